@@ -1,13 +1,43 @@
 import logging
+import os
+import socket
+import threading
 
-from src.kal_worker import KalWorker
+from src.kal_worker import KalWorker, FanOutWorker
 from os import remove
-from src.mirror import Mirror
-from src.cal_setup import get_calendar_service
+from src.mirror import Mirror, FanOutMirror
+from src.cal_setup import get_calendar_service, forget_calendar_service
+from src.source_calendar.ics_calendar_provider import FileEventsProvider
+from src.sync_plan import SyncPlan, load_events
+from src.interval_index import Conflict, find_conflicts
+from typing import List, Union
+from src.remote_snapshot import CalendarSnapshotStore
+from src.util import STATE_DIRECTORY
+from src.rule_cache import RuleResultCache
+from src.batch_controller import AdaptiveBatchController
+from src.job_queue import JobQueue, JobWorker, Job
+from src.change_detection import SyncRecordStore
+from src.watch import WatchRegistry, NotificationReceiver, OwnWriteLog
+from src.log_setup import setup_logging
+from src.sync_journal import SyncJournal
+from src.horizons import HorizonScheduler
+from src.adaptive_polling import AdaptivePoller
+
+snapshot_store = CalendarSnapshotStore()
+rule_cache = RuleResultCache(path=f'{STATE_DIRECTORY}/rule_cache.pickle')
+# shared by all the mirrors, since they use the same google quota
+batch_controller = AdaptiveBatchController()
+sync_record_store = SyncRecordStore()
+journal = SyncJournal()
+horizon_scheduler = HorizonScheduler()
+poller = AdaptivePoller()
+# events written by the workers, to tell the notifications they cause from the edits of other people
+own_writes = OwnWriteLog()
 
 
 def reset_credentials(name:str):
     """Just deletes 'token.pickle'"""
+    forget_calendar_service(name)
     try:
         remove(f'credentials_data/{name}_token.pickle')
     except FileNotFoundError:
@@ -16,16 +46,120 @@ def reset_credentials(name:str):
 
 
 
-def run_service(user:Mirror):
-    print(f"Running service for {user.title}...")
+def make_worker(user:Mirror, **kwargs) -> KalWorker:
+    return KalWorker(source_ics_calendar_url=user.source_ics_calendar_url,
+                     google_calendar_id=user.google_calendar_id,
+                     rules=user.rules,
+                     dedup_key=user.deduplicate,
+                     merge_duplicate_descriptions=user.merge_duplicate_descriptions,
+                     **kwargs)
+
+
+def run_service(user:Mirror, pipelined:bool = False):
+    logging.info(f"Running service for {user.title}...")
 
     
     # reset_credentials(user.title) # pops up the Oauth flow again instead of using the refresh token
-    worker = KalWorker(source_ics_calendar_url=user.source_ics_calendar_url,
-                              google_calendar_id=user.google_calendar_id,
-                              rules=user.rules
-                              )
-    worker.run(get_calendar_service(user.title))
+    # a journal needs the whole plan before the first write : a journaled run can't be pipelined
+    worker = make_worker(user, snapshot_store=snapshot_store, rule_cache=rule_cache, batch_controller=batch_controller,
+                         service_factory=lambda: get_calendar_service(user.title), sync_record_store=sync_record_store,
+                         journal=None if pipelined else journal, poller=poller, own_writes=own_writes)
+    service = get_calendar_service(user.title)
+    if pipelined:
+        return worker.run_pipelined(service)
+    return worker.run(service)
+
+
+def run_tiered_service(user:Mirror):
+    """Syncs the next days of the mirror first, and the far future only when its tier is due (see src/horizons.py).
+    Run it often : most runs only touch the near events."""
+    logging.info(f"Running tiered service for {user.title}...")
+    worker = make_worker(user, snapshot_store=snapshot_store, rule_cache=rule_cache, batch_controller=batch_controller,
+                         service_factory=lambda: get_calendar_service(user.title), sync_record_store=sync_record_store,
+                         journal=journal, poller=poller, own_writes=own_writes)
+    return worker.run_tiered(get_calendar_service(user.title), horizon_scheduler)
+
+
+def run_fan_out_service(mirror:FanOutMirror):
+    """Runs all the targets of the mirror. The source is downloaded and parsed only once."""
+    logging.info(f"Running fan-out service for {mirror.title} on {len(mirror.targets)} calendars...")
+    worker = FanOutWorker(mirror, snapshot_store=snapshot_store, rule_cache=rule_cache,
+                          batch_controller=batch_controller)
+    return worker.run(lambda target: get_calendar_service(target.account or mirror.title))
+
+
+def schedule_mirrors(mirrors:List[Mirror], queue:JobQueue, poller:AdaptivePoller = None):
+    """Enqueues a sync job for each mirror. Mirrors that already wait for a worker aren't enqueued twice.
+    With a `poller`, only the mirrors whose sources or calendar are due are enqueued : call it every few minutes."""
+    if poller is not None:
+        mirrors = poller.due_mirrors(mirrors)
+    for mirror in mirrors:
+        queue.enqueue(mirror.title, mirror.google_calendar_id)
+
+
+def run_job_worker(mirrors:List[Mirror], queue:JobQueue, worker_id:str = None, stop:threading.Event = None):
+    """Runs the jobs of the queue for these mirrors, until `stop` is set. Start as many workers as needed, on any host
+    sharing the queue : a calendar is never synced by two workers at the same time."""
+    mirrors_by_title = {mirror.title: mirror for mirror in mirrors}
+    worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+
+    def run_job(job:Job):
+        if job.mirror_title not in mirrors_by_title:
+            raise KeyError(f"Unknown mirror {job.mirror_title}")
+        if job.payload.get('revalidate'):
+            # the google calendar changed behind our back : the snapshot and the last sync record are outdated
+            snapshot_store.invalidate(job.calendar_id)
+            sync_record_store.invalidate(job.calendar_id)
+            poller.observe_calendar(job.calendar_id, True)
+        run_service(mirrors_by_title[job.mirror_title])
+
+    JobWorker(queue, worker_id, run_job).run_forever(stop=stop)
+
+
+def start_push_triggers(mirrors:List[Mirror], queue:JobQueue, address:str, port:int = 8080) -> NotificationReceiver:
+    """Watches the google calendars of the mirrors, and enqueues their syncs when they change.
+    `address` is the public https url google posts the notifications to, forwarded to `port`.
+    Run `run_job_worker` to process the syncs ; the periodic `schedule_mirrors` can then be much less frequent."""
+    registry = WatchRegistry(address)
+    for mirror in mirrors:
+        registry.watch(get_calendar_service(mirror.title), mirror.google_calendar_id)
+    receiver = NotificationReceiver(registry, mirrors, queue, port=port, own_writes=own_writes,
+                                    get_service=lambda mirror: get_calendar_service(mirror.title))
+    receiver.start()
+    return receiver
+
+
+def plan_service(user:Mirror, google_events_file:str = None, ics_file:Union[str, List[str]] = None) -> SyncPlan:
+    """Dry run : returns what run_service would do, without touching google.
+    The google calendar is read from `google_events_file` (see `sync_plan.dump_events`), or considered empty.
+    `ics_file` replaces the download of the source calendar (a list of files for mirrors with several sources)."""
+    provider = None
+    if isinstance(ics_file, str):
+        provider = FileEventsProvider(ics_file)
+    elif ics_file:
+        provider = [FileEventsProvider(file) for file in ics_file]
+    worker = make_worker(user, provider=provider)
+    google_events = load_events(google_events_file) if google_events_file else []
+    return worker.plan(google_events)
+
+
+def check_mirror_conflicts(mirrors:List[Mirror]) -> List[Conflict]:
+    """Logs the events of different mirrors that overlap in the same google calendar. Doesn't touch google."""
+    by_calendar = {}
+    for mirror in mirrors:
+        by_calendar.setdefault(mirror.google_calendar_id, []).append(mirror)
+
+    conflicts = []
+    for calendar_id, calendar_mirrors in by_calendar.items():
+        if len(calendar_mirrors) < 2:
+            continue
+        events_by_mirror = {mirror.title: [change.event for change in plan_service(mirror).inserts]
+                            for mirror in calendar_mirrors}
+        for conflict in find_conflicts(events_by_mirror):
+            logging.warning(f"Conflict in {calendar_id}: '{conflict.event_1.title}' ({conflict.source_1}) overlaps "
+                            f"'{conflict.event_2.title}' ({conflict.source_2}) at {conflict.event_2.start}")
+            conflicts.append(conflict)
+    return conflicts
 
 
 
@@ -33,8 +167,7 @@ def run_service(user:Mirror):
 from mirrors.my_mirrors import my_mirror
 
 if __name__ == '__main__':
-    logging.basicConfig(encoding='utf-8', level=logging.DEBUG,
-                        handlers=[logging.FileHandler("log.log"), logging.StreamHandler()])
+    setup_logging("log.log", level=logging.DEBUG)
 
     run_service(my_mirror)
 
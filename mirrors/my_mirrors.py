@@ -8,7 +8,7 @@ from src.mirror import Mirror
 
 HAI507I_condition = Condition().field('title').contains('HAI507I', case_sensitive=False)  # Calcul formel
 HAI501I_condition = Condition().field('title').contains('HAI501I', case_sensitive=False)  # Génie logiciel
-HAX503X_HAX505X_condition = Condition().logical_or(Condition().field('title').contains('HAX503X',case_sensitive=False),Condition().field('title').contains('HAX505X',case_sensitive=False))  # Mesure et intégration, Fourier
+HAX503X_HAX505X_condition = Condition().field('title').contains_any(['HAX503X', 'HAX505X'], case_sensitive=False)  # Mesure et intégration, Fourier
 
 HAI503I_condition = Condition().field('title').contains('HAI503I', case_sensitive=False)  # Algorithmique 4
 HAI504I_condition = Condition().field('title').contains('HAI504I', case_sensitive=False)  # Logique du premier ordre
@@ -0,0 +1,84 @@
+"""Profiles a mirror end to end on recorded fixtures, without touching google.
+
+The sources are read from saved ics files (one per url of the mirror, merged like `run`), and the google calendar is a fake one filled with a recorded snapshot : the
+events saved by `sync_plan.dump_events`, or a snapshot file of `kal_state/snapshots`. Each stage of the run is written
+to the output directory as `<stage>.pstats` and `<stage>.speedscope.json` (see src/profiling.py).
+
+Usage:
+    python profile_mirror.py my_mirror saved.ics --google-events google_events.json --output profiles
+    python profile_mirror.py my_merged_mirror l2.ics l3.ics
+"""
+import argparse
+import importlib
+import json
+import logging
+from datetime import datetime
+from typing import List, Union
+
+from src.event import Event
+from src.fake_google_service import FakeGoogleService
+from src.google_calendar_handler import GoogleCalendarHandler
+from src.kal_worker import KalWorker
+from src.metrics import RunMetrics
+from src.mirror import Mirror
+from src.profiling import StageProfiler
+from src.remote_snapshot import CalendarSnapshot
+from src.source_calendar.ics_calendar_provider import FileEventsProvider
+
+
+def load_recorded_events(path: str) -> List[Event]:
+    """Reads the events saved by `sync_plan.dump_events`, or the events of a CalendarSnapshot file."""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return CalendarSnapshot.from_dict(data).events
+    return [Event.from_dict(d) for d in data]
+
+
+def fake_service_with(calendar_id: str, events: List[Event]) -> FakeGoogleService:
+    service = FakeGoogleService()
+    calendar = service.calendars.setdefault(calendar_id, {})
+    for i, event in enumerate(events):
+        body = GoogleCalendarHandler._event_to_body(event)
+        body['id'] = event.id or f'recorded{i}'
+        calendar[body['id']] = body
+    return service
+
+
+def profile_mirror(mirror: Mirror, ics_file: Union[str, List[str]], google_events_file: str = None,
+                   output_directory: str = 'profiles', separation_date: datetime = None,
+                   sampling_interval: float = 0.001) -> RunMetrics:
+    """Runs the mirror once on the fixtures with every stage profiled. Returns the metrics of the run.
+    `ics_file` is a list of files for mirrors with several sources.
+    `separation_date` replaces now, so that old recordings still have events to sync."""
+    ics_files = [ics_file] if isinstance(ics_file, str) else list(ics_file)
+    service = fake_service_with(mirror.google_calendar_id,
+                                load_recorded_events(google_events_file) if google_events_file else [])
+    profiler = StageProfiler(output_directory, sampling_interval=sampling_interval)
+    worker = KalWorker(source_ics_calendar_url=ics_files,
+                       google_calendar_id=mirror.google_calendar_id,
+                       rules=mirror.rules,
+                       provider=[FileEventsProvider(file) for file in ics_files],
+                       dedup_key=mirror.deduplicate,
+                       merge_duplicate_descriptions=mirror.merge_duplicate_descriptions,
+                       profiler=profiler)
+    worker.run(service, separation_date)
+    for path in profiler.dump():
+        logging.info(f"Profile written to {path}")
+    return worker.metrics
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Profiles a mirror of mirrors/my_mirrors.py on recorded fixtures.")
+    parser.add_argument('mirror', help="name of the mirror in mirrors/my_mirrors.py")
+    parser.add_argument('ics_files', nargs='+', help="saved ics files of the sources, in the order of the mirror")
+    parser.add_argument('--google-events', help="recorded events of the google calendar (json)")
+    parser.add_argument('--output', default='profiles', help="directory of the profiles")
+    parser.add_argument('--since', type=datetime.fromisoformat,
+                        help="separation date of the run (default : now), e.g. 2021-09-13")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    mirror = getattr(importlib.import_module('mirrors.my_mirrors'), args.mirror)
+    metrics = profile_mirror(mirror, args.ics_files, args.google_events, args.output, args.since)
+    logging.info(metrics.summary())
@@ -0,0 +1,168 @@
+"""Adaptive polling : each mirror is synced as often as its sources and its calendar actually change.
+
+The poller keeps the change history of each source url (its content hash changed, rather than 304 or the same hash)
+and of each target calendar (kal had to write in it, or google notified a change). The poll interval of a key is
+multiplied by `backoff` each time it is found unchanged, up to `max_interval`, and goes back to `min_interval` as soon
+as it changes. Around the hours of the day when a key usually changes (e.g. when the timetables are edited), its
+interval is capped at `hot_interval`.
+
+A mirror is due when one of its keys is due. Call `schedule_mirrors(mirrors, queue, poller)` every `min_interval` :
+only the due mirrors are enqueued.
+
+The histories are kept in a SQLite file : the scheduler and the job workers (see main.py) are separate processes,
+each observation is a transaction on the history of its key, and the scheduler reads the observations of the workers.
+"""
+import json
+import os
+import sqlite3
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from src.mirror import Mirror
+from src.util import STATE_DIRECTORY
+
+# Changes remembered per key, to find the hours when it usually changes
+HISTORY_SIZE = 50
+
+
+def source_key(url: str) -> str:
+    return f'source:{url}'
+
+
+def calendar_key(calendar_id: str) -> str:
+    return f'calendar:{calendar_id}'
+
+
+def mirror_keys(mirror: Mirror) -> List[str]:
+    urls = mirror.source_ics_calendar_url
+    if isinstance(urls, str):
+        urls = [urls]
+    return [source_key(url) for url in urls] + [calendar_key(mirror.google_calendar_id)]
+
+
+@dataclass
+class PollHistory:
+    interval: float  # seconds to wait before the next poll
+    checked_at: Optional[float] = None  # epoch seconds of the last poll
+    changes: List[float] = field(default_factory=list)  # epoch seconds of the last changes
+
+
+class AdaptivePoller:
+    """Ex:
+        poller = AdaptivePoller()
+        worker = KalWorker(..., poller=poller)
+        schedule_mirrors(mirrors, queue, poller)
+    """
+
+    def __init__(self, min_interval: timedelta = timedelta(minutes=5), max_interval: timedelta = timedelta(hours=6),
+                 backoff: float = 2.0, hot_interval: timedelta = timedelta(minutes=15), hot_threshold: int = 3,
+                 path: str = os.path.join(STATE_DIRECTORY, 'poll_history.sqlite')):
+        """An hour of the day is hot for a key if at least `hot_threshold` of its remembered changes happened then."""
+        if backoff < 1:
+            raise ValueError("backoff must be >= 1")
+        self.min_interval = min_interval.total_seconds()
+        self.max_interval = max_interval.total_seconds()
+        self.backoff = backoff
+        self.hot_interval = hot_interval.total_seconds()
+        self.hot_threshold = hot_threshold
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = self._connect()
+        try:
+            connection.execute('''CREATE TABLE IF NOT EXISTS poll_history (
+                key TEXT PRIMARY KEY,
+                interval REAL NOT NULL,
+                checked_at REAL,
+                changes TEXT NOT NULL
+            )''')
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None : transactions are explicit, so that an observation can lock the database
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    @staticmethod
+    def _to_history(row: sqlite3.Row) -> PollHistory:
+        return PollHistory(interval=row['interval'], checked_at=row['checked_at'], changes=json.loads(row['changes']))
+
+    @property
+    def histories(self) -> Dict[str, PollHistory]:
+        connection = self._connect()
+        try:
+            return {row['key']: self._to_history(row) for row in connection.execute('SELECT * FROM poll_history')}
+        finally:
+            connection.close()
+
+    def history(self, key: str) -> Optional[PollHistory]:
+        connection = self._connect()
+        try:
+            row = connection.execute('SELECT * FROM poll_history WHERE key = ?', (key,)).fetchone()
+        finally:
+            connection.close()
+        return self._to_history(row) if row is not None else None
+
+    def observe(self, key: str, changed: bool, now: datetime = None):
+        """Records a poll of the key, and whether it changed since the previous one."""
+        now = (now or datetime.now()).timestamp()
+        connection = self._connect()
+        try:
+            # the history is read and written in one transaction : the other processes wait
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT * FROM poll_history WHERE key = ?', (key,)).fetchone()
+            history = self._to_history(row) if row is not None else PollHistory(interval=self.min_interval)
+            history.checked_at = now
+            if changed:
+                history.interval = self.min_interval
+                history.changes = (history.changes + [now])[-HISTORY_SIZE:]
+            else:
+                history.interval = min(history.interval * self.backoff, self.max_interval)
+            connection.execute('INSERT OR REPLACE INTO poll_history (key, interval, checked_at, changes) '
+                               'VALUES (?, ?, ?, ?)',
+                               (key, history.interval, history.checked_at, json.dumps(history.changes)))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+
+    def observe_source(self, url: str, changed: bool, now: datetime = None):
+        self.observe(source_key(url), changed, now)
+
+    def observe_calendar(self, calendar_id: str, changed: bool, now: datetime = None):
+        self.observe(calendar_key(calendar_id), changed, now)
+
+    def _hot_between(self, history: PollHistory, start: datetime, end: datetime) -> bool:
+        """True if the key usually changes at an hour of the day between `start` and `end`."""
+        hours = Counter(datetime.fromtimestamp(change).hour for change in history.changes)
+        when = start
+        while when < end:
+            if hours[when.hour] >= self.hot_threshold:
+                return True
+            when += timedelta(hours=1)
+        return hours[end.hour] >= self.hot_threshold
+
+    def next_poll(self, key: str) -> Optional[datetime]:
+        """When the key should be polled next. None if it was never polled."""
+        history = self.history(key)
+        if history is None or history.checked_at is None:
+            return None
+        next_poll = datetime.fromtimestamp(history.checked_at + history.interval)
+        hot_poll = datetime.fromtimestamp(history.checked_at + self.hot_interval)
+        # a change is expected before the next poll : poll earlier
+        if hot_poll < next_poll and self._hot_between(history, hot_poll, next_poll):
+            return hot_poll
+        return next_poll
+
+    def is_due(self, mirror: Mirror, now: datetime = None) -> bool:
+        now = now or datetime.now()
+        return any(next_poll is None or next_poll <= now for next_poll in map(self.next_poll, mirror_keys(mirror)))
+
+    def due_mirrors(self, mirrors: List[Mirror], now: datetime = None) -> List[Mirror]:
+        return [mirror for mirror in mirrors if self.is_due(mirror, now)]
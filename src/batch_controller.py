@@ -0,0 +1,107 @@
+"""Run time tuning of the size and the number of concurrent google batches.
+
+The controller follows an additive increase / multiplicative decrease scheme : each fast batch without errors makes
+the next ones a bit bigger (then more concurrent), and throttling by google halves both and waits before the next
+batch.
+"""
+import time
+from dataclasses import dataclass
+from threading import Lock
+
+from googleapiclient.errors import HttpError
+
+# Google advises against more than 50 calls in one batch
+MAX_BATCH_SIZE = 50
+
+
+def is_throttling_error(exception: Exception) -> bool:
+    """Returns True if google refused the request because of its rate limits."""
+    if not isinstance(exception, HttpError):
+        return False
+    if exception.status_code == 429:
+        return True
+    if exception.status_code == 403:
+        details = f'{exception.reason} {exception.content!r}'.lower()
+        return 'ratelimitexceeded' in details or 'rate limit exceeded' in details
+    return False
+
+
+@dataclass
+class BatchReport:
+    """What happened to one batch."""
+    size: int
+    latency: float  # seconds
+    errors: int = 0
+    throttled: int = 0
+
+
+class AdaptiveBatchController:
+    """Chooses the size of the next google batches and how many can be sent at the same time.
+    Thread safe : share it between the handlers that use the same google quota.
+
+    Ex:
+        handler = GoogleCalendarHandler(calendar_id, service, batch_controller=AdaptiveBatchController())
+    """
+
+    def __init__(self, min_size: int = 5, max_size: int = MAX_BATCH_SIZE, initial_size: int = MAX_BATCH_SIZE,
+                 max_concurrency: int = 4, initial_concurrency: int = 1, target_latency: float = 2.0,
+                 max_error_rate: float = 0.1, size_step: int = 5, backoff: float = 1.0, max_backoff: float = 32.0):
+        if not 1 <= min_size <= initial_size <= max_size <= MAX_BATCH_SIZE:
+            raise ValueError(f"Batch sizes must be ordered and between 1 and {MAX_BATCH_SIZE}")
+        if not 1 <= initial_concurrency <= max_concurrency:
+            raise ValueError("Concurrencies must be ordered and at least 1")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.size_step = size_step
+        self.initial_backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.batch_size = initial_size
+        self.concurrency = initial_concurrency
+        self.backoff = backoff
+        self.throttled_until = 0.0
+        self.batches = 0
+        self.throttled_batches = 0
+        self._lock = Lock()
+
+    def wait_for_quota(self):
+        """Sleeps until the back off that follows throttling is over."""
+        with self._lock:
+            delay = self.throttled_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record(self, report: BatchReport):
+        """Adapts the settings to the result of a batch."""
+        with self._lock:
+            self.batches += 1
+            if report.throttled:
+                self.throttled_batches += 1
+                self.batch_size = max(self.min_size, self.batch_size // 2)
+                self.concurrency = max(1, self.concurrency // 2)
+                self.throttled_until = time.monotonic() + self.backoff
+                self.backoff = min(self.max_backoff, self.backoff * 2)
+                return
+
+            self.backoff = self.initial_backoff
+            error_rate = report.errors / report.size if report.size else 0
+            if error_rate > self.max_error_rate or report.latency > 2 * self.target_latency:
+                self.batch_size = max(self.min_size, self.batch_size - self.size_step)
+            elif report.latency <= self.target_latency and report.size >= self.batch_size:
+                # headroom : grow the batches first, then send more of them at once
+                if self.batch_size < self.max_size:
+                    self.batch_size = min(self.max_size, self.batch_size + self.size_step)
+                elif self.concurrency < self.max_concurrency:
+                    self.concurrency += 1
+
+    def settings(self) -> dict:
+        with self._lock:
+            return {
+                'batch_size': self.batch_size,
+                'concurrency': self.concurrency,
+                'batches': self.batches,
+                'throttled_batches': self.throttled_batches,
+            }
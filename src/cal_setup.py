@@ -1,18 +1,33 @@
 import pickle
 import os.path
+import threading
+from datetime import datetime, timedelta
 
+import httplib2
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow, Flow
 
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
+# Access tokens are refreshed this long before their expiry, so that a sync never starts with a token
+# that will die in the middle of its batches.
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
 
 
+def _token_file(name: str) -> str:
+    return f'credentials_data/{name}_token.pickle'
 
-def get_calendar_service(name:str):
-    file = f'credentials_data/{name}_token.pickle'
+
+def _save_credentials(name: str, creds):
+    with open(_token_file(name), 'wb') as token:
+        pickle.dump(creds, token)
+
+
+def load_credentials(name: str):
+    file = _token_file(name)
     creds = None
     # The file token.pickle stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
@@ -32,9 +47,81 @@ def get_calendar_service(name:str):
             creds = flow.run_local_server(port=0)
 
         # Save the credentials for the next run
-        with open(file, 'wb') as token:
-            pickle.dump(creds, token)
+        _save_credentials(name, creds)
+    return creds
+
+
+class CalendarServiceCache:
+    """Keeps the credentials and the calendar services of each google account, keyed by account name,
+    so that mirrors sharing an account don't unpickle, refresh and `build` again for every run.
+
+    Credentials are shared by all threads and refreshed under a per-account lock, `refresh_margin` before
+    they expire. httplib2 transports are not thread safe, so each thread gets its own authorized transport
+    and service per account; all the mirrors of an account running on that thread share them.
+    """
+
+    def __init__(self, refresh_margin: timedelta = TOKEN_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._account_locks = {}
+        self._credentials = {}
+        self._generations = {}
+        self._local = threading.local()
+
+    def _account_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._account_locks.setdefault(name, threading.Lock())
+
+    def _expires_soon(self, creds) -> bool:
+        if creds.expiry is None:
+            return not creds.valid
+        # google-auth stores expiry as a naive UTC datetime
+        return creds.expiry - self.refresh_margin <= datetime.utcnow()
+
+    def get_credentials(self, name: str):
+        """Returns the cached credentials of the account, loading them on first use and refreshing them
+        if they are about to expire."""
+        with self._account_lock(name):
+            creds = self._credentials.get(name)
+            if creds is None:
+                creds = load_credentials(name)
+                self._credentials[name] = creds
+                self._generations[name] = self._generations.get(name, 0) + 1
+            elif creds.refresh_token and self._expires_soon(creds):
+                creds.refresh(Request())
+                _save_credentials(name, creds)
+            return creds
+
+    def get_service(self, name: str):
+        """Returns a calendar service for the account, built at most once per thread."""
+        creds = self.get_credentials(name)
+        generation = self._generations[name]
+
+        services = getattr(self._local, 'services', None)
+        if services is None:
+            services = self._local.services = {}
+
+        cached = services.get(name)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+
+        http = AuthorizedHttp(creds, http=httplib2.Http())
+        service = build('calendar', 'v3', http=http)
+        services[name] = (generation, service)
+        return service
+
+    def invalidate(self, name: str):
+        """Forgets the account's credentials. Services built from them are rebuilt on their next use."""
+        with self._account_lock(name):
+            self._credentials.pop(name, None)
+
+
+_service_cache = CalendarServiceCache()
+
+
+def get_calendar_service(name: str):
+    return _service_cache.get_service(name)
 
-    service = build('calendar', 'v3', credentials=creds)
-    return service
 
+def forget_calendar_service(name: str):
+    _service_cache.invalidate(name)
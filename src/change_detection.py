@@ -0,0 +1,86 @@
+"""Fast path of the runs : nothing to do when the source, the rules and the sync window didn't change.
+
+After each successful sync, the worker records a fingerprint of what it synced. On the next run, the source is
+downloaded (or answers 304 Not Modified) and hashed without being parsed : if the fingerprint is the same, the run ends
+right away, without parsing, listing the google calendar or writing.
+
+The google calendar itself is not part of the fingerprint : kal is the only writer of its events. A full run still
+happens when the sync window moves to the next period (a day by default).
+"""
+import hashlib
+import json
+import os
+import re
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any
+
+import pytz
+
+from src.util import STATE_DIRECTORY
+
+
+def window_key(separation_date: datetime, period: timedelta) -> int:
+    """Number of the period containing `separation_date`. Changes each time the sync window moves by a period."""
+    epoch = separation_date.astimezone(pytz.utc).timestamp()
+    return int(epoch // period.total_seconds())
+
+
+def sync_fingerprint(source_hashes: List[str], rules_fingerprint: Optional[str], settings: Any) -> Optional[str]:
+    """Hashes everything a sync depends on. Returns None if the rules can't be fingerprinted : no fast path then.
+    `settings` must be json serializable (sync window, deduplication...)."""
+    if rules_fingerprint is None or any(h is None for h in source_hashes):
+        return None
+    data = json.dumps([source_hashes, rules_fingerprint, settings], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+@dataclass
+class SyncRecord:
+    """What the last successful sync of a google calendar was based on.
+    `sources` holds the validators and hash of each source : {source_name: {'etag', 'last_modified', 'hash'}}."""
+    calendar_id: str
+    fingerprint: str
+    sources: Dict[str, Dict[str, Optional[str]]] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return {'calendar_id': self.calendar_id, 'fingerprint': self.fingerprint, 'sources': self.sources}
+
+    @staticmethod
+    def from_dict(d: dict) -> 'SyncRecord':
+        return SyncRecord(calendar_id=d['calendar_id'], fingerprint=d['fingerprint'], sources=d.get('sources', {}))
+
+
+class SyncRecordStore:
+    """Stores the SyncRecord of each google calendar, as json files in `directory`."""
+
+    def __init__(self, directory: str = os.path.join(STATE_DIRECTORY, 'sync_records'),
+                 window_period: timedelta = timedelta(days=1)):
+        self.directory = directory
+        self.window_period = window_period
+
+    def _path(self, calendar_id: str) -> str:
+        return os.path.join(self.directory, re.sub(r'[^A-Za-z0-9._-]', '_', calendar_id) + '.json')
+
+    def load(self, calendar_id: str) -> Optional[SyncRecord]:
+        try:
+            with open(self._path(calendar_id), 'r', encoding='utf-8') as f:
+                record = SyncRecord.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+        return record if record.calendar_id == calendar_id else None
+
+    def save(self, record: SyncRecord):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(record.calendar_id)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(record.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    def invalidate(self, calendar_id: str):
+        """Forces the next run to go through all the steps."""
+        try:
+            os.remove(self._path(calendar_id))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,84 @@
+"""Removal of duplicate events, for feeds that emit the same session several times (e.g. once per student group)."""
+from dataclasses import replace
+from typing import List, Sequence, Union, Hashable, Iterable, Iterator
+
+import pytz
+
+from src.event import Event
+
+UID_KEY = 'uid'
+CONTENT_KEY = 'content'
+
+# Fields compared by the CONTENT_KEY
+CONTENT_FIELDS = ('title', 'start', 'end', 'location')
+
+
+def duplicate_key(event: Event, key: Union[str, Sequence[str]] = CONTENT_KEY) -> Hashable:
+    """Returns the value identifying duplicates of the event.
+    `key` is UID_KEY, CONTENT_KEY (title, start, end and location) or a list of field names."""
+    if key == UID_KEY:
+        return event.uid
+    fields = CONTENT_FIELDS if key == CONTENT_KEY else key
+    values = []
+    for field in fields:
+        value = event.get_attr_from_str(field)
+        if field in ('start', 'end', 'begin', 'created', 'updated') and value is not None:
+            value = value.astimezone(pytz.utc)
+        values.append(value)
+    return tuple(values)
+
+
+def _merge_descriptions(descriptions: List[str]) -> str:
+    """Keeps each line of the descriptions once, in order of first appearance."""
+    lines = []
+    seen = set()
+    for description in descriptions:
+        for line in description.split('\n'):
+            if line not in seen:
+                seen.add(line)
+                lines.append(line)
+    return '\n'.join(lines)
+
+
+def deduplicate_events(events: Sequence[Event], key: Union[str, Sequence[str]] = CONTENT_KEY,
+                       merge_descriptions: bool = False) -> List[Event]:
+    """Keeps the first event of each group of duplicates, in linear time.
+    With `merge_descriptions`, the kept event gets the lines of the descriptions of all its duplicates."""
+    kept = []
+    positions = {}
+    descriptions = {}
+    for event in events:
+        k = duplicate_key(event, key)
+        if k is None:
+            # events without uid can't be compared by uid
+            kept.append(event)
+            continue
+        if k not in positions:
+            positions[k] = len(kept)
+            kept.append(event)
+            descriptions[k] = []
+        if merge_descriptions and event.description:
+            descriptions[k].append(event.description)
+
+    if merge_descriptions:
+        for k, position in positions.items():
+            if len(descriptions[k]) > 1:
+                kept[position] = replace(kept[position], description=_merge_descriptions(descriptions[k]))
+    return kept
+
+
+def deduplicate_stream(chunks: Iterable[List[Event]], key: Union[str, Sequence[str]] = CONTENT_KEY) \
+        -> Iterator[List[Event]]:
+    """Like `deduplicate_events` for events arriving in chunks : keeps the first event of each group of duplicates
+    across all the chunks. Descriptions can't be merged, since a duplicate can still come in a later chunk."""
+    seen = set()
+    for chunk in chunks:
+        kept = []
+        for event in chunk:
+            k = duplicate_key(event, key)
+            if k is None:
+                kept.append(event)
+            elif k not in seen:
+                seen.add(k)
+                kept.append(event)
+        yield kept
@@ -1,4 +1,4 @@
-from dataclasses import dataclass, replace
+from dataclasses import dataclass, replace, fields
 from datetime import datetime
 from typing import Any, Optional
 
@@ -21,7 +21,9 @@ class Event:
     end: datetime = None
     color: EventColor = None
     extended_properties: Optional[dict] = None
-
+    uid: str = None
+    # Which source calendar the event comes from, for mirrors with several sources
+    source: str = None
 
 
     @staticmethod
@@ -32,7 +34,7 @@ class Event:
 
         field = Event._format_field_name(field)
 
-        if field in ('id', 'title', 'description', 'location', 'html_link'):
+        if field in ('id', 'title', 'description', 'location', 'html_link', 'uid', 'source'):
             return str
         if field in ('created', 'updated', 'start', 'end'):
             return datetime
@@ -56,6 +58,32 @@ class Event:
     def get_attr_from_str(self, attr: str) -> Any:
         return self.__getattribute__(self._format_field_name(attr))
 
+    def to_dict(self) -> dict:
+        """Returns a json serializable representation of the event. See `Event.from_dict`."""
+        d = {}
+        for f in fields(self):
+            value = getattr(self, f.name)
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            elif isinstance(value, EventColor):
+                value = value.value
+            d[f.name] = value
+        return d
+
+    @staticmethod
+    def from_dict(d: dict) -> 'Event':
+        values = {}
+        for f in fields(Event):
+            if f.name not in d:
+                continue
+            value = d[f.name]
+            if value is not None and f.name in ('created', 'updated', 'start', 'end'):
+                value = datetime.fromisoformat(value)
+            elif value is not None and f.name == 'color':
+                value = EventColor(value)
+            values[f.name] = value
+        return Event(**values)
+
     def __lt__(self, other) -> bool:
         """Allows sorting by start date."""
         return self.starts_before(other)
@@ -1,10 +1,13 @@
 """Class for changing an event's color base on it's content"""
+import re
 from dataclasses import replace
 from datetime import datetime
-from typing import List, Optional,Sequence
+from typing import List, Optional, Sequence, Callable
 
 from src.event import Event
 from src.event_colors import EventColor
+from src.interval_index import IntervalIndex, duplicates_mask
+from src.string_pool import TransformCache
 
 
 class Condition:
@@ -23,6 +26,13 @@ class Condition:
     def __init__(self):
         self.field_name = None
         self.evaluate_function = None
+        # Evaluates a list of events at once. Defaults to calling evaluate_function on each event.
+        self.batch_function = None
+        # True if the result for an event depends on the other events of the batch
+        self.needs_context = False
+        # Plain data description of the condition, e.g. ('contains', 'title', 'HAX301', True).
+        # Used to fingerprint rule sets. None if the condition can't be described.
+        self.spec = None
 
     def field(self, field: str):
         """Sets the event attribute on which the evaluate function will work on.
@@ -39,6 +49,8 @@ class Condition:
     def always(self):
         """Sets the condition to evaluate to True all the time"""
         self.evaluate_function = lambda event: True
+        self.batch_function = lambda events: [True] * len(events)
+        self.spec = ('always',)
         return self
 
     def contains(self, substring: str, *, case_sensitive=True):
@@ -49,20 +61,40 @@ class Condition:
         The event's field should be of type str. Raises TypeError if not."""
         self._check_str_type()
 
-        def evaluate(event: Event) -> bool:
-            try:
-                value = event.get_attr_from_str(self.field_name)
-            except AttributeError:
-                return False
-            if value is None:
-                return False
-            value: str
-            if case_sensitive:
-                return substring in value
-            else:
-                return substring.lower() in value.lower()
+        if case_sensitive:
+            self._set_value_test(lambda value: substring in value)
+        else:
+            folded_substring = substring.casefold()
+            self._set_value_test(lambda value: folded_substring in value.casefold())
+        self.spec = ('contains', self._spec_field(), substring, case_sensitive)
+        return self
 
-        self.evaluate_function = evaluate
+    def contains_any(self, substrings: Sequence[str], *, case_sensitive=True):
+        """Sets the condition to evaluate to True if the provided field contains at least one of the [substrings].
+        All the substrings are merged in a single precompiled pattern, so the field is scanned once.
+        The event's field should be of type str. Raises TypeError if not."""
+        self._check_str_type()
+        substrings = tuple(substrings)
+        pattern = _substrings_pattern(substrings, case_sensitive)
+
+        if pattern is None:
+            self._set_value_test(lambda value: False)
+        elif case_sensitive:
+            self._set_value_test(lambda value: pattern.search(value) is not None)
+        else:
+            self._set_value_test(lambda value: pattern.search(value.casefold()) is not None)
+        self.spec = ('contains_any', self._spec_field(), substrings, case_sensitive)
+        return self
+
+    def matches(self, regex: str, *, case_sensitive=True):
+        """Sets the condition to evaluate to True if the regular expression [regex] matches somewhere in the
+        provided field (see `re.search`). The expression is compiled once.
+        The event's field should be of type str. Raises TypeError if not."""
+        self._check_str_type()
+        pattern = re.compile(regex, 0 if case_sensitive else re.IGNORECASE)
+
+        self._set_value_test(lambda value: pattern.search(value) is not None)
+        self.spec = ('matches', self._spec_field(), regex, case_sensitive)
         return self
 
     def equals(self, string: str):
@@ -70,14 +102,8 @@ class Condition:
                 The event's field should be of type str. Raises TypeError if not."""
         self._check_str_type()
 
-        def evaluate(event: Event) -> bool:
-            try:
-                value = event.get_attr_from_str(self.field_name)
-            except AttributeError:
-                return False
-            return value is not None and value == string
-
-        self.evaluate_function = evaluate
+        self._set_value_test(lambda value: value == string)
+        self.spec = ('equals', self._spec_field(), string)
         return self
 
     def starts_with(self, start_string: str):
@@ -85,16 +111,8 @@ class Condition:
                         The event's field should be of type str. Raises TypeError if not."""
         self._check_str_type()
 
-        def evaluate(event: Event) -> bool:
-            try:
-                value: str = event.get_attr_from_str(self.field_name)
-
-            except AttributeError:
-                return False
-            return value is not None and value.startswith(start_string)
-
-        self.evaluate_function = evaluate
-
+        self._set_value_test(lambda value: value.startswith(start_string))
+        self.spec = ('starts_with', self._spec_field(), start_string)
         return self
 
     def ends_with(self, end_string: str):
@@ -102,48 +120,108 @@ class Condition:
                         The event's field should be of type str. Raises TypeError if not."""
         self._check_str_type()
 
+        self._set_value_test(lambda value: value.endswith(end_string))
+        self.spec = ('ends_with', self._spec_field(), end_string)
+        return self
+
+    def overlaps_another_event(self):
+        """Sets the condition to evaluate to True if the event overlaps another event of the list the rule is
+        applied to. Uses a sweep line, in O(n log n).
+        Needs the other events, so it only works in batches (see `Rule.apply_to_batch`) : evaluate raises ValueError."""
+        self._set_context_function(lambda events: IntervalIndex(events).overlaps_mask())
+        return self
+
+    def is_duplicate(self, fields: Sequence[str] = ('title',)):
+        """Sets the condition to evaluate to True if an event before this one, in the list the rule is applied to,
+        has the same start, end and [fields]. The first copy of an event is not a duplicate.
+        Only works in batches (see `Rule.apply_to_batch`) : evaluate raises ValueError."""
+        for field in fields:
+            Event.type_of_field(field)
+        fields = tuple(fields)
+        self._set_context_function(lambda events: duplicates_mask(events, fields))
+        return self
+
+    def _set_context_function(self, batch_function: Callable[[Sequence[Event]], List[bool]]):
         def evaluate(event: Event) -> bool:
-            try:
-                value: str = event.get_attr_from_str(self.field_name)
+            raise ValueError("This condition depends on the other events and can only be evaluated in batches.")
+
+        self.evaluate_function = evaluate
+        self.batch_function = batch_function
+        self.needs_context = True
+        # the result depends on the other events, so it can't be described (and cached) event by event
+        self.spec = None
 
+    def _set_value_test(self, test: Callable[[str], bool]):
+        """Sets the condition to evaluate to test(value) on the value of the provided field, and to False if it's None.
+        In batches, the column of values is read once and the test runs in a single comprehension."""
+        field_name = Event._format_field_name(self.field_name)
+
+        def evaluate(event: Event) -> bool:
+            try:
+                value = event.get_attr_from_str(field_name)
             except AttributeError:
                 return False
-            return value is not None and value.endswith(end_string)
+            return value is not None and test(value)
 
-        self.evaluate_function = evaluate
+        def evaluate_batch(events: Sequence[Event]) -> List[bool]:
+            values = [getattr(event, field_name) for event in events]
+            return [value is not None and test(value) for value in values]
 
-        return self
+        self.evaluate_function = evaluate
+        self.batch_function = evaluate_batch
 
     def logical_or(self, condition_1: 'Condition', condition_2: 'Condition'):
-        def evaluate(event: Event) -> bool:
-            return condition_1.evaluate(event) or condition_2.evaluate(event)
-        self.evaluate_function = evaluate
+        self._set_any([condition_1, condition_2])
+        self.spec = self._logical_spec('or', [condition_1, condition_2])
         return self
     
     def logical_any(self, conditions:Sequence['Condition']):
-        def evaluate(event:Event)->bool:
-            return any([condition.evaluate(event) for condition in conditions])
-        
-        self.evaluate_function = evaluate
+        """Evaluates to True if any of the conditions does. Substring conditions on the same field are merged in one
+        matcher, so long OR-chains scan each field once."""
+        self._set_any(conditions)
+        self.spec = self._logical_spec('any', conditions)
         return self
 
+    def _set_any(self, conditions: Sequence['Condition']):
+        self.needs_context = any(condition.needs_context for condition in conditions)
+        merged = _merge_substring_conditions(conditions)
+        if len(merged) == 1:
+            self.evaluate_function = merged[0].evaluate_function
+            self.batch_function = merged[0].batch_function
+            return
+
+        def evaluate(event:Event)->bool:
+            return any(condition.evaluate(event) for condition in merged)
 
-    def logical_and(self, condition_1: 'Condition', condition_2: 'Condition'):
-        def evaluate(event: Event) -> bool:
-            return condition_1.evaluate(event) and condition_2.evaluate(event)
         self.evaluate_function = evaluate
+        self.batch_function = lambda events: _evaluate_batch_short_circuit(merged, events, True)
+
+    def logical_and(self, condition_1: 'Condition', condition_2: 'Condition'):
+        self._set_all([condition_1, condition_2])
+        self.spec = self._logical_spec('and', [condition_1, condition_2])
         return self
 
     def logical_all(self, conditions:Sequence['Condition']):
+        self._set_all(conditions)
+        self.spec = self._logical_spec('all', conditions)
+        return self
+
+    def _set_all(self, conditions: Sequence['Condition']):
+        self.needs_context = any(condition.needs_context for condition in conditions)
+
         def evaluate(event:Event)->bool:
-            return all([condition.evaluate(event) for condition in conditions])
-        
+            return all(condition.evaluate(event) for condition in conditions)
+
         self.evaluate_function = evaluate
-        return self
+        self.batch_function = lambda events: _evaluate_batch_short_circuit(conditions, events, False)
+
     def logical_not(self, condition_1: 'Condition'):
         def evaluate(event: Event) -> bool:
             return not condition_1.evaluate(event)
         self.evaluate_function = evaluate
+        self.batch_function = lambda events: [not value for value in condition_1.evaluate_batch(events)]
+        self.needs_context = condition_1.needs_context
+        self.spec = self._logical_spec('not', [condition_1])
         return self
 
     def evaluate(self, event: Event) -> bool:
@@ -153,12 +231,97 @@ class Condition:
             raise ValueError("Tried to evaluate a rule on a non initialized Condition.")
         return self.evaluate_function(event)
 
+    def evaluate_batch(self, events: Sequence[Event]) -> List[bool]:
+        """Evaluates the condition on all the events at once, and returns the mask of the matching ones."""
+        if self.evaluate_function is None:
+            raise ValueError("Tried to evaluate a rule on a non initialized Condition.")
+        if self.batch_function is None:
+            return [self.evaluate_function(event) for event in events]
+        return self.batch_function(events)
+
+    def _spec_field(self) -> str:
+        return Event._format_field_name(self.field_name)
+
+    @staticmethod
+    def _logical_spec(operator: str, conditions: Sequence['Condition']) -> Optional[tuple]:
+        if any(condition.spec is None for condition in conditions):
+            return None
+        return (operator, tuple(condition.spec for condition in conditions))
+
     def _check_str_type(self):
         if Event.type_of_field(self.field_name) is not str:
             raise TypeError(
                 f"{Condition.contains} can only be called on a string field. {self.field=} {type(self.field)=}.")
 
 
+def _evaluate_batch_short_circuit(conditions: Sequence[Condition], events: Sequence[Event], stop_value: bool) \
+        -> List[bool]:
+    """Evaluates an 'any' (stop_value=True) or an 'all' (stop_value=False) of the conditions on a batch of events.
+    Each condition only evaluates the events that are not decided yet, except the conditions that need the other
+    events, which always see the whole batch."""
+    mask = [not stop_value] * len(events)
+    undecided = list(range(len(events)))
+    for condition in conditions:
+        if not undecided:
+            break
+        if condition.needs_context:
+            all_values = condition.evaluate_batch(events)
+            values = [all_values[i] for i in undecided]
+        else:
+            values = condition.evaluate_batch([events[i] for i in undecided])
+        still_undecided = []
+        for i, value in zip(undecided, values):
+            if bool(value) == stop_value:
+                mask[i] = stop_value
+            else:
+                still_undecided.append(i)
+        undecided = still_undecided
+    return mask
+
+
+def _substrings_pattern(substrings: Sequence[str], case_sensitive: bool) -> Optional[re.Pattern]:
+    """Compiles an alternation of the escaped substrings, casefolded if not case_sensitive. None if there are none."""
+    if not substrings:
+        return None
+    if not case_sensitive:
+        substrings = [substring.casefold() for substring in substrings]
+    # longest first, so that the alternation doesn't stop on a shorter prefix
+    alternatives = sorted(set(substrings), key=len, reverse=True)
+    return re.compile('|'.join(re.escape(substring) for substring in alternatives))
+
+
+def _merge_substring_conditions(conditions: Sequence[Condition]) -> List[Condition]:
+    """Returns equivalent conditions for a logical OR, where the `contains` and `contains_any` conditions on the same
+    field and with the same case sensitivity are merged into a single `contains_any`."""
+    groups = {}
+    merged = []
+    for condition in conditions:
+        spec = condition.spec
+        if spec is not None and spec[0] in ('contains', 'contains_any'):
+            substrings = (spec[2],) if spec[0] == 'contains' else spec[2]
+            key = (spec[1], spec[3])
+            if key not in groups:
+                groups[key] = []
+                merged.append(key)
+            groups[key].append((condition, substrings))
+        else:
+            merged.append(condition)
+
+    result = []
+    for item in merged:
+        if isinstance(item, Condition):
+            result.append(item)
+            continue
+        group = groups[item]
+        if len(group) == 1:
+            result.append(group[0][0])
+        else:
+            field, case_sensitive = item
+            substrings = [substring for _, group_substrings in group for substring in group_substrings]
+            result.append(Condition().field(field).contains_any(substrings, case_sensitive=case_sensitive))
+    return result
+
+
 class Rule:
     """Represents a rule, independent of any event.
     The rule can be then applied to an event instance, and the chosen action(s) will be executed
@@ -181,6 +344,16 @@ class Rule:
     def __init__(self):
         self.apply_functions = []
         self.conditions = None
+        self.name = None
+        # Plain data description of each action, in the same order as apply_functions
+        self.action_specs = []
+        # Results of the string actions by (action index, input value) : equal inputs share their result
+        self.transform_cache = TransformCache()
+
+    def named(self, name: str):
+        """Gives the rule a name, used to attribute changes to it in sync plans and logs."""
+        self.name = name
+        return self
 
     def on(self, conditions: List[Condition]):
         if isinstance(conditions, Condition):
@@ -194,6 +367,7 @@ class Rule:
             return replace(event, color=color)
 
         self.apply_functions.append(apply)
+        self.action_specs.append(('change_color', color.value))
         return self
 
     def prefix_str_to_field(self, field_name: str, append_value):
@@ -202,11 +376,17 @@ class Rule:
         Ex:
         Rule().prefix_str_to_field('title', 'Doctor Appointment - ').on(Condition().field('title').contains('Mr. BOBO'))
         """
+        index = len(self.action_specs)
+
+        def transform(field_value: str) -> str:
+            return append_value + field_value
+
         def apply(event: Event) -> Event:
             field_value = event.get_attr_from_str(field_name)
-            return replace(event, **{field_name:append_value + field_value})
+            return replace(event, **{field_name:self.transform_cache.apply(index, transform, field_value)})
 
         self.apply_functions.append(apply)
+        self.action_specs.append(('prefix_str_to_field', Event._format_field_name(field_name), append_value))
         return self
 
     def append_str_to_field(self, field_name: str, append_value):
@@ -216,14 +396,20 @@ class Rule:
         Rule().append_str_to_field('title', ' - Doctor Appointment').on(Condition().field('title').contains('Mr. BOBO'))
         """
 
+        index = len(self.action_specs)
+
+        def transform(field_value: str) -> str:
+            return field_value + append_value
+
         def apply(event: Event) -> Event:
             field_value = event.get_attr_from_str(field_name)
-            return replace(event, **{field_name:field_value + append_value})
+            return replace(event, **{field_name:self.transform_cache.apply(index, transform, field_value)})
             # copy = replace(event)
             # copy.__setattr__(field_name, field_value + append_value)
             # return copy
 
         self.apply_functions.append(apply)
+        self.action_specs.append(('append_str_to_field', Event._format_field_name(field_name), append_value))
         return self
 
     def set_field_str(self, field_name: str, value: str):
@@ -239,6 +425,7 @@ class Rule:
             # return copy
 
         self.apply_functions.append(apply)
+        self.action_specs.append(('set_field_str', Event._format_field_name(field_name), value))
         return self
 
     def remove_event(self):
@@ -247,25 +434,95 @@ class Rule:
         """
 
         def apply(e: Event) -> None:
-            print(f'deleting event : {e.title}')
             return None
 
         self.apply_functions.append(apply)
+        self.action_specs.append(('remove_event',))
         return self
 
-    def apply_to_event(self, event: Event) -> Optional[Event]:
-        """Checks if all conditions evaluate to True with this event, and returns the event, eventually modified with
-        the current apply functions."""
+    @property
+    def spec(self) -> Optional[tuple]:
+        """Plain data description of the rule, or None if one of its conditions can't be described."""
+        if not self.conditions or any(condition.spec is None for condition in self.conditions):
+            return None
+        return ('rule', tuple(self.action_specs), tuple(condition.spec for condition in self.conditions))
 
+    def matches(self, event: Event) -> bool:
+        """Returns True if all the conditions of the rule evaluate to True with this event."""
         if not self.conditions:
             raise ValueError("No conditions provided.")
+        return all((condition.evaluate(event) for condition in self.conditions))
+
+    def apply_actions(self, event: Event) -> Optional[Event]:
+        """Applies the actions of the rule to the event, without checking the conditions."""
+        for func in self.apply_functions:
+            if event is None:
+                return None
+            event = func(event)
+        return event
+
+    def match_batch(self, events: Sequence[Event]) -> List[bool]:
+        """Returns the mask of the events verifying all the conditions. Each condition evaluates the whole column of
+        values of its field at once, and only on the events that passed the previous conditions."""
+        if not self.conditions:
+            raise ValueError("No conditions provided.")
+        return _evaluate_batch_short_circuit(self.conditions, events, False)
+
+    def apply_actions_to_batch(self, events: Sequence[Event]) -> List[Optional[Event]]:
+        """Applies the actions of the rule to all the events, without checking the conditions.
+        The actions are computed field by field, then each event is copied once with all its new values."""
+        if len(self.action_specs) != len(self.apply_functions):
+            return [self.apply_actions(event) for event in events]
+
+        changes = [{} for _ in events]
+        for index, spec in enumerate(self.action_specs):
+            action = spec[0]
+            if action == 'remove_event':
+                return [None] * len(events)
+            if action == 'change_color':
+                color = EventColor(spec[1])
+                for change in changes:
+                    change['color'] = color
+                continue
+
+            field_name, value = spec[1], spec[2]
+            if action == 'set_field_str':
+                for change in changes:
+                    change[field_name] = value
+                continue
+
+            column = [change[field_name] if field_name in change else getattr(event, field_name)
+                      for event, change in zip(events, changes)]
+            if action == 'prefix_str_to_field':
+                def transform(current: str, value=value) -> str:
+                    return value + current
+            else:
+                def transform(current: str, value=value) -> str:
+                    return current + value
+            new_column = [self.transform_cache.apply(index, transform, current) for current in column]
+            for change, new_value in zip(changes, new_column):
+                change[field_name] = new_value
+
+        return [replace(event, **change) for event, change in zip(events, changes)]
+
+    def apply_to_batch(self, events: Sequence[Event]) -> List[Optional[Event]]:
+        """Batch version of apply_to_event : returns the list of events, where the events matching the conditions
+        are modified by the actions (None if removed)."""
+        mask = self.match_batch(events)
+        results = list(events)
+        indices = [i for i, matched in enumerate(mask) if matched]
+        if not indices:
+            return results
+        for i, result in zip(indices, self.apply_actions_to_batch([events[i] for i in indices])):
+            results[i] = result
+        return results
+
+    def apply_to_event(self, event: Event) -> Optional[Event]:
+        """Checks if all conditions evaluate to True with this event, and returns the event, eventually modified with
+        the current apply functions."""
 
         event_copy = replace(event)
 
-        if all((condition.evaluate(event_copy) for condition in self.conditions)):
-            for func in self.apply_functions:
-                if event_copy is None:
-                    return None
-                event_copy = func(event_copy)
+        if self.matches(event_copy):
+            return self.apply_actions(event_copy)
         return event_copy
-
@@ -13,3 +13,16 @@ class UnkownRequestError(Exception):
 class CalendarNotAvailableError(Exception):
     """Raised when the server cannot provide the ics file.
     Example : The server is in maintenance."""
+
+
+class InvalidRuleFileError(Exception):
+    """Raised when a rule file can't be read or doesn't describe valid rules."""
+
+
+class MemoryDriftError(Exception):
+    """Raised by the soak test when the memory of the process keeps growing across sync cycles."""
+
+
+class CircuitOpenError(Exception):
+    """Raised when a host failed too many times in a row : it isn't requested for a while.
+    See src/source_calendar/fetch_scheduler.py"""
@@ -0,0 +1,160 @@
+"""In memory stand-in for the google calendar service, with the calls used by GoogleCalendarHandler."""
+import itertools
+import threading
+from collections import deque
+from datetime import datetime
+
+import httplib2
+import pytz
+from googleapiclient.errors import HttpError
+
+
+def _now() -> str:
+    return datetime.now(pytz.utc).isoformat()
+
+
+class FakeRequest:
+    def __init__(self, function):
+        self.function = function
+
+    def execute(self):
+        return self.function()
+
+
+class FakeBatch:
+    def __init__(self, service):
+        self.service = service
+        self.requests = []
+
+    def add(self, request, callback):
+        self.requests.append((request, callback))
+
+    def execute(self):
+        with self.service.lock:
+            if self.service.crash_after_batches is not None and self.service.batches >= self.service.crash_after_batches:
+                raise ConnectionAbortedError("the process died")
+            self.service.batches += 1
+            self.service.batch_sizes.append(len(self.requests))
+        for i, (request, callback) in enumerate(self.requests):
+            try:
+                self.service.maybe_throttle()
+                response = request.execute()
+            except Exception as e:
+                callback(str(i), None, e)
+            else:
+                callback(str(i), response, None)
+
+
+class FakeEvents:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, calendarId, timeMin=None, privateExtendedProperty=None, updatedMin=None, showDeleted=False,
+             **kwargs):
+        def run():
+            items = list(self.service.calendars.get(calendarId, {}).values())
+            if showDeleted:
+                items += self.service.deleted.get(calendarId, {}).values()
+            if updatedMin is not None:
+                items = [item for item in items if 'updated' in item and
+                         datetime.fromisoformat(item['updated']) >= datetime.fromisoformat(updatedMin)]
+            if privateExtendedProperty is not None:
+                key, value = privateExtendedProperty.split('=', 1)
+                items = [item for item in items
+                         if ((item.get('extendedProperties') or {}).get('private') or {}).get(key) == value]
+            if timeMin is not None:
+                items = [item for item in items if 'end' not in item or
+                         datetime.fromisoformat(item['end']['dateTime']) > datetime.fromisoformat(timeMin)]
+            # deleted events only keep their id
+            return {'items': [item for item in items if 'start' not in item] +
+                    sorted((item for item in items if 'start' in item),
+                           key=lambda item: datetime.fromisoformat(item['start']['dateTime']))}
+        return FakeRequest(run)
+
+    def list_next(self, request, response):
+        return None
+
+    def insert(self, calendarId, body):
+        def run():
+            with self.service.lock:
+                events = self.service.calendars.setdefault(calendarId, {})
+                if body.get('id') in events:
+                    raise HttpError(httplib2.Response({'status': 409}), b'{"error": {"message": "Duplicate"}}')
+                body_with_id = dict(body, id=body.get('id') or f'g{next(self.service.ids)}', updated=_now())
+                events[body_with_id['id']] = body_with_id
+                self.service.deleted.get(calendarId, {}).pop(body_with_id['id'], None)
+                return body_with_id
+        return FakeRequest(run)
+
+    def update(self, calendarId, eventId, body):
+        def run():
+            with self.service.lock:
+                events = self.service.calendars.get(calendarId, {})
+                if eventId not in events:
+                    raise KeyError(eventId)
+                events[eventId] = dict(body, id=eventId, updated=_now())
+                return events[eventId]
+        return FakeRequest(run)
+
+    def watch(self, calendarId, body):
+        def run():
+            with self.service.lock:
+                self.service.watched[body['id']] = (calendarId, body)
+            return {'id': body['id'], 'resourceId': f'resource-{calendarId}', 'expiration': '4102444800000'}
+        return FakeRequest(run)
+
+    def delete(self, calendarId, eventId):
+        def run():
+            with self.service.lock:
+                del self.service.calendars.get(calendarId, {})[eventId]
+                self.service.deleted.setdefault(calendarId, {})[eventId] = {'id': eventId, 'status': 'cancelled',
+                                                                            'updated': _now()}
+        return FakeRequest(run)
+
+
+class FakeChannels:
+    def __init__(self, service):
+        self.service = service
+
+    def stop(self, body):
+        def run():
+            with self.service.lock:
+                del self.service.watched[body['id']]
+        return FakeRequest(run)
+
+
+class FakeGoogleService:
+    """Calendars are dicts of event bodies by id."""
+
+    def __init__(self):
+        self.calendars = {}
+        self.deleted = {}  # deleted events by calendar, listed with showDeleted
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.batches = 0
+        # the last batch sizes only : the soak test sends thousands of batches
+        self.batch_sizes = deque(maxlen=100)
+        self.watched = {}
+        # batches sent before every batch fails, to simulate a crash in the middle of a run
+        self.crash_after_batches = None
+        self.throttled_requests = 0
+
+    def throttle(self, n: int):
+        """The next n requests sent in batches fail with a 429 error."""
+        self.throttled_requests = n
+
+    def maybe_throttle(self):
+        with self.lock:
+            if self.throttled_requests <= 0:
+                return
+            self.throttled_requests -= 1
+        raise HttpError(httplib2.Response({'status': 429}), b'{"error": {"message": "Rate Limit Exceeded"}}')
+
+    def events(self):
+        return FakeEvents(self)
+
+    def channels(self):
+        return FakeChannels(self)
+
+    def new_batch_http_request(self):
+        return FakeBatch(self)
@@ -1,101 +1,67 @@
-from dataclasses import dataclass
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import List
+from typing import List, Any, Tuple, Callable, Optional
 
 import pytz
 from googleapiclient.discovery import Resource
 
+from src.batch_controller import AdaptiveBatchController, BatchReport, is_throttling_error
 from src.event import Event
-from src.event_colors import EventColor
+from src.google_event_view import GoogleEventView, LISTED_FIELDS
 from src.util import group_elements_by
 
 
+@dataclass
+class BatchWriteResult:
+    """What google answered to a series of batched writes.
+    `done` holds the deleted ids, or the events returned by google for inserts and updates."""
+    done: List[Any] = field(default_factory=list)
+    failed: List[Tuple[Any, Exception]] = field(default_factory=list)
+
+
 @dataclass
 class GoogleCalendarHandler:
-    """Api for inserting, deleting events from a google calendar"""
+    """Api for inserting, deleting events from a google calendar
+
+    With a `batch_controller`, the size of the batches adapts to the latency and the errors of google (see
+    src/batch_controller.py). Batches are only sent concurrently with a `service_factory`, which must return a
+    service usable by the calling thread (e.g. `lambda: get_calendar_service(name)`)."""
     calendar_id: str
     service: Resource
     time_zone: str = "Europe/Paris"
+    batch_controller: Optional[AdaptiveBatchController] = None
+    service_factory: Optional[Callable[[], Resource]] = None
 
     BATCH_MAX_REQUEST_NUMBER = 50
 
+    # Number of times a throttled write is sent again
+    MAX_THROTTLED_ATTEMPTS = 3
+
     @staticmethod
     def _parseEvent(response: dict) -> Event:
         # {'kind': 'calendar#event', 'etag': '"3263102242854000"', 'id': 'mt972eo82fsqaschfh1nkacpes', 'status': 'confirmed', 'htmlLink': 'https://www.google.com/calendar/event?eid=bXQ5NzJlbzgyZnNxYXNjaGZoMW5rYWNwZXMgdnMyZWhlcWJvdWZ2ZzYza2Rla2Y1bXVpMG9AZw', 'created': '2021-09-13T16:38:41.000Z', 'updated': '2021-09-13T16:38:41.427Z', 'summary': 'HAX301X', 'description': 'L2 CUPGE\nL2 Maths\nDouble L2 Info Maths (portée par info)\nAlgèbre III Réduction des endomorphismes\nA valider\nBABENKO   IVAN\n(Exporté le:13/09/2021 18:38)', 'location': 'Amphi 5.02', 'colorId': '1', 'creator': {'email': 'supermuel66@gmail.com'}, 'organizer': {'email': 'vs2eheqboufvg63kdekf5mui0o@group.calendar.google.com', 'displayName': 'L2', 'self': True}, 'start': {'dateTime': '2021-12-09T08:00:00+01:00', 'timeZone': 'Europe/Paris'}, 'end': {'dateTime': '2021-12-09T09:30:00+01:00', 'timeZone': 'Europe/Paris'}, 'iCalUID': 'mt972eo82fsqaschfh1nkacpes@google.com', 'sequence': 0, 'reminders': {'useDefault': True}, 'eventType': 'default'}
 
-        # etag = response.get('etag', None)
-        # kind = response.get('kind', None)
-        # status = response.get('status', None)
-        id = response.get('id', None)
-        html_link = response.get('htmlLink', None)
-        created = response.get('created', None)
-        try:
-            created = datetime.fromisoformat(created)
-        except Exception as e:
-            # print(e, type(e).__name__)
-            created = None
-        updated = response.get('updated', None)
-        try:
-            updated = datetime.fromisoformat(updated)
-        except Exception:
-            updated = None
-        title = response.get('summary', None)
-        description = response.get('description', None)
-        location = response.get('location', None)
-        color_id = response.get('colorId', None)
-        color = None
-        if color_id is not None:
-            color = EventColor.from_color_id(color_id)
-
-        is_all_day=False
-        start_dict = response['start']
-        if start_dict is not None:
-            if 'dateTime' in start_dict:
-                start_dt = datetime.fromisoformat(start_dict['dateTime'])
-            elif 'date' in start_dict:
-                is_all_day = True
-                start_dt = datetime.strptime(start_dict['date'], '%Y-%m-%d')
-            else:
-                raise ValueError('Unknown date type')
-
-        end_dict = response['end']
-        if end_dict:
-            if 'dateTime' in end_dict:
-                end_dt = datetime.fromisoformat(end_dict['dateTime'])
-            elif 'date' in end_dict:
-                is_all_day = True
-                end_dt = datetime.strptime(end_dict['date'], '%Y-%m-%d')
-            else:
-                raise ValueError('Unknown date type')
-        
-
-
-        extended_properties = response.get('extendedProperties', {})
-
-        return Event(title=title,
-                     description=description,
-                     location=location,
-                     start=start_dt,
-                     end=end_dt,
-                     color=color,
-                     updated=updated,
-                     created=created,
-                     html_link=html_link,
-                     id=id,
-                     extended_properties = extended_properties,
-                     is_all_day=is_all_day,
-                     )
-
-    def get_events_since_date(self, date: datetime = None, limit: int = None) -> List[Event]:
+        return GoogleEventView(response).to_event()
+
+    def get_events_since_date(self, date: datetime = None, limit: int = None, kal_only: bool = False) -> List[Event]:
         """
         if the event has started but is not yet finished at date, it is included.
         if the event's end matches exactly the date, it is excluded.
 
         results are ordered by their start time. It's done on google servers, the method don't verify
         the order afterwards.
-        """
 
+        With `kal_only`, only the kal-signed events are returned : google filters them, and the other events are
+        skipped before being parsed anyway.
+        """
+        return [view.to_event() for view in self.list_event_views(date, limit, kal_only)]
 
+    def list_event_views(self, date: datetime = None, limit: int = None,
+                         kal_only: bool = False) -> List[GoogleEventView]:
+        """Same as `get_events_since_date`, but returns lazy views : fields are only parsed when read."""
         request = self.service.events().list(
             calendarId=self.calendar_id,
             timeMin=date.astimezone(pytz.utc).isoformat() if date else None,
@@ -105,18 +71,23 @@ class GoogleCalendarHandler:
             singleEvents=True,
             orderBy='startTime',
             maxResults=limit,
+            privateExtendedProperty='kal=true' if kal_only else None,
+            fields=LISTED_FIELDS,
         )
 
-        events_dicts = []
+        views = []
 
         while request is not None:
             response = request.execute()
 
-            events_dicts += response.get('items', [])
+            for item in response.get('items', []):
+                view = GoogleEventView(item)
+                if not kal_only or view.has_kal_signature:
+                    views.append(view)
 
             request = self.service.events().list_next(request, response)
 
-        return list(map(GoogleCalendarHandler._parseEvent, events_dicts))
+        return views
 
     def get_events(self, limit: int = None) -> List[Event]:
         return self.get_events_since_date(limit=limit)
@@ -131,14 +102,93 @@ class GoogleCalendarHandler:
         to_delete_ids = [event.id for event in events if event.start.astimezone(pytz.utc) > date.astimezone(pytz.utc)]
         self.delete_events(to_delete_ids)
 
-    def delete_events(self, events_ids: List[str]):
-        for event_ids_sublist in group_elements_by(GoogleCalendarHandler.BATCH_MAX_REQUEST_NUMBER, events_ids):
+    def _execute_in_batches(self, items: List[Any], make_request: Callable[[Resource, Any], Any],
+                            parse_response: Callable[[Any, Any], Any]) -> BatchWriteResult:
+        if self.batch_controller is not None:
+            return self._execute_in_adaptive_batches(items, make_request, parse_response)
+
+        result = BatchWriteResult()
+
+        def callback_for(item):
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    result.failed.append((item, exception))
+                else:
+                    result.done.append(parse_response(item, response))
+            return callback
+
+        for items_sublist in group_elements_by(GoogleCalendarHandler.BATCH_MAX_REQUEST_NUMBER, items):
+            if not items_sublist:
+                continue
             batch = self.service.new_batch_http_request()
-            for event_id in event_ids_sublist:
-                batch.add(self.service.events().delete(calendarId=self.calendar_id, eventId=event_id))
+            for item in items_sublist:
+                batch.add(make_request(self.service, item), callback=callback_for(item))
             batch.execute()
+        return result
+
+    def _send_batch(self, batch_items: List[Tuple[Any, int]], make_request: Callable[[Resource, Any], Any]) \
+            -> Tuple[List[Tuple[Any, int, Any, Optional[Exception]]], float]:
+        """Sends one batch of (item, attempt). Returns (item, attempt, response, exception) for each item, and the
+        latency of the batch."""
+        service = self.service_factory() if self.service_factory is not None else self.service
+        answers = []
+
+        def callback_for(item, attempt):
+            def callback(request_id, response, exception):
+                answers.append((item, attempt, response, exception))
+            return callback
+
+        batch = service.new_batch_http_request()
+        for item, attempt in batch_items:
+            batch.add(make_request(service, item), callback=callback_for(item, attempt))
+        start = time.perf_counter()
+        batch.execute()
+        return answers, time.perf_counter() - start
+
+    def _execute_in_adaptive_batches(self, items: List[Any], make_request: Callable[[Resource, Any], Any],
+                                     parse_response: Callable[[Any, Any], Any]) -> BatchWriteResult:
+        """Sends the items in batches sized by the controller, several at once if it allows it.
+        Throttled items are sent again in later batches, after the controller's back off."""
+        controller = self.batch_controller
+        max_concurrency = controller.max_concurrency if self.service_factory is not None else 1
+        result = BatchWriteResult()
+        pending = deque((item, 1) for item in items)
+        running = set()
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            while pending or running:
+                while pending and len(running) < min(controller.concurrency, max_concurrency):
+                    controller.wait_for_quota()
+                    batch = [pending.popleft() for _ in range(min(controller.batch_size, len(pending)))]
+                    running.add(executor.submit(self._send_batch, batch, make_request))
+
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    answers, latency = future.result()
+                    report = BatchReport(size=len(answers), latency=latency)
+                    for item, attempt, response, exception in answers:
+                        if exception is None:
+                            result.done.append(parse_response(item, response))
+                        elif is_throttling_error(exception):
+                            report.throttled += 1
+                            if attempt < GoogleCalendarHandler.MAX_THROTTLED_ATTEMPTS:
+                                pending.append((item, attempt + 1))
+                            else:
+                                result.failed.append((item, exception))
+                        else:
+                            report.errors += 1
+                            result.failed.append((item, exception))
+                    controller.record(report)
+        return result
+
+    def delete_events(self, events_ids: List[str]) -> BatchWriteResult:
+        return self._execute_in_batches(
+            events_ids,
+            lambda service, event_id: service.events().delete(calendarId=self.calendar_id, eventId=event_id),
+            lambda event_id, response: event_id,
+        )
 
-    def insert_events(self, events: List[Event]) :
+    def insert_events(self, events: List[Event]) -> BatchWriteResult:
         """extended_properties:
         { # Extended properties of the event.
         "private": { # Properties that are private to the copy of the event that appears on this calendar.
@@ -150,15 +200,26 @@ class GoogleCalendarHandler:
         to set for all the events
         """
 
+        return self._execute_in_batches(
+            events,
+            lambda service, event: service.events().insert(
+                calendarId=self.calendar_id,
+                body=GoogleCalendarHandler._event_to_body(event),
+            ),
+            lambda event, response: GoogleCalendarHandler._parseEvent(response),
+        )
 
-        for event_ids_sublist in group_elements_by(GoogleCalendarHandler.BATCH_MAX_REQUEST_NUMBER, events):
-            batch = self.service.new_batch_http_request()
-            for event in event_ids_sublist:
-                batch.add(self.service.events().insert(
-                    calendarId=self.calendar_id,
-                    body=GoogleCalendarHandler._event_to_body(event),
-                ))
-            batch.execute()
+    def update_events(self, events: List[Event]) -> BatchWriteResult:
+        """Replaces the google events having the same ids as `events` by their new content."""
+        return self._execute_in_batches(
+            events,
+            lambda service, event: service.events().update(
+                calendarId=self.calendar_id,
+                eventId=event.id,
+                body=GoogleCalendarHandler._event_to_body(event),
+            ),
+            lambda event, response: GoogleCalendarHandler._parseEvent(response),
+        )
 
     @staticmethod
     def _event_to_body(event: Event) -> dict:
@@ -177,6 +238,9 @@ class GoogleCalendarHandler:
 
         if event.color is not None:
             d['colorId'] = event.color.value
+        if event.id is not None:
+            # client supplied id on inserts, see src/sync_journal.py
+            d['id'] = event.id
         return d
 
     def insert_events_after_date(self, events: List[Event], date: datetime, extended_properties:dict= None):
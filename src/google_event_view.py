@@ -0,0 +1,115 @@
+"""Lazy view over an event returned by the google calendar api.
+
+Listing a shared calendar returns many events that kal ignores. The view only decodes a field when it is read, and
+`has_kal_signature` looks at the raw dict, so ignored events cost (almost) nothing.
+"""
+from datetime import datetime
+from functools import cached_property
+from typing import Optional, Tuple
+
+from src.event import Event
+from src.event_colors import EventColor
+
+# Fields of the events requested from google when listing a calendar (`fields` parameter of events.list)
+LISTED_FIELDS = 'nextPageToken,items(id,htmlLink,created,updated,summary,description,location,colorId,start,end,' \
+                'extendedProperties)'
+
+
+def _parse_optional_datetime(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value)
+    except Exception:
+        return None
+
+
+def _parse_time(time_dict: dict) -> Tuple[datetime, bool]:
+    """Returns the date of a start or end dict, and whether it is an all day date."""
+    if 'dateTime' in time_dict:
+        return datetime.fromisoformat(time_dict['dateTime']), False
+    if 'date' in time_dict:
+        return datetime.strptime(time_dict['date'], '%Y-%m-%d'), True
+    raise ValueError('Unknown date type')
+
+
+class GoogleEventView:
+    """Read only event backed by the response dict of google. Fields are decoded on first access."""
+
+    def __init__(self, response: dict):
+        self.response = response
+
+    @property
+    def has_kal_signature(self) -> bool:
+        private = (self.response.get('extendedProperties') or {}).get('private') or {}
+        return 'kal' in private
+
+    @property
+    def id(self) -> Optional[str]:
+        return self.response.get('id')
+
+    @property
+    def title(self) -> Optional[str]:
+        return self.response.get('summary')
+
+    @property
+    def description(self) -> Optional[str]:
+        return self.response.get('description')
+
+    @property
+    def location(self) -> Optional[str]:
+        return self.response.get('location')
+
+    @property
+    def html_link(self) -> Optional[str]:
+        return self.response.get('htmlLink')
+
+    @property
+    def extended_properties(self) -> dict:
+        return self.response.get('extendedProperties', {})
+
+    @cached_property
+    def created(self) -> Optional[datetime]:
+        return _parse_optional_datetime(self.response.get('created'))
+
+    @cached_property
+    def updated(self) -> Optional[datetime]:
+        return _parse_optional_datetime(self.response.get('updated'))
+
+    @cached_property
+    def color(self) -> Optional[EventColor]:
+        color_id = self.response.get('colorId')
+        return EventColor.from_color_id(color_id) if color_id is not None else None
+
+    @cached_property
+    def _start(self) -> Tuple[datetime, bool]:
+        return _parse_time(self.response['start'])
+
+    @cached_property
+    def _end(self) -> Tuple[datetime, bool]:
+        return _parse_time(self.response['end'])
+
+    @property
+    def start(self) -> datetime:
+        return self._start[0]
+
+    @property
+    def end(self) -> datetime:
+        return self._end[0]
+
+    @property
+    def is_all_day(self) -> bool:
+        return self._start[1] or self._end[1]
+
+    def to_event(self) -> Event:
+        return Event(title=self.title,
+                     description=self.description,
+                     location=self.location,
+                     start=self.start,
+                     end=self.end,
+                     color=self.color,
+                     updated=self.updated,
+                     created=self.created,
+                     html_link=self.html_link,
+                     id=self.id,
+                     extended_properties=self.extended_properties,
+                     is_all_day=self.is_all_day,
+                     )
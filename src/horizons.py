@@ -0,0 +1,113 @@
+"""Sync horizons : the events of the next days are synced first and on every run, the far future less often.
+
+The sync window is cut in tiers (by default the next 7 days, 7 to 60 days, and beyond). `KalWorker.run_tiered` syncs
+the due tiers nearest first, each one with its own plan. A tier is due when it wasn't synced for `refresh_interval`.
+A tier with `max_writes` only sends that many writes per run, the nearest events first : the rest waits for the next
+runs, and the tier stays due until it is fully synced. When the writes of a tier fail (e.g. the quota is exhausted),
+the farther tiers wait for the next run.
+
+The sync dates of the tiers are kept in a SQLite file, shared by the processes running the mirrors (see main.py).
+"""
+import os
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Tuple
+
+import pytz
+
+from src.util import STATE_DIRECTORY
+
+
+@dataclass(frozen=True)
+class HorizonTier:
+    """Events starting within `end` from now (and after the end of the previous tier). `end` is None for the last tier.
+    `refresh_interval` is the minimum time between two syncs of the tier : zero syncs it on every run."""
+    name: str
+    end: Optional[timedelta]
+    refresh_interval: timedelta = timedelta(0)
+    max_writes: Optional[int] = None
+
+
+DEFAULT_TIERS = [
+    HorizonTier('near', timedelta(days=7)),
+    HorizonTier('mid', timedelta(days=60), refresh_interval=timedelta(hours=6), max_writes=500),
+    HorizonTier('far', None, refresh_interval=timedelta(days=1), max_writes=200),
+]
+
+
+def tier_windows(tiers: List[HorizonTier], now: datetime) -> List[Tuple[HorizonTier, datetime, Optional[datetime]]]:
+    """Returns each tier with the dates its events start between : (tier, after, until)."""
+    windows = []
+    after = now
+    for tier in tiers:
+        until = now + tier.end if tier.end is not None else None
+        windows.append((tier, after, until))
+        after = until
+    return windows
+
+
+class HorizonScheduler:
+    """Decides which tiers of a google calendar are due, and remembers when each one was fully synced, in a SQLite file.
+
+    Ex:
+        scheduler = HorizonScheduler()
+        plans = worker.run_tiered(service, scheduler)
+    """
+
+    def __init__(self, tiers: List[HorizonTier] = None,
+                 path: str = os.path.join(STATE_DIRECTORY, 'horizons.sqlite')):
+        self.tiers = tiers if tiers is not None else DEFAULT_TIERS
+        if any(tier.end is None for tier in self.tiers[:-1]):
+            raise ValueError("Only the last tier can be unbounded")
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = self._connect()
+        try:
+            connection.execute('''CREATE TABLE IF NOT EXISTS tier_syncs (
+                calendar_id TEXT NOT NULL,
+                tier TEXT NOT NULL,
+                synced_at REAL NOT NULL,
+                PRIMARY KEY (calendar_id, tier)
+            )''')
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def synced_at(self, calendar_id: str) -> Dict[str, float]:
+        """When each tier of the calendar was last fully synced, in epoch seconds, by tier name."""
+        connection = self._connect()
+        try:
+            return dict(connection.execute('SELECT tier, synced_at FROM tier_syncs WHERE calendar_id = ?',
+                                           (calendar_id,)))
+        finally:
+            connection.close()
+
+    def due_tiers(self, calendar_id: str, now: datetime = None) -> List[HorizonTier]:
+        """The tiers to sync on this run, nearest first."""
+        now = now or datetime.now(pytz.utc)
+        synced_at = self.synced_at(calendar_id)
+        return [tier for tier in self.tiers
+                if tier.name not in synced_at or
+                now.timestamp() - synced_at[tier.name] >= tier.refresh_interval.total_seconds()]
+
+    def mark_synced(self, calendar_id: str, tier: HorizonTier, now: datetime = None):
+        now = now or datetime.now(pytz.utc)
+        connection = self._connect()
+        try:
+            # one row per tier : the tiers synced by the other processes are kept
+            connection.execute('INSERT OR REPLACE INTO tier_syncs (calendar_id, tier, synced_at) VALUES (?, ?, ?)',
+                               (calendar_id, tier.name, now.timestamp()))
+        finally:
+            connection.close()
+
+    def reset(self, calendar_id: str):
+        """Makes all the tiers of the calendar due."""
+        connection = self._connect()
+        try:
+            connection.execute('DELETE FROM tier_syncs WHERE calendar_id = ?', (calendar_id,))
+        finally:
+            connection.close()
@@ -0,0 +1,101 @@
+"""Overlap detection between events, with a sweep line over their UTC epochs.
+
+Two events overlap if each one starts strictly before the other ends. Sorting by start costs O(n log n), then the
+overlap mask is computed in a single pass, and the overlapping pairs in O(n log n + number of pairs).
+"""
+import heapq
+from dataclasses import dataclass
+from itertools import groupby
+from typing import List, Tuple, Sequence, Dict
+
+import pytz
+
+from src.event import Event
+
+
+def _epoch(date) -> float:
+    return date.astimezone(pytz.utc).timestamp()
+
+
+class IntervalIndex:
+    """Sorted index of the [start, end) intervals of events. Events must have a start and an end."""
+
+    def __init__(self, events: Sequence[Event]):
+        self.events = list(events)
+        self.starts = [_epoch(event.start) for event in self.events]
+        self.ends = [_epoch(event.end) for event in self.events]
+        # positions of the events, sorted by start then end
+        self.order = sorted(range(len(self.events)), key=lambda i: (self.starts[i], self.ends[i]))
+
+    def overlaps_mask(self) -> List[bool]:
+        """Returns, for each event, whether it overlaps at least one other event."""
+        mask = [False] * len(self.events)
+        groups = [list(group) for _, group in groupby(self.order, key=lambda i: self.starts[i])]
+        max_previous_end = float('-inf')
+
+        for n, group in enumerate(groups):
+            start = self.starts[group[0]]
+            next_start = self.starts[groups[n + 1][0]] if n + 1 < len(groups) else float('inf')
+
+            # events with the same start overlap each other if they both last
+            lasting = [i for i in group if self.ends[i] > start]
+            if len(lasting) > 1:
+                for i in lasting:
+                    mask[i] = True
+
+            for i in group:
+                if start < max_previous_end or next_start < self.ends[i]:
+                    mask[i] = True
+
+            max_previous_end = max(max_previous_end, max(self.ends[i] for i in group))
+        return mask
+
+    def overlapping_pairs(self) -> List[Tuple[int, int]]:
+        """Returns the positions (i, j), i < j, of all the pairs of overlapping events."""
+        pairs = []
+        active = []  # heap of (end, position) of the events started before the current one
+        for i in self.order:
+            while active and active[0][0] <= self.starts[i]:
+                heapq.heappop(active)
+            for _, j in active:
+                # zero length events can share a start with an active event without overlapping it
+                if self.starts[j] < self.ends[i]:
+                    pairs.append((min(i, j), max(i, j)))
+            heapq.heappush(active, (self.ends[i], i))
+        return pairs
+
+
+def duplicates_mask(events: Sequence[Event], fields: Sequence[str] = ('title',)) -> List[bool]:
+    """Returns, for each event, whether an event before it in the list has the same start, end and `fields`.
+    The first occurrence is not marked, so that removing the marked events keeps one copy of each."""
+    seen = set()
+    mask = []
+    for event in events:
+        key = (_epoch(event.start), _epoch(event.end)) + tuple(event.get_attr_from_str(f) for f in fields)
+        mask.append(key in seen)
+        seen.add(key)
+    return mask
+
+
+@dataclass
+class Conflict:
+    """Two overlapping events coming from different sources, e.g. two mirrors of the same google calendar."""
+    source_1: str
+    event_1: Event
+    source_2: str
+    event_2: Event
+
+
+def find_conflicts(events_by_source: Dict[str, List[Event]]) -> List[Conflict]:
+    """Returns all the pairs of overlapping events that come from different sources."""
+    sources = []
+    events = []
+    for source, source_events in events_by_source.items():
+        sources += [source] * len(source_events)
+        events += source_events
+
+    conflicts = []
+    for i, j in IntervalIndex(events).overlapping_pairs():
+        if sources[i] != sources[j]:
+            conflicts.append(Conflict(sources[i], events[i], sources[j], events[j]))
+    return conflicts
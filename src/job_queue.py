@@ -0,0 +1,237 @@
+"""Sync jobs shared between worker processes.
+
+A scheduler enqueues one job per mirror. Workers claim jobs with a lease that they renew with heartbeats while the
+sync runs. A job whose lease expires (the worker died) can be claimed again. A job is never claimed while another job
+of the same google calendar is running, so two workers never sync the same calendar at the same time.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Optional, Callable
+
+from src.util import STATE_DIRECTORY
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+@dataclass
+class Job:
+    id: int
+    mirror_title: str
+    calendar_id: str
+    payload: dict = field(default_factory=dict)
+    status: str = PENDING
+    attempts: int = 0
+    lease_owner: Optional[str] = None
+    lease_expires: Optional[float] = None  # epoch seconds
+    error: Optional[str] = None
+
+
+class JobQueue(ABC):
+
+    @abstractmethod
+    def enqueue(self, mirror_title: str, calendar_id: str, payload: dict = None) -> int:
+        """Adds a job and returns its id. If the mirror already has a pending job, its id is returned instead, and
+        `payload` is merged into its payload."""
+
+    @abstractmethod
+    def claim(self, worker_id: str, lease_seconds: float) -> Optional[Job]:
+        """Returns the oldest job that can run now, leased to `worker_id`, or None."""
+
+    @abstractmethod
+    def heartbeat(self, job: Job, lease_seconds: float) -> bool:
+        """Extends the lease of the job. Returns False if the worker lost it."""
+
+    @abstractmethod
+    def complete(self, job: Job):
+        pass
+
+    @abstractmethod
+    def fail(self, job: Job, error: str, retry: bool = True):
+        """Marks the job as failed, or pending again if `retry` and it has attempts left."""
+
+    @abstractmethod
+    def get(self, job_id: int) -> Optional[Job]:
+        pass
+
+
+class SQLiteJobQueue(JobQueue):
+    """Job queue in a SQLite file, shared by the processes that can open it."""
+
+    def __init__(self, path: str = f'{STATE_DIRECTORY}/jobs.sqlite', max_attempts: int = 3):
+        self.path = path
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = self._connect()
+        try:
+            connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                mirror_title TEXT NOT NULL,
+                calendar_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires REAL,
+                error TEXT,
+                enqueued_at REAL NOT NULL
+            )''')
+            connection.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, calendar_id)')
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None : transactions are explicit, so that a claim can lock the database (BEGIN IMMEDIATE)
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    @staticmethod
+    def _to_job(row: sqlite3.Row) -> Job:
+        return Job(id=row['id'], mirror_title=row['mirror_title'], calendar_id=row['calendar_id'],
+                   payload=json.loads(row['payload']), status=row['status'], attempts=row['attempts'],
+                   lease_owner=row['lease_owner'], lease_expires=row['lease_expires'], error=row['error'])
+
+    def enqueue(self, mirror_title: str, calendar_id: str, payload: dict = None) -> int:
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT id, payload FROM jobs WHERE mirror_title = ? AND status = ?',
+                                     (mirror_title, PENDING)).fetchone()
+            if row is not None:
+                job_id = row['id']
+                if payload:
+                    merged = dict(json.loads(row['payload']), **payload)
+                    connection.execute('UPDATE jobs SET payload = ? WHERE id = ?', (json.dumps(merged), job_id))
+            else:
+                job_id = connection.execute(
+                    'INSERT INTO jobs (mirror_title, calendar_id, payload, status, enqueued_at) VALUES (?, ?, ?, ?, ?)',
+                    (mirror_title, calendar_id, json.dumps(payload or {}), PENDING, time.time())).lastrowid
+            connection.execute('COMMIT')
+            return job_id
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+
+    def claim(self, worker_id: str, lease_seconds: float) -> Optional[Job]:
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            # a running job whose lease expired is claimable again, and no longer locks its calendar
+            row = connection.execute('''
+                SELECT * FROM jobs AS job
+                WHERE (job.status = ? OR (job.status = ? AND job.lease_expires < ?))
+                  AND NOT EXISTS (SELECT 1 FROM jobs AS other
+                                  WHERE other.calendar_id = job.calendar_id AND other.id != job.id
+                                    AND other.status = ? AND other.lease_expires >= ?)
+                ORDER BY job.enqueued_at, job.id
+                LIMIT 1''', (PENDING, RUNNING, now, RUNNING, now)).fetchone()
+            if row is None:
+                connection.execute('COMMIT')
+                return None
+            connection.execute('UPDATE jobs SET status = ?, lease_owner = ?, lease_expires = ?, attempts = attempts + 1 '
+                               'WHERE id = ?', (RUNNING, worker_id, now + lease_seconds, row['id']))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+        job = self._to_job(row)
+        job.status, job.lease_owner, job.lease_expires, job.attempts = \
+            RUNNING, worker_id, now + lease_seconds, job.attempts + 1
+        return job
+
+    def _update_leased(self, job: Job, sql: str, parameters: tuple) -> bool:
+        """Runs an update of the job only if `job.lease_owner` still holds its lease."""
+        connection = self._connect()
+        try:
+            cursor = connection.execute(sql + ' WHERE id = ? AND status = ? AND lease_owner = ?',
+                                        parameters + (job.id, RUNNING, job.lease_owner))
+            return cursor.rowcount == 1
+        finally:
+            connection.close()
+
+    def heartbeat(self, job: Job, lease_seconds: float) -> bool:
+        expires = time.time() + lease_seconds
+        if self._update_leased(job, 'UPDATE jobs SET lease_expires = ?', (expires,)):
+            job.lease_expires = expires
+            return True
+        return False
+
+    def complete(self, job: Job):
+        if self._update_leased(job, 'UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires = NULL', (DONE,)):
+            job.status = DONE
+
+    def fail(self, job: Job, error: str, retry: bool = True):
+        status = PENDING if retry and job.attempts < self.max_attempts else FAILED
+        if self._update_leased(job, 'UPDATE jobs SET status = ?, error = ?, lease_owner = NULL, lease_expires = NULL',
+                               (status, error)):
+            job.status = status
+            job.error = error
+
+    def get(self, job_id: int) -> Optional[Job]:
+        connection = self._connect()
+        try:
+            row = connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            return self._to_job(row) if row is not None else None
+        finally:
+            connection.close()
+
+
+class JobWorker:
+    """Claims jobs and runs them, renewing their lease in a background thread."""
+
+    def __init__(self, queue: JobQueue, worker_id: str, run_job: Callable[[Job], None],
+                 lease_seconds: float = 300):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.run_job = run_job
+        self.lease_seconds = lease_seconds
+
+    def run_once(self) -> Optional[Job]:
+        """Runs one job if one is available. Returns it, or None."""
+        job = self.queue.claim(self.worker_id, self.lease_seconds)
+        if job is None:
+            return None
+
+        finished = threading.Event()
+
+        def keep_lease():
+            while not finished.wait(self.lease_seconds / 3):
+                if not self.queue.heartbeat(job, self.lease_seconds):
+                    logging.warning(f"{self.worker_id} lost the lease of job {job.id} ({job.mirror_title})")
+                    return
+
+        heartbeat = threading.Thread(target=keep_lease, name=f'kal-heartbeat-{job.id}', daemon=True)
+        heartbeat.start()
+        try:
+            self.run_job(job)
+        except Exception as e:
+            logging.error(f"Job {job.id} ({job.mirror_title}) failed : {type(e).__name__} {e}")
+            self.queue.fail(job, f'{type(e).__name__}: {e}')
+        else:
+            self.queue.complete(job)
+        finally:
+            finished.set()
+            heartbeat.join()
+        return job
+
+    def run_forever(self, poll_interval: float = 5, stop: threading.Event = None):
+        """Runs the jobs as they come, until `stop` is set."""
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            if self.run_once() is None:
+                stop.wait(poll_interval)
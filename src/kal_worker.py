@@ -1,75 +1,485 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import replace
 from datetime import datetime
 from os import remove
-from typing import List
+from typing import List, Tuple, Optional, Union, Callable, Dict, Any
 from copy import deepcopy
 
 
 from src.cal_setup import get_calendar_service
 from src.event import Event
 from src.event_rules import Rule
+from src.dedup import deduplicate_events
 from src.source_calendar.events_repository import EventsRepository
-from src.google_calendar_handler import GoogleCalendarHandler
-from src.mirror import Mirror
+from src.google_calendar_handler import GoogleCalendarHandler, BatchWriteResult
+from src.batch_controller import AdaptiveBatchController
+from src.metrics import RunMetrics
+from src.memory import MemoryTracker, MemoryReport
+from src.profiling import StageProfiler
+from src.log_setup import RULE_DEBUG_SAMPLES
+from src.mirror import Mirror, FanOutMirror, MirrorTarget
+from src.rule_cache import RuleResultCache, rules_fingerprint
+from src.change_detection import SyncRecordStore, SyncRecord, sync_fingerprint, window_key
+from src.remote_snapshot import CalendarSnapshotStore, CalendarSnapshot
 import pytz
 import logging
 
-from src.source_calendar.ics_calendar_provider import NetworkEventsProvider
+from src.source_calendar.ics_calendar_provider import NetworkEventsProvider, CalendarProvider, StringEventsProvider, \
+    RawCalendar
+from src.sync_plan import SyncPlan, RuleOutcome, PlannedChange, compute_sync_plan, sync_key, INSERT, UPDATE, DELETE
+from src.sync_journal import SyncJournal, is_already_done
+from src.util import group_elements_by
+from src.pipeline import PipelinedRun, EVENTS_PER_CHUNK
+from src.horizons import HorizonScheduler, tier_windows
+from src.adaptive_polling import AdaptivePoller
+from src.watch import OwnWriteLog
 
 
 class KalWorker:
 
-    def __init__(self, source_ics_calendar_url : str, google_calendar_id: str,rules : List[Rule]):
+    def __init__(self, source_ics_calendar_url : Union[str, List[str]], google_calendar_id: str,rules : List[Rule],
+                 provider: Union[CalendarProvider, List[CalendarProvider]] = None, snapshot_store: CalendarSnapshotStore = None,
+                 rule_cache: RuleResultCache = None, dedup_key: Optional[Union[str, List[str]]] = None,
+                 merge_duplicate_descriptions: bool = False, first_rule_index: int = 0,
+                 batch_controller: AdaptiveBatchController = None, service_factory: Callable[[], object] = None,
+                 sync_record_store: SyncRecordStore = None, journal: SyncJournal = None,
+                 memory_tracker: MemoryTracker = None, poller: AdaptivePoller = None, profiler: StageProfiler = None,
+                 own_writes: OwnWriteLog = None):
+        """`source_ics_calendar_url` can be a list of urls : their events are fetched concurrently and merged, and each
+        event is tagged with its source.
+        `provider` replaces the network download of the urls, e.g. with a FileEventsProvider (or a list of them).
+        With a `snapshot_store`, the google calendar is only listed when its snapshot needs to be revalidated.
+        With a `rule_cache`, unchanged events reuse the results of the rules from the previous runs.
+        With a `dedup_key`, duplicate source events are removed before the rules (see `dedup.deduplicate_events`).
+        `first_rule_index` numbers the rules in attributions, when they continue the rules of a FanOutWorker.
+        With a `batch_controller`, the google batches are tuned at run time. They can be sent concurrently with a
+        `service_factory` returning a service for the calling thread (see `GoogleCalendarHandler`).
+        With a `sync_record_store`, a run ends right away when the source, the rules and the sync window didn't change
+        since the last successful sync (see src/change_detection.py).
+        With a `journal`, the writes are journaled and a run that died in the middle is resumed by the next one
+        (see src/sync_journal.py).
+        With a `memory_tracker`, the memory of each stage is measured, and the allocation sites growing between two
+        runs are reported in `memory_report` (see src/memory.py).
+        With a `poller`, the changes of the sources and of the google calendar are recorded to adapt the poll interval
+        of the mirror (see src/adaptive_polling.py). The sources are compared to the sync record if there is one,
+        otherwise they count as changed when the run had to write.
+        With a `profiler`, each stage is profiled (see src/profiling.py).
+        With `own_writes`, the written events are recorded, to tell the push notifications they cause from the edits
+        of other people (see src/watch.py).
+        The measures of the last run are in `metrics`."""
         self.source_ics_calendar_url = source_ics_calendar_url
         self.google_calendar_id = google_calendar_id
         self.rules = rules
+        self.provider = provider
+        self.snapshot_store = snapshot_store
+        self.rule_cache = rule_cache
+        self.dedup_key = dedup_key
+        self.merge_duplicate_descriptions = merge_duplicate_descriptions
+        self.first_rule_index = first_rule_index
+        self.batch_controller = batch_controller
+        self.service_factory = service_factory
+        self.sync_record_store = sync_record_store
+        self.journal = journal
+        self.memory_tracker = memory_tracker
+        self.poller = poller
+        self.profiler = profiler
+        self.own_writes = own_writes
+        self.metrics: Optional[RunMetrics] = None
+        self.memory_report: Optional[MemoryReport] = None
 
-    def run(self, service):
+    def run(self, service, separation_date: datetime = None,
+            prefix_outcomes: List[RuleOutcome] = None) -> Optional[SyncPlan]:
         """
-        - deletes all the events of the google_calendar starting from now, that have been created by Kal.
-          (User created events should not be deleted.)
+        - lists the events of the google calendar starting from now that have been created by Kal.
+          (User created events are never touched.)
         - fetches the source_calendar
         - parses all the events
         - apply the rules to the events
-        - upload all the new events to the google calendar
-        
+        - computes the plan : which kal events must be inserted, updated or deleted
+        - applies the plan to the google calendar
+
+        Returns the applied plan, or None if nothing changed since the last sync (see `sync_record_store`).
+        `prefix_outcomes` are the outcomes of rules already applied to the source, see `plan`.
         """
-        print(f"Running on google calendar : {self.google_calendar_id}, with {len(self.rules)}")
-        handler = GoogleCalendarHandler(calendar_id=self.google_calendar_id,
-                                        service=service)
+        logging.info(f"Running on google calendar : {self.google_calendar_id}, with {len(self.rules)} rules")
+        handler = self._make_handler(service)
+        self.metrics = RunMetrics(calendar_id=self.google_calendar_id, memory_tracker=self.memory_tracker,
+                                  profiler=self.profiler)
+
+        # Only events starting after this date are modified
+        if separation_date is None:
+            separation_date = datetime.now()
+
+        if self.journal is not None:
+            self._resume(handler)
+
+        record, providers = None, None
+        if prefix_outcomes is None:
+            unchanged, record, providers = self._detect_changes(separation_date)
+            if unchanged:
+                return None
+
+        with self.metrics.stage('list'):
+            snapshot, google_events = self._load_google_events(handler, separation_date)
+        source_events = None
+        if prefix_outcomes is None:
+            with self.metrics.stage('fetch'):
+                source_events = self.fetch_source_events(providers)
+        with self.metrics.stage('plan'):
+            plan = self.plan(google_events, separation_date, source_events=source_events,
+                             prefix_outcomes=prefix_outcomes)
+        with self.metrics.stage('write'):
+            deleted, updated, inserted = self.apply(plan, handler)
+        self._after_writes(snapshot, separation_date, deleted, updated, inserted, record)
+        return plan
+
+    def run_tiered(self, service, scheduler: HorizonScheduler) -> Dict[str, SyncPlan]:
+        """Same as `run`, but the due tiers of the sync window are synced one after the other, nearest first
+        (see src/horizons.py). The google calendar is listed and the source fetched once for all the tiers.
+        Returns the applied plans by tier name.
+        The tiers that aren't due are not synced : the sync record can't tell the calendar is up to date anymore."""
+        logging.info(f"Running tiers on google calendar : {self.google_calendar_id}, with {len(self.rules)} rules")
+        handler = self._make_handler(service)
+        self.metrics = RunMetrics(calendar_id=self.google_calendar_id, memory_tracker=self.memory_tracker,
+                                  profiler=self.profiler)
+        now = datetime.now()
+
+        if self.journal is not None:
+            self._resume(handler)
 
-        # Delete events after this date
+        tiers = scheduler.due_tiers(self.google_calendar_id, now)
+        if not tiers:
+            logging.info(f"No tier of {self.google_calendar_id} is due")
+            return {}
+
+        with self.metrics.stage('list'):
+            snapshot, google_events = self._load_google_events(handler, now)
+        with self.metrics.stage('fetch'):
+            source_events = self.fetch_source_events()
+
+        # the rules run once over all the tiers : overlaps and duplicates across two tiers are seen
+        windows = tier_windows(scheduler.tiers, now)
+        with self.metrics.stage('rules'):
+            outcomes = self.source_outcomes(now, source_events, windows[-1][2])
+            self._sign_outcomes(outcomes)
+        google_kal_events = [e for e in google_events if self._event_has_kal_signature(e)]
+
+        plans = {}
+        deleted, updated, inserted = BatchWriteResult(), BatchWriteResult(), BatchWriteResult()
+        for tier, after, until in windows:
+            if tier not in tiers:
+                continue
+            with self.metrics.stage(f'plan {tier.name}'):
+                plan = compute_sync_plan(self.google_calendar_id, google_kal_events,
+                                         outcomes_between(outcomes, after, until), after, until)
+            complete = tier.max_writes is None or len(plan.changes) <= tier.max_writes
+            if not complete:
+                logging.info(f"Tier {tier.name} of {self.google_calendar_id} needs {len(plan.changes)} writes : "
+                             f"sending the {tier.max_writes} nearest ones")
+                changes = sorted(plan.changes, key=lambda change: change.event.start.astimezone(pytz.utc))
+                plan = replace(plan, changes=changes[:tier.max_writes])
+            with self.metrics.stage(f'write {tier.name}'):
+                tier_results = self.apply(plan, handler)
+            for total, result in zip((deleted, updated, inserted), tier_results):
+                total.done += result.done
+                total.failed += result.failed
+            plans[tier.name] = plan
+            self.metrics.count(f'{tier.name} writes', len(plan.changes))
+            if any(result.failed for result in tier_results):
+                # the quota is probably exhausted : the farther tiers wait for the next run
+                logging.warning(f"Writes of tier {tier.name} failed : skipping the farther tiers")
+                break
+            if complete:
+                scheduler.mark_synced(self.google_calendar_id, tier, now)
+        self._after_writes(snapshot, now, deleted, updated, inserted)
+        return plans
+
+    def run_pipelined(self, service, events_per_chunk: int = EVENTS_PER_CHUNK) -> Optional[SyncPlan]:
+        """Same as `run`, but the download, the parsing, the rules and the google writes overlap (see src/pipeline.py).
+        The first events are written while the rest of the source is still downloading.
+        Duplicate descriptions can't be merged in a stream, the conditions on the other events (overlaps, duplicates)
+        would only see the events of their chunk, and a journal needs the whole plan before the first write :
+        with `merge_duplicate_descriptions`, such a condition or a `journal`, this is a `run`."""
+        needs_context = any(condition.needs_context for rule in self.rules for condition in (rule.conditions or []))
+        if self.merge_duplicate_descriptions or needs_context or self.journal is not None:
+            logging.warning("Duplicate descriptions are merged, rules need the other events or writes are journaled : "
+                            "running without pipeline")
+            return self.run(service)
+        logging.info(f"Running pipeline on google calendar : {self.google_calendar_id}, with {len(self.rules)} rules")
+        handler = self._make_handler(service)
+        self.metrics = RunMetrics(calendar_id=self.google_calendar_id, memory_tracker=self.memory_tracker,
+                                  profiler=self.profiler)
         separation_date = datetime.now()
 
-        google_events = handler.get_events_since_date(separation_date)
+        # with change detection, the sources are downloaded first, then parsed while they are written
+        unchanged, record, providers = self._detect_changes(separation_date)
+        if unchanged:
+            return None
+
+        loaded = {}
+
+        def list_google_events() -> List[Event]:
+            loaded['snapshot'], google_events = self._load_google_events(handler, separation_date)
+            return google_events
+
+        pipeline = PipelinedRun(self, handler, separation_date, events_per_chunk=events_per_chunk, providers=providers)
+        try:
+            with self.metrics.stage('pipeline'):
+                plan = pipeline.run(list_google_events)
+        except Exception:
+            # some writes may have been sent : the snapshot can't be trusted anymore
+            if self.snapshot_store is not None:
+                self.snapshot_store.invalidate(self.google_calendar_id)
+            if self.sync_record_store is not None:
+                self.sync_record_store.invalidate(self.google_calendar_id)
+            raise
+        logging.info(f"Applied plan on {plan.calendar_id}: {plan.summary()}")
+        self._after_writes(loaded['snapshot'], separation_date, pipeline.deleted, pipeline.updated, pipeline.inserted,
+                           record)
+        return plan
+
+    def _detect_changes(self, separation_date: datetime) \
+            -> Tuple[bool, Optional[SyncRecord], Optional[List[CalendarProvider]]]:
+        """Downloads the sources without parsing them, and compares the fingerprint of the sync with the last one.
+        Returns whether nothing changed, the record to save after this sync and providers of the downloaded sources.
+        Without a `sync_record_store`, returns (False, None, None)."""
+        if self.sync_record_store is None:
+            return False, None, None
+        with self.metrics.stage('change detection'):
+            previous = self.sync_record_store.load(self.google_calendar_id)
+            previous_sources = previous.sources if previous is not None else {}
+            providers = self._get_providers()
+
+            def download(provider: CalendarProvider) -> RawCalendar:
+                validators = previous_sources.get(provider.source_name, {})
+                return provider.download(validators.get('etag'), validators.get('last_modified'))
+
+            raws = self._map_providers(download, providers)
+            hashes = [previous_sources.get(provider.source_name, {}).get('hash') if raw.not_modified
+                      else raw.content_hash for provider, raw in zip(providers, raws)]
+            settings = {
+                'window': window_key(separation_date, self.sync_record_store.window_period),
+                'deduplicate': self.dedup_key,
+                'merge_duplicate_descriptions': self.merge_duplicate_descriptions,
+                'first_rule_index': self.first_rule_index,
+            }
+            fingerprint = sync_fingerprint(hashes, rules_fingerprint(self.rules), settings)
+            if self.poller is not None:
+                for provider, content_hash in zip(providers, hashes):
+                    changed = content_hash is None or \
+                        content_hash != previous_sources.get(provider.source_name, {}).get('hash')
+                    self.poller.observe_source(provider.source_name, changed)
+            if previous is not None and fingerprint is not None and fingerprint == previous.fingerprint:
+                logging.info(f"Nothing changed for {self.google_calendar_id} since the last sync")
+                self.metrics.count('skipped runs')
+                if self.poller is not None:
+                    self.poller.observe_calendar(self.google_calendar_id, False)
+                logging.info(self.metrics.summary())
+                return True, None, None
+
+            # something else changed : the sources that answered 304 are needed anyway
+            raws = [provider.download() if raw.not_modified else raw for provider, raw in zip(providers, raws)]
+        record = SyncRecord(calendar_id=self.google_calendar_id, fingerprint=fingerprint, sources={
+            provider.source_name: {'etag': raw.etag, 'last_modified': raw.last_modified, 'hash': raw.content_hash}
+            for provider, raw in zip(providers, raws)})
+        return False, record, [StringEventsProvider(raw.text, provider.source_name)
+                               for provider, raw in zip(providers, raws)]
+
+    def _make_handler(self, service) -> GoogleCalendarHandler:
+        return GoogleCalendarHandler(calendar_id=self.google_calendar_id, service=service,
+                                     batch_controller=self.batch_controller, service_factory=self.service_factory)
+
+    def _load_google_events(self, handler: GoogleCalendarHandler, separation_date: datetime) \
+            -> Tuple[CalendarSnapshot, List[Event]]:
+        """Returns the snapshot of the google calendar, listing the calendar if it isn't fresh, and its events."""
+        snapshot = self.snapshot_store.load_fresh(self.google_calendar_id) if self.snapshot_store else None
+        if snapshot is not None:
+            return snapshot, snapshot.events
+        listed_at = datetime.now(pytz.utc)
+        # user created events are never touched : they aren't even parsed
+        google_events = handler.get_events_since_date(separation_date, kal_only=True)
+        snapshot = CalendarSnapshot(calendar_id=self.google_calendar_id, validated_at=listed_at, events=google_events)
+        return snapshot, google_events
+
+    def _after_writes(self, snapshot: CalendarSnapshot, separation_date: datetime, deleted: BatchWriteResult,
+                      updated: BatchWriteResult, inserted: BatchWriteResult, record: SyncRecord = None):
+        for item, exception in deleted.failed + updated.failed + inserted.failed:
+            logging.warning(f"Write failed on {self.google_calendar_id} : {type(exception).__name__} {exception}")
+        self.metrics.count('deleted', len(deleted.done))
+        self.metrics.count('updated', len(updated.done))
+        self.metrics.count('inserted', len(inserted.done))
+        self.metrics.count('failed writes', len(deleted.failed) + len(updated.failed) + len(inserted.failed))
+        if self.batch_controller is not None:
+            self.metrics.settings.update(self.batch_controller.settings())
+        else:
+            self.metrics.settings['batch_size'] = GoogleCalendarHandler.BATCH_MAX_REQUEST_NUMBER
+        logging.info(self.metrics.summary())
+        if self.snapshot_store is not None:
+            if deleted.failed or updated.failed or inserted.failed:
+                # Someone else touched our events : list the calendar again on the next run
+                self.snapshot_store.invalidate(self.google_calendar_id)
+            else:
+                snapshot.apply_writes(deleted.done, updated.done, inserted.done)
+                snapshot.drop_events_ended_before(separation_date)
+                self.snapshot_store.save(snapshot)
+        if self.sync_record_store is not None:
+            if deleted.failed or updated.failed or inserted.failed or record is None or record.fingerprint is None:
+                self.sync_record_store.invalidate(self.google_calendar_id)
+            else:
+                self.sync_record_store.save(record)
+        if self.rule_cache is not None:
+            self.rule_cache.save()
+        if self.own_writes is not None and (deleted.done or updated.done or inserted.done):
+            self.own_writes.note(self.google_calendar_id, deleted.done, updated.done + inserted.done)
+        if self.poller is not None:
+            wrote = bool(deleted.done or updated.done or inserted.done)
+            self.poller.observe_calendar(self.google_calendar_id, wrote)
+            if self.sync_record_store is None:
+                for provider in self._get_providers():
+                    self.poller.observe_source(provider.source_name, wrote)
+        if self.memory_tracker is not None:
+            self.memory_report = self.memory_tracker.snapshot_run(self.google_calendar_id)
+
+    def plan(self, google_events: List[Event], separation_date: datetime = None,
+             source_events: List[Event] = None, prefix_outcomes: List[RuleOutcome] = None,
+             until: datetime = None) -> SyncPlan:
+        """Computes the changes a run would make, without touching google.
+
+        `google_events` are the current events of the google calendar, e.g. loaded from a snapshot with
+        `sync_plan.load_events`. `source_events` defaults to the events of the provider.
+        With `prefix_outcomes`, the source isn't fetched : the rules of this worker continue from these outcomes.
+        With `until`, only the events starting between `separation_date` and `until` are synced."""
+        if separation_date is None:
+            separation_date = datetime.now()
 
         google_kal_events = [e for e in google_events if self._event_has_kal_signature(e)]
 
-        handler.delete_events_after_date(google_kal_events, separation_date)
+        if prefix_outcomes is not None:
+            outcomes = continue_rules(prefix_outcomes, self.rules, self.first_rule_index)
+        else:
+            outcomes = self.source_outcomes(separation_date, source_events, until)
+        self._sign_outcomes(outcomes)
+        return compute_sync_plan(self.google_calendar_id, google_kal_events, outcomes, separation_date, until)
+
+    def source_outcomes(self, separation_date: datetime, source_events: List[Event] = None,
+                        until: datetime = None) -> List[RuleOutcome]:
+        """Fetches the source (unless `source_events` are given), keeps the events starting after `separation_date`
+        (and not after `until`), removes the duplicates and applies the rules."""
+        if source_events is None:
+            source_events = self.fetch_source_events()
+
+        separation_utc = separation_date.astimezone(pytz.utc)
+        until_utc = until.astimezone(pytz.utc) if until is not None else None
+        new_events = [event for event in source_events if event.start.astimezone(pytz.utc) > separation_utc and
+                      (until_utc is None or event.start.astimezone(pytz.utc) <= until_utc)]
+        if self.dedup_key is not None:
+            count = len(new_events)
+            new_events = deduplicate_events(new_events, self.dedup_key, self.merge_duplicate_descriptions)
+            logging.info(f"Removed {count - len(new_events)} duplicate events")
+
+        return apply_rules_with_attribution(new_events, self.rules, self.rule_cache, self.first_rule_index)
+
+    def signed_outcomes(self, events: List[Event]) -> List[RuleOutcome]:
+        """Applies the rules to events already filtered and deduplicated, and signs the results."""
+        outcomes = apply_rules_with_attribution(events, self.rules, self.rule_cache, self.first_rule_index)
+        self._sign_outcomes(outcomes)
+        return outcomes
 
-        print(f"Deleted {len(google_kal_events)} events after {separation_date}")
+    def _sign_outcomes(self, outcomes: List[RuleOutcome]):
+        for outcome in outcomes:
+            if outcome.result is not None:
+                outcome.result = self._add_kal_signature(outcome.result, sync_key(outcome.source))
 
+    def apply(self, plan: SyncPlan, handler: GoogleCalendarHandler) \
+            -> Tuple[BatchWriteResult, BatchWriteResult, BatchWriteResult]:
+        """Applies the plan to the google calendar. Returns the results of the deletes, updates and inserts."""
+        if self.journal is not None:
+            plan = self.journal.begin(plan)
+            results = self._apply_journaled(plan.changes, handler)
+            self.journal.finish(plan.calendar_id)
+            logging.info(f"Applied plan on {plan.calendar_id}: {plan.summary()}")
+            return results
 
-        provider = NetworkEventsProvider(calendar_url=self.source_ics_calendar_url)
-        repo = EventsRepository(provider)
-        fresh_events = list(repo.get_events())
+        deleted = handler.delete_events([change.event.id for change in plan.deletes])
+        updated = handler.update_events([change.event for change in plan.updates])
+        inserted = handler.insert_events([change.event for change in plan.inserts])
+        logging.info(f"Applied plan on {plan.calendar_id}: {plan.summary()}")
+        return deleted, updated, inserted
 
-        new_events = [event for event in fresh_events if
-                      event.start.astimezone(pytz.utc) > separation_date.astimezone(pytz.utc)]
+    def _apply_journaled(self, changes: List[PlannedChange], handler: GoogleCalendarHandler) \
+            -> Tuple[BatchWriteResult, BatchWriteResult, BatchWriteResult]:
+        """Applies the changes batch by batch, acknowledging each batch in the journal.
+        Writes that a previous attempt already did count as done."""
+        results = {DELETE: BatchWriteResult(), UPDATE: BatchWriteResult(), INSERT: BatchWriteResult()}
+        writers = {
+            DELETE: lambda batch: handler.delete_events([change.event.id for change in batch]),
+            UPDATE: lambda batch: handler.update_events([change.event for change in batch]),
+            INSERT: lambda batch: handler.insert_events([change.event for change in batch]),
+        }
+        for action in (DELETE, UPDATE, INSERT):
+            action_changes = [change for change in changes if change.action == action]
+            for batch in group_elements_by(GoogleCalendarHandler.BATCH_MAX_REQUEST_NUMBER, action_changes):
+                if not batch:
+                    continue
+                result = writers[action](batch)
+                results[action].done += result.done
+                for item, exception in result.failed:
+                    if is_already_done(action, exception):
+                        results[action].done.append(item)
+                    else:
+                        results[action].failed.append((item, exception))
+                self.journal.acknowledge(handler.calendar_id, [change.event.id for change in batch])
+        return results[DELETE], results[UPDATE], results[INSERT]
 
+    def _resume(self, handler: GoogleCalendarHandler):
+        """Finishes the journaled sync of the calendar if the previous run died during its writes."""
+        pending = self.journal.pending(self.google_calendar_id)
+        if pending is None:
+            return
+        remaining = pending.remaining_changes()
+        logging.warning(f"Resuming the interrupted sync of {self.google_calendar_id} : {len(remaining)} writes left")
+        with self.metrics.stage('resume'):
+            self._apply_journaled(remaining, handler)
+        self.journal.finish(self.google_calendar_id)
+        self.metrics.count('resumed writes', len(remaining))
+        # the writes of the dead run are not in the snapshot or the sync record
+        if self.snapshot_store is not None:
+            self.snapshot_store.invalidate(self.google_calendar_id)
+        if self.sync_record_store is not None:
+            self.sync_record_store.invalidate(self.google_calendar_id)
 
-        events_after_rules = get_events_after_applying_rules(new_events, self.rules)
+    def _get_providers(self) -> List[CalendarProvider]:
+        if self.provider is not None:
+            return self.provider if isinstance(self.provider, list) else [self.provider]
+        urls = self.source_ics_calendar_url
+        if isinstance(urls, str):
+            urls = [urls]
+        return [NetworkEventsProvider(calendar_url=url) for url in urls]
 
-        new_events_with_kal_signature = list(map(self._add_kal_signature, events_after_rules))
+    def fetch_source_events(self, providers: List[CalendarProvider] = None) -> List[Event]:
+        """Downloads and parses all the sources concurrently, and returns their events in the order of the sources.
+        `providers` defaults to the providers of the worker."""
+        if providers is None:
+            providers = self._get_providers()
 
-        handler.insert_events(new_events_with_kal_signature)
-        print(f"Added: {len(events_after_rules)} events")
+        def fetch(provider: CalendarProvider) -> List[Event]:
+            return list(EventsRepository(provider, source=provider.source_name).get_events())
 
+        return [event for events in self._map_providers(fetch, providers) for event in events]
 
-    def _add_kal_signature(self, event:Event)-> Event:
+    @staticmethod
+    def _map_providers(function: Callable[[CalendarProvider], Any], providers: List[CalendarProvider]) -> List[Any]:
+        """Calls `function` on each provider, concurrently if there are several."""
+        if len(providers) == 1:
+            return [function(providers[0])]
+        with ThreadPoolExecutor(max_workers=len(providers)) as executor:
+            return list(executor.map(function, providers))
+
+    def _add_kal_signature(self, event:Event, key: str = None)-> Event:
         """Ads a kal signature to event.
         A kal signature is a private property (https://developers.google.com/calendar/api/guides/extended-properties)
         indicating that this event has been created by the Kal service. 
+        It also holds the sync key of the source event, used to match the event with its source on the next runs.
         """
         properties = deepcopy(event.extended_properties)
         if properties is None:
@@ -78,6 +488,10 @@ class KalWorker:
             properties['private'] = {'kal': 'true'}
         else:
             properties['private']['kal'] = 'true'
+        if key is not None:
+            properties['private']['kal_key'] = key
+        if event.source is not None:
+            properties['private']['kal_source'] = event.source
         return replace(event, extended_properties=properties)
 
     def _event_has_kal_signature(self, event: Event)-> bool:
@@ -92,19 +506,136 @@ class KalWorker:
         return 'kal' in private
 
 
+class FanOutWorker:
+    """Runs a FanOutMirror : the source is fetched, parsed, deduplicated and goes through the common rules once,
+    then the targets continue from these shared outcomes concurrently, each one with its own rules and calendar."""
 
-def get_events_after_applying_rules(events:List[Event], rules: List[Rule]) -> List[Event]:
-    """Applys all the rules provided to all the events. If an event becomes None after a rule, it won't be included in the returned list"""
-    new_events: List[Event]
-    new_events = []
-    for e in events:
-        for rule in rules:
-            if e is None:
-                break
-            e = rule.apply_to_event(e)
-        if e is not None:
-            new_events.append(e)
-    return new_events
+    def __init__(self, mirror: FanOutMirror, provider: Union[CalendarProvider, List[CalendarProvider]] = None,
+                 snapshot_store: CalendarSnapshotStore = None, rule_cache: RuleResultCache = None,
+                 batch_controller: AdaptiveBatchController = None):
+        self.mirror = mirror
+        self.source_worker = KalWorker(source_ics_calendar_url=mirror.source_ics_calendar_url,
+                                       google_calendar_id=None, rules=mirror.common_rules, provider=provider,
+                                       rule_cache=rule_cache, dedup_key=mirror.deduplicate,
+                                       merge_duplicate_descriptions=mirror.merge_duplicate_descriptions)
+        self.target_workers = {target.title: KalWorker(source_ics_calendar_url=mirror.source_ics_calendar_url,
+                                                       google_calendar_id=target.google_calendar_id,
+                                                       rules=target.rules, snapshot_store=snapshot_store,
+                                                       batch_controller=batch_controller,
+                                                       first_rule_index=len(mirror.common_rules))
+                               for target in mirror.targets}
+        self.rule_cache = rule_cache
+
+    def run(self, get_service: Callable[[MirrorTarget], object]) -> Dict[str, SyncPlan]:
+        """Runs all the targets, `get_service(target)` returning the google service of a target.
+        Returns the applied plans by target title. A failing target doesn't stop the others."""
+        separation_date = datetime.now()
+        outcomes = self.source_worker.source_outcomes(separation_date)
+        if self.rule_cache is not None:
+            self.rule_cache.save()
+
+        def run_target(target: MirrorTarget) -> SyncPlan:
+            worker = self.target_workers[target.title]
+            worker.service_factory = lambda: get_service(target)
+            return worker.run(get_service(target), separation_date, prefix_outcomes=outcomes)
+
+        plans = {}
+        with ThreadPoolExecutor(max_workers=max(len(self.mirror.targets), 1)) as executor:
+            futures = {target.title: executor.submit(run_target, target) for target in self.mirror.targets}
+            for title, future in futures.items():
+                try:
+                    plans[title] = future.result()
+                except Exception as e:
+                    logging.error(f"Fan-out target {title} of {self.mirror.title} failed : {type(e).__name__} {e}")
+        return plans
+
+    def plan(self, google_events_by_target: Dict[str, List[Event]] = None,
+             source_events: List[Event] = None) -> Dict[str, SyncPlan]:
+        """Dry run of all the targets. The google calendars are read from `google_events_by_target`, or considered
+        empty."""
+        separation_date = datetime.now()
+        outcomes = self.source_worker.source_outcomes(separation_date, source_events)
+        google_events_by_target = google_events_by_target or {}
+        return {title: worker.plan(google_events_by_target.get(title, []), separation_date, prefix_outcomes=outcomes)
+                for title, worker in self.target_workers.items()}
 
 
+def rule_label(rule: Rule, index: int) -> str:
+    return rule.name if rule.name else f'rule #{index}'
 
+
+def apply_rules_with_attribution(events: List[Event], rules: List[Rule],
+                                 cache: RuleResultCache = None, first_rule_index: int = 0) -> List[RuleOutcome]:
+    """Applies the rules like `get_events_after_applying_rules`, and also records which rules matched each event.
+    With a `cache`, events already seen with the same rules reuse their previous outcome.
+    `first_rule_index` numbers the rules in the attributions ; the cache is only used from the first rule."""
+    memo = cache.bind(rules) if cache is not None and first_rule_index == 0 else None
+    outcomes = []
+    pending = []
+    for event in events:
+        outcome = memo.get(event) if memo is not None else None
+        if outcome is None:
+            outcome = RuleOutcome(source=event, result=event)
+            pending.append(outcome)
+        outcomes.append(outcome)
+
+    _apply_rules_to_outcomes(pending, rules, first_rule_index)
+
+    if memo is not None:
+        for outcome in outcomes:
+            memo.put(outcome)
+    return outcomes
+
+
+def outcomes_between(outcomes: List[RuleOutcome], after: datetime, until: datetime = None) -> List[RuleOutcome]:
+    """Returns the outcomes whose source event starts after `after`, and not after `until`."""
+    after_utc = after.astimezone(pytz.utc)
+    until_utc = until.astimezone(pytz.utc) if until is not None else None
+    return [outcome for outcome in outcomes if outcome.source.start.astimezone(pytz.utc) > after_utc and
+            (until_utc is None or outcome.source.start.astimezone(pytz.utc) <= until_utc)]
+
+
+def continue_rules(outcomes: List[RuleOutcome], rules: List[Rule], first_rule_index: int = 0) -> List[RuleOutcome]:
+    """Applies more rules to the outcomes of previous rules, without modifying them (they can be shared)."""
+    copies = [RuleOutcome(source=outcome.source, result=outcome.result, rules=list(outcome.rules))
+              for outcome in outcomes]
+    _apply_rules_to_outcomes(copies, rules, first_rule_index)
+    return copies
+
+
+def _apply_rules_to_outcomes(outcomes: List[RuleOutcome], rules: List[Rule], first_rule_index: int = 0):
+    """Applies the rules in place, rule by rule on the whole list (see `Rule.apply_to_batch`).
+    Logs one summary line, and a few matched events of each rule at debug level."""
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    count = len(outcomes)
+    summary = []
+    for i, rule in enumerate(rules, start=first_rule_index):
+        outcomes = [outcome for outcome in outcomes if outcome.result is not None]
+        if not outcomes:
+            break
+        mask = rule.match_batch([outcome.result for outcome in outcomes])
+        matching = [outcome for outcome, matched in zip(outcomes, mask) if matched]
+        if not matching:
+            continue
+        label = rule_label(rule, i)
+        removed = 0
+        for outcome, result in zip(matching, rule.apply_actions_to_batch([outcome.result for outcome in matching])):
+            outcome.result = result
+            outcome.rules.append(label)
+            removed += result is None
+        summary.append(f"{label} matched {len(matching)}" + (f" (removed {removed})" if removed else ""))
+        if debug:
+            for outcome in matching[:RULE_DEBUG_SAMPLES]:
+                result = outcome.result.title if outcome.result is not None else 'removed'
+                logging.debug(f"{label} : '{outcome.source.title}' -> {result}")
+    if count:
+        logging.info(f"Rules applied to {count} events : {'; '.join(summary) or 'no match'}")
+
+
+def get_events_after_applying_rules(events:List[Event], rules: List[Rule]) -> List[Event]:
+    """Applys all the rules provided to all the events. If an event becomes None after a rule, it won't be included in the returned list.
+    Each rule is applied to the whole list at once (see `Rule.apply_to_batch`)."""
+    new_events = list(events)
+    for rule in rules:
+        new_events = [e for e in rule.apply_to_batch(new_events) if e is not None]
+    return new_events
@@ -0,0 +1,51 @@
+"""Logging that never blocks the sync : records are put in a queue, and written to the file and the console by a
+background thread (QueueHandler / QueueListener)."""
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+# Events logged at debug level for each rule, instead of one line per matched event
+RULE_DEBUG_SAMPLES = 3
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(threadName)s %(message)s'
+
+
+class LogListener(QueueListener):
+    """A QueueListener that can be stopped more than once : by its owner, then when the program exits."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.running = False
+
+    def start(self):
+        super().start()
+        self.running = True
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            super().stop()
+
+
+def setup_logging(path: str = 'log.log', level: int = logging.INFO, console: bool = True) -> LogListener:
+    """Replaces the handlers of the root logger by a queue, emptied by a listener thread into `path` and the console.
+    The listener is stopped (and the queue flushed) when the program exits."""
+    log_queue = queue.SimpleQueue()  # unbounded : putting a record never waits
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.FileHandler(path, encoding='utf-8')]
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener = LogListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
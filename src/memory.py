@@ -0,0 +1,165 @@
+"""Opt-in memory accounting of the runs, to catch leaks in a long running worker.
+
+With a `MemoryTracker`, the stages of a run (see src/metrics.py) record the peak of the memory allocated by python
+during the stage, and the peak RSS of the process during the stage, sampled by a background thread. After each run of a mirror, a tracemalloc snapshot is
+taken and compared to the one of its previous run : the allocation sites that grew the most are reported.
+
+tracemalloc slows python down and its measures are process wide : use it to investigate, not in production.
+"""
+import logging
+import os
+import threading
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+# Frames of tracemalloc itself, and of the imports, are not allocation sites of kal
+IGNORED_FILES = (tracemalloc.__file__, '<frozen importlib._bootstrap>', '<frozen importlib._bootstrap_external>')
+
+
+def current_rss() -> Optional[int]:
+    """Resident memory of the process in bytes, or None if it can't be read (only on linux)."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RssSampler:
+    """Reads the RSS of the process every `interval` seconds from a background thread, and keeps the highest one."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='kal-rss-sampler', daemon=True)
+
+    def _sample(self):
+        rss = current_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        if self.peak is not None:  # no thread where the RSS can't be read
+            self._thread.start()
+
+    def stop(self) -> Optional[int]:
+        """Stops sampling. Returns the highest RSS seen, in bytes."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._sample()
+        return self.peak
+
+
+def format_bytes(n: Optional[int]) -> str:
+    if n is None:
+        return '?'
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(n) < 1024:
+            return f'{n:.0f}{unit}' if unit == 'B' else f'{n:.1f}{unit}'
+        n /= 1024
+    return f'{n:.1f}GiB'
+
+
+@dataclass
+class StageMemory:
+    traced_peak: int  # highest memory allocated by python during the stage, in bytes
+    traced_end: int  # memory allocated by python at the end of the stage
+    peak_rss: Optional[int]  # highest RSS of the process during the stage, sampled every `rss_interval` seconds
+
+    def to_dict(self) -> dict:
+        return {'traced_peak': self.traced_peak, 'traced_end': self.traced_end, 'peak_rss': self.peak_rss}
+
+
+@dataclass
+class AllocationSite:
+    location: str  # file:line
+    size: int  # bytes allocated there
+    size_diff: int  # growth since the previous run of the mirror
+    count: int
+
+
+@dataclass
+class MemoryReport:
+    """Memory of one run of a mirror."""
+    label: str
+    traced: int
+    rss: Optional[int]
+    top: List[AllocationSite] = field(default_factory=list)
+
+    def summary(self) -> str:
+        sites = '; '.join(f'{site.location} {format_bytes(site.size)} ({format_bytes(site.size_diff)})'
+                          for site in self.top)
+        return f"Memory of {self.label} : traced {format_bytes(self.traced)}, rss {format_bytes(self.rss)} | " \
+               f"top sites (growth) : {sites}"
+
+
+class MemoryTracker:
+    """Takes the memory measures of the runs. Starts tracemalloc if it isn't tracing yet.
+
+    Ex:
+        worker = KalWorker(..., memory_tracker=MemoryTracker())
+        worker.run(service)
+        worker.metrics.memory  # measures of each stage
+        worker.memory_report.top  # allocation sites that grew the most since the previous run
+    """
+
+    def __init__(self, top: int = 10, frames: int = 1, rss_interval: float = 0.005):
+        """`top` is the number of allocation sites reported, `frames` the depth of the tracebacks kept by tracemalloc,
+        `rss_interval` the seconds between two reads of the RSS during a stage."""
+        self.top = top
+        self.rss_interval = rss_interval
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self._snapshots: Dict[str, tracemalloc.Snapshot] = {}
+        self._samplers: Dict[str, RssSampler] = {}
+        self._lock = threading.Lock()
+
+    def start_stage(self, name: str):
+        tracemalloc.reset_peak()
+        sampler = RssSampler(self.rss_interval)
+        with self._lock:
+            self._samplers[name] = sampler
+        sampler.start()
+
+    def end_stage(self, name: str) -> StageMemory:
+        traced_end, traced_peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            sampler = self._samplers.pop(name, None)
+        return StageMemory(traced_peak=traced_peak, traced_end=traced_end,
+                           peak_rss=sampler.stop() if sampler is not None else None)
+
+    def _take_snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, filename) for filename in IGNORED_FILES])
+
+    def snapshot_run(self, label: str) -> MemoryReport:
+        """Snapshots the memory after a run of the mirror `label`, and compares it to its previous run.
+        Only the last snapshot of each label is kept."""
+        snapshot = self._take_snapshot()
+        with self._lock:
+            previous = self._snapshots.get(label)
+            self._snapshots[label] = snapshot
+        if previous is None:
+            stats = snapshot.statistics('lineno')
+            top = [AllocationSite(str(stat.traceback[0]), stat.size, stat.size, stat.count)
+                   for stat in stats[:self.top]]
+        else:
+            stats = snapshot.compare_to(previous, 'lineno')
+            top = [AllocationSite(str(stat.traceback[0]), stat.size, stat.size_diff, stat.count)
+                   for stat in stats[:self.top]]
+        report = MemoryReport(label=label, traced=tracemalloc.get_traced_memory()[0], rss=current_rss(), top=top)
+        logging.info(report.summary())
+        return report
+
+    def stop(self):
+        """Stops tracemalloc and forgets the snapshots."""
+        with self._lock:
+            self._snapshots.clear()
+        tracemalloc.stop()
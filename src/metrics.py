@@ -0,0 +1,70 @@
+"""Measures of a run : time spent in each stage, counters and the settings chosen at run time."""
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Dict, Any, Optional
+
+from src.memory import MemoryTracker, StageMemory, format_bytes
+from src.profiling import StageProfiler
+
+
+@dataclass
+class RunMetrics:
+    calendar_id: str
+    stages: Dict[str, float] = field(default_factory=dict)  # seconds spent in each stage
+    counters: Dict[str, int] = field(default_factory=dict)
+    settings: Dict[str, Any] = field(default_factory=dict)
+    memory: Dict[str, StageMemory] = field(default_factory=dict)  # measures of each stage, with a memory_tracker
+    memory_tracker: Optional[MemoryTracker] = field(default=None, repr=False, compare=False)
+    profiler: Optional[StageProfiler] = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        self._lock = Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Adds the time spent in the block to the stage.
+        Ex:
+            with metrics.stage('plan'):
+                plan = worker.plan(google_events)
+        """
+        start = time.perf_counter()
+        if self.memory_tracker is not None:
+            self.memory_tracker.start_stage(name)
+        if self.profiler is not None:
+            self.profiler.start_stage(name)
+        try:
+            yield
+        finally:
+            if self.profiler is not None:
+                self.profiler.end_stage(name)
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0) + elapsed
+                if self.memory_tracker is not None:
+                    self.memory[name] = self.memory_tracker.end_stage(name)
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self) -> dict:
+        return {
+            'calendar_id': self.calendar_id,
+            'stages': dict(self.stages),
+            'counters': dict(self.counters),
+            'settings': dict(self.settings),
+            'memory': {name: stage.to_dict() for name, stage in self.memory.items()},
+        }
+
+    def summary(self) -> str:
+        stages = ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.stages.items())
+        counters = ', '.join(f'{name} {n}' for name, n in self.counters.items())
+        settings = ', '.join(f'{name} {value}' for name, value in self.settings.items())
+        summary = f"Metrics of {self.calendar_id} : {stages} | {counters} | {settings}"
+        if self.memory:
+            memory = ', '.join(f'{name} peak {format_bytes(stage.traced_peak)} rss {format_bytes(stage.peak_rss)}'
+                               for name, stage in self.memory.items())
+            summary += f" | {memory}"
+        return summary
@@ -1,15 +1,55 @@
-from typing import List
+from typing import List, Optional, Union
 from src.event_rules import Rule
 
 class Mirror:
     """
     name: the mirror's custom name, for logging and credentials persistence. Use an alphanumeric format: [A-Za-z0-9] 
-    source_ics_calendar_url: Url of the ics file
+    source_ics_calendar_url: Url of the ics file, or a list of urls to merge several calendars into one
     google_calendar_id: Find it in the parameters of calendar.google.com on Desktop (see /images/find_google_calendar_id.png)
     rules: A list of custom rules
+    deduplicate: Removes the duplicate events of the source before applying the rules. 'uid', 'content' (same title,
+        start, end and location) or a list of fields. See src/dedup.py
+    merge_duplicate_descriptions: The kept event gets the description lines of all its duplicates
     """
-    def __init__(self, title: str, source_ics_calendar_url: str, google_calendar_id: str, rules: List[Rule]):
+    def __init__(self, title: str, source_ics_calendar_url: Union[str, List[str]], google_calendar_id: str, rules: List[Rule],
+                 deduplicate: Optional[Union[str, List[str]]] = None, merge_duplicate_descriptions: bool = False):
         self.title = title
         self.source_ics_calendar_url = source_ics_calendar_url
         self.google_calendar_id = google_calendar_id
         self.rules = rules
+        self.deduplicate = deduplicate
+        self.merge_duplicate_descriptions = merge_duplicate_descriptions
+
+
+class MirrorTarget:
+    """
+    One google calendar of a FanOutMirror.
+    title: name of the target, for logging
+    google_calendar_id: the google calendar written by this target
+    rules: rules applied after the common rules of the FanOutMirror, only for this target
+    account: name of the credentials used for this calendar. Defaults to the title of the FanOutMirror
+    """
+    def __init__(self, title: str, google_calendar_id: str, rules: List[Rule] = None, account: str = None):
+        self.title = title
+        self.google_calendar_id = google_calendar_id
+        self.rules = rules if rules is not None else []
+        self.account = account
+
+
+class FanOutMirror:
+    """
+    Mirrors one source to several google calendars (e.g. one per student group).
+    The source is downloaded, parsed and goes through the `common_rules` only once, then each target applies its own rules.
+    title, source_ics_calendar_url, deduplicate, merge_duplicate_descriptions: see Mirror
+    common_rules: rules applied to the source before the rules of the targets
+    targets: the google calendars to write
+    """
+    def __init__(self, title: str, source_ics_calendar_url: Union[str, List[str]], common_rules: List[Rule],
+                 targets: List[MirrorTarget], deduplicate: Optional[Union[str, List[str]]] = None,
+                 merge_duplicate_descriptions: bool = False):
+        self.title = title
+        self.source_ics_calendar_url = source_ics_calendar_url
+        self.common_rules = common_rules
+        self.targets = targets
+        self.deduplicate = deduplicate
+        self.merge_duplicate_descriptions = merge_duplicate_descriptions
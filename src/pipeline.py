@@ -0,0 +1,192 @@
+"""Pipelined runs: the stages of a run overlap instead of running one after the other.
+
+    download + parse  ->  rules + diff  ->  google writes
+       (a thread per source)   (a thread)     (the calling thread)
+
+The stages are connected by bounded queues. The first insert batches are sent while the rest of the source is still
+downloading, and when google slows down the queues fill up and the download waits (backpressure). The google calendar
+is listed in parallel with the download. The deletes are only known once the whole source has been seen, so they are
+written last.
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Iterator, Callable, Any
+
+import pytz
+
+from src.dedup import deduplicate_stream
+from src.event import Event
+from src.google_calendar_handler import GoogleCalendarHandler, BatchWriteResult
+from src.source_calendar.events_repository import EventsRepository
+from src.source_calendar.ics_calendar_provider import CalendarProvider
+from src.sync_plan import SyncPlan, SyncPlanner, PlannedChange, INSERT, UPDATE, DELETE
+
+# Maximum number of chunks waiting between two stages
+QUEUE_SIZE = 4
+
+# Number of source events parsed at once
+EVENTS_PER_CHUNK = 500
+
+_END = object()
+
+
+class PipelineStopped(Exception):
+    """Raised in a stage when another stage failed."""
+
+
+def _put(q: queue.Queue, item: Any, stop: threading.Event):
+    """Blocks while the queue is full, unless the pipeline is stopped."""
+    while True:
+        if stop.is_set():
+            raise PipelineStopped()
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _drain(q: queue.Queue, producers: int, stop: threading.Event) -> Iterator[Any]:
+    """Yields the items of the queue until all the producers have sent _END, unless the pipeline is stopped."""
+    ended = 0
+    while ended < producers:
+        if stop.is_set():
+            raise PipelineStopped()
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _END:
+            ended += 1
+        else:
+            yield item
+
+
+class PipelinedRun:
+    """One pipelined run of a KalWorker. See `KalWorker.run_pipelined`."""
+
+    def __init__(self, worker, handler: GoogleCalendarHandler, separation_date: datetime,
+                 events_per_chunk: int = EVENTS_PER_CHUNK, queue_size: int = QUEUE_SIZE,
+                 providers: List[CalendarProvider] = None):
+        """`providers` defaults to the providers of the worker."""
+        self.worker = worker
+        self.providers = providers
+        self.handler = handler
+        self.separation_date = separation_date
+        self.events_per_chunk = events_per_chunk
+        self.stop = threading.Event()
+        self.errors = []
+        self.parsed = queue.Queue(maxsize=queue_size)
+        self.planned = queue.Queue(maxsize=queue_size)
+        self.plan = SyncPlan(calendar_id=handler.calendar_id, separation_date=separation_date)
+        self.deleted = BatchWriteResult()
+        self.updated = BatchWriteResult()
+        self.inserted = BatchWriteResult()
+
+    def run(self, list_google_events: Callable[[], List[Event]]) -> SyncPlan:
+        """Runs all the stages. `list_google_events` returns the current events of the google calendar ; it is called
+        in parallel with the download. Returns the applied plan ; the results of the writes are in `deleted`,
+        `updated` and `inserted`."""
+        providers = self.providers if self.providers is not None else self.worker._get_providers()
+        threads = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            google_events = executor.submit(list_google_events)
+            try:
+                for provider in providers:
+                    threads.append(self._start_stage(lambda p=provider: self._fetch(p), self.parsed,
+                                                     f'fetch {provider.source_name}'))
+                threads.append(self._start_stage(lambda: self._diff(google_events.result, len(providers)),
+                                                 self.planned, 'diff'))
+                self._write()
+            except PipelineStopped:
+                pass
+            finally:
+                self.stop.set()
+                for thread in threads:
+                    thread.join()
+        if self.errors:
+            raise self.errors[0]
+        return self.plan
+
+    def _start_stage(self, target: Callable[[], None], output: queue.Queue, name: str) -> threading.Thread:
+        """Runs `target` in a thread, then sends _END to `output`. If it fails, the whole pipeline stops and `run`
+        raises the error."""
+
+        def run():
+            try:
+                target()
+                _put(output, _END, self.stop)
+            except PipelineStopped:
+                pass
+            except Exception as e:
+                logging.error(f"Pipeline stage {name} failed : {type(e).__name__} {e}")
+                self.errors.append(e)
+                self.stop.set()
+
+        thread = threading.Thread(target=run, name=f'kal-{name}', daemon=True)
+        thread.start()
+        return thread
+
+    def _fetch(self, provider):
+        repository = EventsRepository(provider, source=provider.source_name)
+        for chunk in repository.iter_event_chunks(self.events_per_chunk):
+            _put(self.parsed, chunk, self.stop)
+
+    def _source_chunks(self, producers: int) -> Iterator[List[Event]]:
+        separation_utc = self.separation_date.astimezone(pytz.utc)
+        for chunk in _drain(self.parsed, producers, self.stop):
+            yield [event for event in chunk if event.start.astimezone(pytz.utc) > separation_utc]
+
+    def _diff(self, get_google_events: Callable[[], List[Event]], producers: int):
+        chunks = self._source_chunks(producers)
+        if self.worker.dedup_key is not None:
+            chunks = deduplicate_stream(chunks, self.worker.dedup_key)
+
+        # the chunks keep coming while the google calendar is listed
+        planner = None
+        for chunk in chunks:
+            planner = planner or self._make_planner(get_google_events)
+            changes = planner.add(self.worker.signed_outcomes(chunk))
+            if changes:
+                _put(self.planned, changes, self.stop)
+
+        planner = planner or self._make_planner(get_google_events)
+        deletes = planner.finish()
+        if deletes:
+            _put(self.planned, deletes, self.stop)
+
+    def _make_planner(self, get_google_events: Callable[[], List[Event]]) -> SyncPlanner:
+        google_kal_events = [e for e in get_google_events() if self.worker._event_has_kal_signature(e)]
+        return SyncPlanner(google_kal_events, self.separation_date)
+
+    def _write(self):
+        """Writes the changes by full batches as they arrive, then the rest at the end."""
+        batch_size = GoogleCalendarHandler.BATCH_MAX_REQUEST_NUMBER
+        pending = {INSERT: [], UPDATE: [], DELETE: []}
+        for changes in _drain(self.planned, 1, self.stop):
+            for change in changes:
+                pending[change.action].append(change)
+            for action in (INSERT, UPDATE):
+                while len(pending[action]) >= batch_size:
+                    self._write_batch(action, pending[action][:batch_size])
+                    pending[action] = pending[action][batch_size:]
+        for action in (INSERT, UPDATE, DELETE):
+            if pending[action]:
+                self._write_batch(action, pending[action])
+
+    def _write_batch(self, action: str, changes: List[PlannedChange]):
+        if action == INSERT:
+            result = self.handler.insert_events([change.event for change in changes])
+            total = self.inserted
+        elif action == UPDATE:
+            result = self.handler.update_events([change.event for change in changes])
+            total = self.updated
+        else:
+            result = self.handler.delete_events([change.event.id for change in changes])
+            total = self.deleted
+        total.done += result.done
+        total.failed += result.failed
+        self.plan.changes += changes
@@ -0,0 +1,133 @@
+"""Profiling of the stages of a run (see src/metrics.py).
+
+A `StageProfiler` profiles each stage twice at once :
+- with cProfile, dumped as `<stage>.pstats` (open it with `python -m pstats` or snakeviz),
+- with a sampler reading the stack of the thread running the stage every `sampling_interval` seconds, dumped as a
+  flame graph in `<stage>.speedscope.json` (open it on https://www.speedscope.app).
+Both only see the thread running the stage : the threads of a pipelined run are not profiled.
+"""
+import cProfile
+import json
+import os
+import re
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+Frame = Tuple[str, str, int]  # function name, file, first line
+
+
+class StackSampler:
+    """Samples the stack of one thread from a background thread."""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: List[Tuple[Frame, ...]] = []  # stacks, root first
+        self.weights: List[float] = []  # seconds represented by each sample
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='kal-sampler', daemon=True)
+
+    def _run(self):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.samples.append(tuple(reversed(stack)))
+                self.weights.append(now - last)
+            last = now
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def speedscope_profile(name: str, samples: List[Tuple[Frame, ...]], weights: List[float]) -> dict:
+    """Returns a speedscope file (https://www.speedscope.app/file-format-schema.json) with one sampled profile."""
+    frames: List[dict] = []
+    index: Dict[Frame, int] = {}
+    indexed_samples = []
+    for stack in samples:
+        indexed = []
+        for frame in stack:
+            if frame not in index:
+                index[frame] = len(frames)
+                frames.append({'name': frame[0], 'file': frame[1], 'line': frame[2]})
+            indexed.append(index[frame])
+        indexed_samples.append(indexed)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'kal',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': indexed_samples,
+            'weights': weights,
+        }],
+    }
+
+
+class StageProfiler:
+    """Ex:
+        profiler = StageProfiler('profiles')
+        worker = KalWorker(..., profiler=profiler)
+        worker.run(service)
+        profiler.dump()  # profiles/plan.pstats, profiles/plan.speedscope.json...
+    """
+
+    def __init__(self, output_directory: str, sampling_interval: float = 0.001):
+        self.output_directory = output_directory
+        self.sampling_interval = sampling_interval
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self.samples: Dict[str, List[Tuple[Frame, ...]]] = {}
+        self.weights: Dict[str, List[float]] = {}
+        self._running: Dict[str, Tuple[cProfile.Profile, StackSampler]] = {}
+
+    def start_stage(self, name: str):
+        profile = self.profiles.setdefault(name, cProfile.Profile())
+        sampler = StackSampler(threading.get_ident(), self.sampling_interval)
+        self._running[name] = (profile, sampler)
+        sampler.start()
+        profile.enable()
+
+    def end_stage(self, name: str):
+        running = self._running.pop(name, None)
+        if running is None:
+            return
+        profile, sampler = running
+        profile.disable()
+        sampler.stop()
+        self.samples.setdefault(name, []).extend(sampler.samples)
+        self.weights.setdefault(name, []).extend(sampler.weights)
+
+    def _path(self, stage: str, extension: str) -> str:
+        return os.path.join(self.output_directory, re.sub(r'[^A-Za-z0-9._-]', '_', stage) + extension)
+
+    def dump(self) -> List[str]:
+        """Writes the profiles of the stages profiled so far. Returns the paths of the files."""
+        os.makedirs(self.output_directory, exist_ok=True)
+        paths = []
+        for stage, profile in self.profiles.items():
+            path = self._path(stage, '.pstats')
+            profile.dump_stats(path)
+            paths.append(path)
+            path = self._path(stage, '.speedscope.json')
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(speedscope_profile(stage, self.samples.get(stage, []), self.weights.get(stage, [])), f)
+            paths.append(path)
+        return paths
@@ -0,0 +1,102 @@
+"""Local snapshots of the kal-signed events of google calendars, to avoid listing them on every run."""
+import json
+import os
+import re
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import pytz
+
+from src.event import Event
+from src.util import STATE_DIRECTORY
+
+
+@dataclass
+class CalendarSnapshot:
+    """The kal-signed events of a google calendar, as last listed from google (`validated_at`) and then updated
+    with the results of our own writes."""
+    calendar_id: str
+    validated_at: datetime
+    events: List[Event] = field(default_factory=list)
+
+    def is_fresh(self, max_age: timedelta, now: datetime = None) -> bool:
+        now = now if now is not None else datetime.now(pytz.utc)
+        return now - self.validated_at < max_age
+
+    def apply_writes(self, deleted_ids: List[str], updated: List[Event], inserted: List[Event]):
+        """Updates the snapshot with the events returned by google after a sync."""
+        replaced = {event.id: event for event in updated}
+        deleted = set(deleted_ids)
+        events = []
+        for event in self.events:
+            if event.id in deleted:
+                continue
+            events.append(replaced.get(event.id, event))
+        self.events = events + list(inserted)
+
+    def drop_events_ended_before(self, date: datetime):
+        date = date.astimezone(pytz.utc)
+        self.events = [event for event in self.events if event.end.astimezone(pytz.utc) > date]
+
+    def to_dict(self) -> dict:
+        return {
+            'calendar_id': self.calendar_id,
+            'validated_at': self.validated_at.isoformat(),
+            'events': [event.to_dict() for event in self.events],
+        }
+
+    @staticmethod
+    def from_dict(d: dict) -> 'CalendarSnapshot':
+        return CalendarSnapshot(calendar_id=d['calendar_id'],
+                                validated_at=datetime.fromisoformat(d['validated_at']),
+                                events=[Event.from_dict(e) for e in d['events']])
+
+
+class CalendarSnapshotStore:
+    """Stores one snapshot per google calendar id, as json files in `directory`.
+
+    Kal is the only writer of kal-signed events, so a snapshot kept up to date with our own writes is as good as
+    listing the calendar. It is still revalidated against google once it is older than `max_age`, or after a
+    write conflict (see `invalidate`)."""
+
+    def __init__(self, directory: str = os.path.join(STATE_DIRECTORY, 'snapshots'),
+                 max_age: timedelta = timedelta(hours=24)):
+        self.directory = directory
+        self.max_age = max_age
+
+    def _path(self, calendar_id: str) -> str:
+        return os.path.join(self.directory, re.sub(r'[^A-Za-z0-9._-]', '_', calendar_id) + '.json')
+
+    def load(self, calendar_id: str) -> Optional[CalendarSnapshot]:
+        """Returns the snapshot of the calendar, or None if there is none or it's unreadable."""
+        try:
+            with open(self._path(calendar_id), 'r', encoding='utf-8') as f:
+                snapshot = CalendarSnapshot.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+        if snapshot.calendar_id != calendar_id:
+            return None
+        return snapshot
+
+    def load_fresh(self, calendar_id: str) -> Optional[CalendarSnapshot]:
+        """Returns the snapshot of the calendar only if it doesn't need to be revalidated."""
+        snapshot = self.load(calendar_id)
+        if snapshot is None or not snapshot.is_fresh(self.max_age):
+            return None
+        return snapshot
+
+    def save(self, snapshot: CalendarSnapshot):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(snapshot.calendar_id)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def invalidate(self, calendar_id: str):
+        """Forces the next run to list the calendar from google."""
+        try:
+            os.remove(self._path(calendar_id))
+        except FileNotFoundError:
+            pass
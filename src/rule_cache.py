@@ -0,0 +1,146 @@
+"""Memoization of the results of the rules, across runs.
+
+Timetable feeds barely change between two polls, so most events go through the exact same rules with the exact same
+result every run. The cache key is made of a fingerprint of the rule set (its specs) and of the values of the event
+fields the rules read : editing a rule in mirrors/* changes the fingerprint, so stale results are never reused.
+"""
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from dataclasses import replace
+from typing import List, Optional, Set, Tuple
+
+from src.event import Event
+from src.event_rules import Rule
+from src.sync_plan import RuleOutcome
+
+_LOGICAL_OPERATORS = ('or', 'any', 'and', 'all', 'not')
+_REMOVED = 'removed'
+
+
+def rules_fingerprint(rules: List[Rule]) -> Optional[str]:
+    """Returns a hash of the definitions of the rules, or None if one of them can't be described."""
+    specs = [rule.spec for rule in rules]
+    if any(spec is None for spec in specs):
+        return None
+    # names are part of the cached outcomes, through the matched rules labels
+    names = [rule.name for rule in rules]
+    return hashlib.sha256(repr((specs, names)).encode('utf-8')).hexdigest()
+
+
+def _condition_fields(spec: tuple, fields: Set[str]):
+    operator = spec[0]
+    if operator in _LOGICAL_OPERATORS:
+        for child in spec[1]:
+            _condition_fields(child, fields)
+    elif operator != 'always':
+        fields.add(spec[1])
+
+
+def rules_fields(rules: List[Rule]) -> Tuple[Set[str], Set[str]]:
+    """Returns the event fields read and the event fields written by the rules. Rules must have a spec."""
+    read, written = set(), set()
+    for rule in rules:
+        _, action_specs, condition_specs = rule.spec
+        for spec in condition_specs:
+            _condition_fields(spec, read)
+        for spec in action_specs:
+            if spec[0] == 'change_color':
+                written.add('color')
+            elif spec[0] in ('prefix_str_to_field', 'append_str_to_field'):
+                read.add(spec[1])
+                written.add(spec[1])
+            elif spec[0] == 'set_field_str':
+                written.add(spec[1])
+    return read, written
+
+
+class RuleResultCache:
+    """LRU cache of rule outcomes, optionally persisted in a pickle file at `path` (see `save`)."""
+
+    def __init__(self, max_size: int = 100_000, path: str = None):
+        self.max_size = max_size
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None:
+            self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def bind(self, rules: List[Rule]) -> Optional['BoundRuleCache']:
+        """Returns a view of the cache for this rule set, or None if the rules can't be fingerprinted."""
+        fingerprint = rules_fingerprint(rules)
+        if fingerprint is None:
+            return None
+        read, written = rules_fields(rules)
+        return BoundRuleCache(self, fingerprint, sorted(read), sorted(written))
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                entries = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return
+        if isinstance(entries, OrderedDict):
+            self._entries = entries
+
+    def save(self):
+        """Writes the cache to `path`, if any."""
+        if self.path is None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            data = pickle.dumps(self._entries)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+
+class BoundRuleCache:
+    """Looks up and stores outcomes of one rule set. Only the written fields of the result are stored."""
+
+    def __init__(self, cache: RuleResultCache, fingerprint: str, read_fields: List[str], written_fields: List[str]):
+        self.cache = cache
+        self.fingerprint = fingerprint
+        self.read_fields = read_fields
+        self.written_fields = written_fields
+
+    def _key(self, event: Event) -> str:
+        values = tuple(getattr(event, field) for field in self.read_fields)
+        return self.fingerprint + hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+    def get(self, event: Event) -> Optional[RuleOutcome]:
+        cached = self.cache.get(self._key(event))
+        if cached is None:
+            return None
+        changes, rules = cached
+        result = None if changes == _REMOVED else replace(event, **changes)
+        return RuleOutcome(source=event, result=result, rules=list(rules))
+
+    def put(self, outcome: RuleOutcome):
+        if outcome.result is None:
+            changes = _REMOVED
+        else:
+            changes = {field: getattr(outcome.result, field) for field in self.written_fields}
+        self.cache.put(self._key(outcome.source), (changes, tuple(outcome.rules)))
@@ -0,0 +1,291 @@
+"""Rules described in json or yaml files instead of python code.
+
+A rule file holds a list of rules, each with a `when` (one condition, or a list of conditions that must all be
+verified) and a list of `actions`, named after the methods of Condition and Rule :
+
+    rules:
+      - name: Calcul formel
+        when: {field: title, contains: HAI507I, case_sensitive: false}
+        actions:
+          - prefix_str_to_field: {field: title, value: 'Calcul formel - '}
+          - change_color: SAGE
+      - when:
+          any:
+            - {field: title, contains: HAX504X}
+            - {field: location, starts_with: 'Salle'}
+        actions: [remove_event]
+
+Files are compiled into a flat plan : a list of (name, rule spec) where nested `any`/`all` are flattened, substring
+conditions of an `any` are merged and actions following `remove_event` are dropped. The plan is cached on disk by
+the hash of the file path and content, so loading an unchanged file skips the parsing and the validation (most of
+the time, for yaml files) : the rules are still rebuilt from the plan. Only the plan of the last version of each file
+is kept.
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+from typing import List, Optional, Tuple, Any
+
+from src.event import Event
+from src.event_colors import EventColor
+from src.event_rules import Rule, Condition
+from src.exceptions import InvalidRuleFileError
+from src.util import STATE_DIRECTORY
+
+try:
+    import yaml
+except ImportError:  # yaml rule files are optional
+    yaml = None
+
+# Increment when the compiled plan format changes, to invalidate the cached plans
+COMPILER_VERSION = 1
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(STATE_DIRECTORY, 'compiled_rules')
+
+_STR_OPERATORS = ('contains', 'contains_any', 'matches', 'equals', 'starts_with', 'ends_with')
+_CASE_OPERATORS = ('contains', 'contains_any', 'matches')
+_FIELD_ACTIONS = ('prefix_str_to_field', 'append_str_to_field', 'set_field_str')
+
+CompiledRule = Tuple[Optional[str], tuple]
+
+
+def load_rules(path: str, cache_directory: Optional[str] = DEFAULT_CACHE_DIRECTORY) -> List[Rule]:
+    """Loads the rules of a json or yaml file. Set `cache_directory` to None to disable the compiled plans cache.
+    Raises InvalidRuleFileError."""
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+    except OSError as e:
+        raise InvalidRuleFileError(f"Cannot read rule file {path} : {e}")
+
+    digest = hashlib.sha256(f'{COMPILER_VERSION}:'.encode() + content).hexdigest()
+    # the plans of a file share the prefix, to delete the plans of its previous versions
+    path_key = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_directory, f'{path_key}-{digest}.pickle') if cache_directory else None
+
+    plan = _load_cached_plan(cache_path) if cache_path else None
+    if plan is not None:
+        try:
+            return rules_from_plan(plan)
+        except Exception as e:  # a plan of an older kal, unpickled but not understood anymore
+            logging.warning(f"Ignoring the compiled rules {cache_path} : {type(e).__name__} {e}")
+    plan = compile_rules(_parse(path, content))
+    if cache_path:
+        _save_cached_plan(cache_path, plan)
+    return rules_from_plan(plan)
+
+
+def _parse(path: str, content: bytes) -> Any:
+    try:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise InvalidRuleFileError(f"PyYAML must be installed to read {path}")
+            return yaml.safe_load(content)
+        return json.loads(content)
+    except ValueError as e:  # json.JSONDecodeError
+        raise InvalidRuleFileError(f"Cannot parse rule file {path} : {e}")
+    except Exception as e:
+        if yaml is not None and isinstance(e, yaml.YAMLError):
+            raise InvalidRuleFileError(f"Cannot parse rule file {path} : {e}")
+        raise
+
+
+def _load_cached_plan(cache_path: str) -> Optional[List[CompiledRule]]:
+    """Returns the cached plan, or None if there is none or it can't be read : the file is then compiled again."""
+    try:
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:  # a corrupt or stale pickle can raise about anything (AttributeError, ImportError...)
+        logging.warning(f"Ignoring the compiled rules {cache_path} : {type(e).__name__} {e}")
+        return None
+
+
+def _save_cached_plan(cache_path: str, plan: List[CompiledRule]):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # the pid avoids clashes between the processes of a pool compiling the same file
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(plan, f)
+    os.replace(tmp_path, cache_path)
+
+    directory, name = os.path.split(cache_path)
+    prefix = name.split('-')[0] + '-'
+    for other in os.listdir(directory):
+        if other.startswith(prefix) and other.endswith('.pickle') and other != name:
+            try:
+                os.remove(os.path.join(directory, other))
+            except FileNotFoundError:  # removed by another process
+                pass
+
+
+def compile_rules(data: Any) -> List[CompiledRule]:
+    """Validates the content of a rule file and compiles it into a flat plan. Raises InvalidRuleFileError."""
+    if isinstance(data, dict):
+        data = data.get('rules')
+    if not isinstance(data, list):
+        raise InvalidRuleFileError("A rule file must contain a list of rules")
+    return [_compile_rule(rule, i) for i, rule in enumerate(data)]
+
+
+def _compile_rule(data: Any, index: int) -> CompiledRule:
+    if not isinstance(data, dict):
+        raise InvalidRuleFileError(f"Rule #{index} should be a mapping")
+    name = data.get('name')
+    when = data.get('when')
+    if when is None:
+        raise InvalidRuleFileError(f"Rule #{index} has no 'when'")
+    conditions = [_compile_condition(c) for c in (when if isinstance(when, list) else [when])]
+    # a list of conditions is an implicit 'all'
+    flat_conditions = []
+    for spec in conditions:
+        flat_conditions.extend(spec[1] if spec[0] == 'all' else [spec])
+
+    actions = []
+    for action in data.get('actions', []):
+        spec = _compile_action(action, index)
+        actions.append(spec)
+        if spec[0] == 'remove_event':
+            break
+    if not actions:
+        raise InvalidRuleFileError(f"Rule #{index} has no actions")
+
+    return name, ('rule', tuple(actions), tuple(flat_conditions))
+
+
+def _compile_condition(data: Any) -> tuple:
+    if not isinstance(data, dict):
+        raise InvalidRuleFileError(f"A condition should be a mapping, not {data!r}")
+
+    if data.get('always'):
+        return ('always',)
+    for operator in ('any', 'all'):
+        if operator in data:
+            children = data[operator]
+            if not isinstance(children, list) or not children:
+                raise InvalidRuleFileError(f"'{operator}' expects a non empty list of conditions")
+            return _flatten(operator, [_compile_condition(child) for child in children])
+    if 'not' in data:
+        return ('not', (_compile_condition(data['not']),))
+
+    operators = [key for key in data if key in _STR_OPERATORS]
+    if len(operators) != 1 or 'field' not in data:
+        raise InvalidRuleFileError(f"A condition needs a 'field' and exactly one of {_STR_OPERATORS} : {data!r}")
+    operator = operators[0]
+    field = Event._format_field_name(str(data['field']))
+    try:
+        field_type = Event.type_of_field(field)
+    except AttributeError as e:
+        raise InvalidRuleFileError(str(e))
+    if field_type is not str:
+        raise InvalidRuleFileError(f"'{operator}' can only be used on a string field, not {field}")
+
+    argument = data[operator]
+    if operator == 'contains_any':
+        if not isinstance(argument, list):
+            raise InvalidRuleFileError("'contains_any' expects a list of strings")
+        argument = tuple(str(a) for a in argument)
+    else:
+        argument = str(argument)
+    if operator == 'matches':
+        try:
+            re.compile(argument)
+        except re.error as e:
+            raise InvalidRuleFileError(f"Invalid regular expression {argument!r} : {e}")
+
+    if operator in _CASE_OPERATORS:
+        case_sensitive = data.get('case_sensitive', True)
+        if not isinstance(case_sensitive, bool):
+            raise InvalidRuleFileError(f"'case_sensitive' expects true or false, not {case_sensitive!r}")
+        return (operator, field, argument, case_sensitive)
+    return (operator, field, argument)
+
+
+def _flatten(operator: str, children: List[tuple]) -> tuple:
+    """Inlines nested conditions with the same operator, and merges substring conditions of an 'any'."""
+    flat = []
+    for child in children:
+        flat.extend(child[1] if child[0] == operator else [child])
+
+    if operator == 'any':
+        merged = []
+        positions = {}
+        for child in flat:
+            if child[0] in ('contains', 'contains_any'):
+                key = (child[1], child[3])
+                substrings = (child[2],) if child[0] == 'contains' else child[2]
+                if key in positions:
+                    _, field, merged_substrings, case_sensitive = merged[positions[key]]
+                    merged[positions[key]] = ('contains_any', field, merged_substrings + substrings, case_sensitive)
+                    continue
+                positions[key] = len(merged)
+                child = ('contains_any', child[1], substrings, child[3])
+            merged.append(child)
+        flat = merged
+
+    if len(flat) == 1:
+        return flat[0]
+    return (operator, tuple(flat))
+
+
+def _compile_action(data: Any, index: int) -> tuple:
+    if data == 'remove_event' or (isinstance(data, dict) and data.get('remove_event')):
+        return ('remove_event',)
+    if not isinstance(data, dict) or len(data) != 1:
+        raise InvalidRuleFileError(f"Rule #{index} : an action should be a mapping with a single key, not {data!r}")
+
+    (action, argument), = data.items()
+    if action == 'change_color':
+        return ('change_color', _color_value(str(argument), index))
+    if action in _FIELD_ACTIONS:
+        if not isinstance(argument, dict) or 'field' not in argument or 'value' not in argument:
+            raise InvalidRuleFileError(f"Rule #{index} : '{action}' expects a 'field' and a 'value'")
+        return (action, Event._format_field_name(str(argument['field'])), str(argument['value']))
+    raise InvalidRuleFileError(f"Rule #{index} : unknown action '{action}'")
+
+
+def _color_value(color: str, index: int) -> str:
+    if color.upper() in EventColor.__members__:
+        return EventColor[color.upper()].value
+    if EventColor.from_color_id(color) is not None:
+        return color
+    raise InvalidRuleFileError(f"Rule #{index} : unknown color '{color}'")
+
+
+def rules_from_plan(plan: List[CompiledRule]) -> List[Rule]:
+    """Builds Rule objects from a compiled plan."""
+    rules = []
+    for name, (_, actions, conditions) in plan:
+        rule = Rule()
+        if name is not None:
+            rule.named(name)
+        for action in actions:
+            if action[0] == 'change_color':
+                rule.change_color(EventColor(action[1]))
+            else:
+                getattr(rule, action[0])(*action[1:])
+        rules.append(rule.on([condition_from_spec(spec) for spec in conditions]))
+    return rules
+
+
+def condition_from_spec(spec: tuple) -> Condition:
+    operator = spec[0]
+    if operator == 'always':
+        return Condition().always()
+    if operator in ('any', 'all'):
+        children = [condition_from_spec(child) for child in spec[1]]
+        return Condition().logical_any(children) if operator == 'any' else Condition().logical_all(children)
+    if operator in ('or', 'and'):
+        first, second = (condition_from_spec(child) for child in spec[1])
+        return Condition().logical_or(first, second) if operator == 'or' else Condition().logical_and(first, second)
+    if operator == 'not':
+        return Condition().logical_not(condition_from_spec(spec[1][0]))
+
+    condition = Condition().field(spec[1])
+    if operator in _CASE_OPERATORS:
+        return getattr(condition, operator)(spec[2], case_sensitive=spec[3])
+    return getattr(condition, operator)(spec[2])
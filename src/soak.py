@@ -0,0 +1,100 @@
+"""Soak test : runs a worker through many synthetic sync cycles against a google service, and fails if the memory of
+the process keeps growing. Use an in memory service (e.g. src/fake_google_service.py), never a real calendar.
+
+Each cycle feeds the worker a new version of a synthetic calendar, where a few events are renamed, one is cancelled
+and one is added, like a timetable between two polls.
+
+Ex:
+    worker = KalWorker(source_ics_calendar_url='synthetic', google_calendar_id='soak', rules=my_mirror.rules)
+    result = soak(worker, FakeGoogleService(), cycles=5000)
+"""
+import gc
+import logging
+import tracemalloc
+import warnings
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import pytz
+
+from src.exceptions import MemoryDriftError
+from src.memory import format_bytes
+from src.source_calendar.ics_calendar_provider import StringEventsProvider
+
+SOURCE_NAME = 'synthetic'
+
+
+def synthetic_ics(cycle: int, events: int, start: datetime, changed: int = 3) -> str:
+    """Calendar of `events` hourly events from `start`. Each cycle renames about `changed` events and replaces an event
+    by a new one at the same time, so the sync has updates, a delete and an insert to do."""
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:kal-soak']
+    for i in range(cycle, cycle + events):
+        begin = start + timedelta(hours=i % events)
+        renamed = (i + cycle) % max(events // changed, 1) == 0
+        lines += ['BEGIN:VEVENT', f'UID:soak-{i}', 'DTSTAMP:20210913T080000Z',
+                  f"DTSTART:{begin.strftime('%Y%m%dT%H%M%SZ')}",
+                  f"DTEND:{(begin + timedelta(minutes=90)).strftime('%Y%m%dT%H%M%SZ')}",
+                  f"SUMMARY:Course {i % 40}{' (moved)' if renamed else ''}",
+                  'LOCATION:Bat 36 - Salle 3',
+                  'DESCRIPTION:L2 CUPGE\\nL2 Maths\\nGroupe A',
+                  'END:VEVENT']
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(lines)
+
+
+@dataclass
+class SoakResult:
+    cycles: int
+    baseline: int  # bytes allocated by python after the warmup
+    samples: List[int] = field(default_factory=list)  # bytes allocated by python at each sample
+
+    @property
+    def drift(self) -> int:
+        """Growth of the memory since the warmup. The lowest of the last samples is used : memory that is freed
+        later (caches being evicted, garbage...) isn't a drift."""
+        if not self.samples:
+            return 0
+        last = self.samples[len(self.samples) // 2:]
+        return min(last) - self.baseline
+
+
+def _traced_memory() -> int:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def soak(worker, service, cycles: int = 1000, events: int = 100, warmup: int = 50, sample_every: int = 50,
+         max_drift: int = 1024 * 1024) -> SoakResult:
+    """Runs `cycles` syncs of the `worker` (a KalWorker, whose provider is replaced) against `service`.
+    Raises MemoryDriftError if the memory allocated by python grew by more than `max_drift` bytes after the `warmup`
+    cycles, which fill the caches."""
+    start = datetime.now(pytz.utc).replace(minute=0, second=0, microsecond=0) + timedelta(days=1)
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    result: Optional[SoakResult] = None
+    try:
+        # arrow warns on each parse : when the caller records warnings (like pytest does), the records would grow
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for cycle in range(cycles):
+                worker.provider = StringEventsProvider(synthetic_ics(cycle, events, start), SOURCE_NAME)
+                worker.run(service)
+                if cycle + 1 == warmup:
+                    result = SoakResult(cycles=cycles, baseline=_traced_memory())
+                elif result is not None and (cycle + 1 - warmup) % sample_every == 0:
+                    result.samples.append(_traced_memory())
+            if result is None:
+                raise ValueError(f"{cycles} cycles don't go past the warmup ({warmup} cycles)")
+            if not result.samples or (cycles - warmup) % sample_every:
+                result.samples.append(_traced_memory())
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    logging.info(f"Soak of {cycles} cycles : drift {format_bytes(result.drift)} since the warmup")
+    if result.drift > max_drift:
+        raise MemoryDriftError(f"Memory grew by {format_bytes(result.drift)} over {cycles} cycles "
+                               f"(max {format_bytes(max_drift)})")
+    return result
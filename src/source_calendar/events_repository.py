@@ -1,7 +1,43 @@
+from ics import Calendar
+
 from src.source_calendar.ics_calendar_provider import CalendarProvider
 from src.event import Event
+from src.string_pool import StringPool
+
+from typing import Iterator, Iterable, List
+
+
+def split_ics_lines(lines: Iterable[str], events_per_chunk: int) -> Iterator[str]:
+    """Cuts an ics file into small calendars of at most `events_per_chunk` VEVENTs, as its lines arrive.
+    Each chunk repeats the header of the file (properties, VTIMEZONEs...) so that it can be parsed alone."""
+    header = []
+    events = []
+    current = None
+    for line in lines:
+        if current is not None:
+            current.append(line)
+            if line.startswith('END:VEVENT'):
+                events.append(current)
+                current = None
+                if len(events) >= events_per_chunk:
+                    yield _make_chunk(header, events)
+                    events = []
+        elif line.startswith('BEGIN:VEVENT'):
+            current = [line]
+        elif line.startswith('END:VCALENDAR'):
+            break
+        elif line:
+            header.append(line)
+    if events:
+        yield _make_chunk(header, events)
 
-from typing import Iterator
+
+def _make_chunk(header: List[str], events: List[List[str]]) -> str:
+    lines = list(header)
+    for event in events:
+        lines += event
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(lines)
 
 
 class EventsRepository:
@@ -11,17 +47,31 @@ class EventsRepository:
         calendar = self.provider.get_calendar()
 
         for event in calendar.events:
-            yield Event(
-                title=event.name,
-                description=event.description,
-                location=event.location,
-                start=event.begin.datetime,
-                end=event.end.datetime,
-                html_link=event.url,
-                is_all_day=event.all_day,
-                created=event.created,
-                updated=event.last_modified,
-            )
-
-    def __init__(self, provider: CalendarProvider):
+            yield self._to_event(event)
+
+    def iter_event_chunks(self, events_per_chunk: int = 500) -> Iterator[List[Event]]:
+        """Yields the events by chunks, parsing each chunk as soon as it is downloaded."""
+        for chunk in split_ics_lines(self.provider.iter_ics_lines(), events_per_chunk):
+            yield [self._to_event(event) for event in Calendar(chunk).events]
+
+    def _to_event(self, event) -> Event:
+        return Event(
+            title=self.string_pool.intern(event.name),
+            description=self.string_pool.intern(event.description),
+            location=self.string_pool.intern(event.location),
+            start=event.begin.datetime,
+            end=event.end.datetime,
+            html_link=event.url,
+            is_all_day=event.all_day,
+            created=event.created.datetime if event.created else None,
+            updated=event.last_modified.datetime if event.last_modified else None,
+            uid=event.uid,
+            source=self.source,
+        )
+
+    def __init__(self, provider: CalendarProvider, source: str = None, string_pool: StringPool = None):
+        """`source` is set as the source of all the events.
+        The events share the instances of their equal titles, descriptions and locations, kept in `string_pool`."""
         self.provider = provider
+        self.source = source
+        self.string_pool = string_pool if string_pool is not None else StringPool()
@@ -0,0 +1,203 @@
+"""Fetching of the ics files, polite to the servers shared by many mirrors.
+
+All the requests to a host go through its `HostState` :
+- at most `max_concurrency` requests to the host at the same time,
+- the retries of all the urls of the host share a budget : when the host fails, every mirror backs off together,
+  instead of each one retrying its url 5 times,
+- after `failure_threshold` failures in a row, the circuit opens : the requests to the host fail right away with
+  CircuitOpenError for `open_seconds`. Then one request is let through : the circuit closes again if it succeeds.
+
+Hosts don't wait for each other : a struggling planning server doesn't slow down the other sources.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, Optional
+from urllib.parse import urlsplit
+
+import requests
+
+from src.exceptions import CircuitOpenError
+
+# Statuses worth retrying : the server is overloaded or restarting
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half open'
+
+
+@dataclass(frozen=True)
+class HostPolicy:
+    max_concurrency: int = 2
+    max_attempts: int = 3  # attempts of a request, if the retry budget allows it
+    retry_budget: float = 10  # retries the host can spend at once...
+    retry_refill: float = 0.1  # ...refilled by this many retries per second
+    backoff: float = 0.5  # first backoff of the host after a failure, in seconds, doubled at each failure
+    max_backoff: float = 30.0
+    failure_threshold: int = 5  # failures in a row that open the circuit
+    open_seconds: float = 60.0
+
+
+class HostState:
+    """Concurrency slots, retry budget, backoff and circuit of one host, shared by all its requests."""
+
+    def __init__(self, host: str, policy: HostPolicy):
+        self.host = host
+        self.policy = policy
+        self.slots = threading.BoundedSemaphore(policy.max_concurrency)
+        self._lock = threading.Lock()
+        self.retry_tokens = policy.retry_budget
+        self._refilled_at = time.monotonic()
+        self.failures = 0  # failures in a row
+        self.backoff_until = 0.0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._trial_running = False
+
+    def backoff_wait(self) -> float:
+        """Raises CircuitOpenError if the circuit of the host is open. Returns the seconds left of its backoff."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN and now - self.opened_at < self.policy.open_seconds:
+                raise CircuitOpenError(f"{self.host} failed {self.failures} times in a row : not requested until "
+                                       f"{self.policy.open_seconds - (now - self.opened_at):.0f}s from now")
+            return self.backoff_until - now
+
+    @contextmanager
+    def request(self):
+        """Wraps one request to the host, which must record its success or failure.
+        Raises CircuitOpenError if the host must not be requested now. Once the circuit has been open for
+        `open_seconds`, only one request at a time is let through, until one succeeds."""
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.policy.open_seconds:
+                    raise CircuitOpenError(f"{self.host} failed {self.failures} times in a row")
+                self.state = HALF_OPEN
+            trial = self.state == HALF_OPEN
+            if trial:
+                if self._trial_running:
+                    raise CircuitOpenError(f"{self.host} is being tested by another request")
+                self._trial_running = True
+        try:
+            yield
+        finally:
+            if trial:
+                # whatever ended the trial, another request can test the host
+                with self._lock:
+                    self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logging.info(f"{self.host} answers again : closing its circuit")
+            self.failures = 0
+            self.backoff_until = 0.0
+            self.state = CLOSED
+
+    def record_failure(self, retry_after: Optional[float] = None):
+        with self._lock:
+            self.failures += 1
+            backoff = min(self.policy.backoff * 2 ** (self.failures - 1), self.policy.max_backoff)
+            if retry_after is not None:
+                backoff = min(max(backoff, retry_after), self.policy.max_backoff)
+            self.backoff_until = max(self.backoff_until, time.monotonic() + backoff)
+            if self.state == HALF_OPEN or self.failures >= self.policy.failure_threshold:
+                if self.state != OPEN:
+                    logging.warning(f"{self.host} failed {self.failures} times in a row : opening its circuit for "
+                                    f"{self.policy.open_seconds:.0f}s")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def take_retry(self) -> bool:
+        """Spends a retry of the budget of the host. False if it is exhausted."""
+        with self._lock:
+            now = time.monotonic()
+            self.retry_tokens = min(self.policy.retry_budget,
+                                    self.retry_tokens + (now - self._refilled_at) * self.policy.retry_refill)
+            self._refilled_at = now
+            if self.retry_tokens < 1:
+                return False
+            self.retry_tokens -= 1
+            return True
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class FetchScheduler:
+    """Sends the GET requests of the providers, host by host.
+
+    Ex:
+        with fetch_scheduler.fetch('https://proseconsult.umontpellier.fr/...', stream=True) as response:
+            lines = response.iter_lines()
+    """
+
+    def __init__(self, policy: HostPolicy = None, host_policies: Dict[str, HostPolicy] = None, timeout: float = 30.0):
+        """`host_policies` overrides the default `policy` for some hosts."""
+        self.policy = policy or HostPolicy()
+        self.host_policies = host_policies or {}
+        self.timeout = timeout
+        self._hosts: Dict[str, HostState] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def host_state(self, url: str) -> HostState:
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = HostState(host, self.host_policies.get(host, self.policy))
+            return self._hosts[host]
+
+    def _session(self) -> requests.Session:
+        # sessions keep the connections to the hosts alive, but aren't thread safe
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    @contextmanager
+    def fetch(self, url: str, headers: Dict[str, str] = None, stream: bool = False) -> Iterator[requests.Response]:
+        """GET request, retried on connection errors and on RETRY_STATUSES while the retry budget of the host lasts.
+        The last response is returned even if its status is an error. The concurrency slot of the host is held until
+        the end of the block, so that a streamed response counts until it is read.
+        Raises CircuitOpenError, or the requests error of the last attempt."""
+        state = self.host_state(url)
+        attempt = 1
+        while True:
+            wait = state.backoff_wait()
+            if wait > 0:
+                # no slot is held while waiting : a host in backoff doesn't block the requests of other threads
+                time.sleep(wait)
+            with state.slots:
+                with state.request():
+                    try:
+                        response = self._session().get(url, headers=headers, stream=stream, timeout=self.timeout)
+                    except requests.RequestException:
+                        state.record_failure()
+                        if attempt >= state.policy.max_attempts or not state.take_retry():
+                            raise
+                        response = None
+                    else:
+                        if response.status_code not in RETRY_STATUSES:
+                            state.record_success()
+                        else:
+                            state.record_failure(_retry_after(response))
+                            if attempt < state.policy.max_attempts and state.take_retry():
+                                response.close()
+                                response = None
+                if response is not None:
+                    with response:
+                        yield response
+                    return
+            attempt += 1
+            logging.info(f"Retrying {url} (attempt {attempt})")
+
+
+# Shared by all the network providers : all the mirrors of the process share the limits of each host
+fetch_scheduler = FetchScheduler()
@@ -1,58 +1,135 @@
+import hashlib
 from abc import ABC, abstractmethod
+from contextlib import contextmanager, ExitStack
+from dataclasses import dataclass
+from typing import Iterator, Optional
 
 import requests
 
 from ics import Calendar
 
 from src.exceptions import InvalidUrlError, InvalidStatusCodeError, NoInternetConnectionError, UnkownRequestError, \
-    CalendarNotAvailableError
-from src.util import is_url_valid, robust_request
+    CalendarNotAvailableError, CircuitOpenError
+from src.source_calendar.fetch_scheduler import FetchScheduler, fetch_scheduler
+from src.util import is_url_valid
 
 import logging
 
 
+@dataclass
+class RawCalendar:
+    """The content of an ics file before parsing. `text` is None when the server answered 304 Not Modified."""
+    text: Optional[str]
+    content_hash: Optional[str] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @property
+    def not_modified(self) -> bool:
+        return self.text is None
+
+
+def _hash_content(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
 class CalendarProvider(ABC):
     @abstractmethod
     def get_calendar(self) -> Calendar:
         """Returns a Calendar instance from the icspy module."""
         pass
 
+    @property
+    def source_name(self) -> str:
+        """Identifies the calendar in logs and in the source of its events."""
+        return type(self).__name__
+
+    def iter_ics_lines(self) -> Iterator[str]:
+        """Yields the lines of the ics file, if possible while it is still downloading.
+        By default, the whole calendar is loaded first."""
+        yield from str(self.get_calendar()).splitlines()
+
+    def download(self, etag: str = None, last_modified: str = None) -> RawCalendar:
+        """Returns the ics file without parsing it, to detect changes cheaply.
+        Providers that support it answer `not_modified` when the validators of the previous download still match."""
+        text = str(self.get_calendar())
+        return RawCalendar(text=text, content_hash=_hash_content(text.encode('utf-8')))
+
 
 class NetworkEventsProvider(CalendarProvider):
     calendar_url: str
 
-    def __init__(self, calendar_url: str):
+    def __init__(self, calendar_url: str, scheduler: FetchScheduler = None):
+        """The requests go through `scheduler`, by default the one shared by all the providers of the process."""
         if not is_url_valid(calendar_url):
             raise InvalidUrlError(calendar_url)
         self.calendar_url = calendar_url
+        self.scheduler = scheduler or fetch_scheduler
+
+    @property
+    def source_name(self) -> str:
+        return self.calendar_url
 
     def get_calendar(self) -> Calendar:
         """Returns a Calendar object of the icspy module."""
         return Calendar(self._get_ics_file())
 
-    def _get_ics_file(self) -> str:
-        """Returns the string representing the content of an ics file.
-        Raises NoInternetConnectionError, UnknownRequestError"""
-
-        try:
-            response = robust_request(self.calendar_url)
-            if response.status_code != 200:
-                raise InvalidStatusCodeError(f"The ics file request returned a {response.status_code} status code.")
-
-            response = requests.get(self.calendar_url)
-        except requests.ConnectionError as e:
-            logging.error(f"Could not fetch ics file from internet. The connection is probably broken : {e}")
-            raise NoInternetConnectionError()
-        except Exception as e:
-            logging.error(
-                f"Could not fetch ics file from internet : {self.calendar_url}. Error : {type(e).__name__} {e}")
-            raise UnkownRequestError()
-
-        content_type = response.headers["Content-Type"]
+    @contextmanager
+    def _fetch(self, headers: dict = None, stream: bool = False) -> Iterator[requests.Response]:
+        """Requests the ics file through the scheduler.
+        Raises NoInternetConnectionError, UnknownRequestError, CircuitOpenError"""
+        with ExitStack() as stack:
+            try:
+                response = stack.enter_context(self.scheduler.fetch(self.calendar_url, headers=headers, stream=stream))
+            except CircuitOpenError as e:
+                logging.warning(f"Could not fetch ics file from internet : {self.calendar_url}. {e}")
+                raise
+            except requests.ConnectionError as e:
+                logging.error(f"Could not fetch ics file from internet. The connection is probably broken : {e}")
+                raise NoInternetConnectionError()
+            except Exception as e:
+                logging.error(
+                    f"Could not fetch ics file from internet : {self.calendar_url}. Error : {type(e).__name__} {e}")
+                raise UnkownRequestError()
+            yield response
+
+    @staticmethod
+    def _check_response(response: requests.Response):
+        if response.status_code != 200:
+            raise InvalidStatusCodeError(f"The ics file request returned a {response.status_code} status code.")
+        content_type = response.headers.get("Content-Type", "")
         if "html" in content_type.lower():
             raise CalendarNotAvailableError(f"Content type is {content_type}")
 
-        return response.text
+    def _get_ics_file(self) -> str:
+        """Returns the string representing the content of an ics file.
+        Raises NoInternetConnectionError, UnknownRequestError"""
+        with self._fetch() as response:
+            self._check_response(response)
+            return response.text
+
+    def download(self, etag: str = None, last_modified: str = None) -> RawCalendar:
+        """Conditional request : with the validators of the previous download, the server can answer 304."""
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        with self._fetch(headers=headers) as response:
+            if response.status_code == 304:
+                return RawCalendar(text=None, etag=etag, last_modified=last_modified)
+            self._check_response(response)
+            return RawCalendar(text=response.text, content_hash=_hash_content(response.content),
+                               etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'))
+
+    def iter_ics_lines(self) -> Iterator[str]:
+        """Yields the lines of the ics file as they are downloaded.
+        Raises the same errors as `get_calendar`, before yielding the first line."""
+        with self._fetch(stream=True) as response:
+            self._check_response(response)
+            if response.encoding is None:
+                response.encoding = 'utf-8'
+            yield from response.iter_lines(decode_unicode=True)
 
 
 class FileEventsProvider(CalendarProvider):
@@ -63,3 +140,35 @@ class FileEventsProvider(CalendarProvider):
     def __init__(self, file_path, encoding='utf-8'):
         self.file_path = file_path
         self.encoding = encoding
+
+    @property
+    def source_name(self) -> str:
+        return self.file_path
+
+    def iter_ics_lines(self) -> Iterator[str]:
+        with open(self.file_path, "r", encoding=self.encoding) as F:
+            for line in F:
+                yield line.rstrip('\r\n')
+
+    def download(self, etag: str = None, last_modified: str = None) -> RawCalendar:
+        with open(self.file_path, "rb") as F:
+            content = F.read()
+        return RawCalendar(text=content.decode(self.encoding), content_hash=_hash_content(content))
+
+
+class StringEventsProvider(CalendarProvider):
+    """Provides a calendar already downloaded, under the name of its original source."""
+
+    def __init__(self, text: str, source_name: str):
+        self.text = text
+        self._source_name = source_name
+
+    def get_calendar(self) -> Calendar:
+        return Calendar(self.text)
+
+    def iter_ics_lines(self) -> Iterator[str]:
+        yield from self.text.splitlines()
+
+    @property
+    def source_name(self) -> str:
+        return self._source_name
@@ -0,0 +1,65 @@
+"""Shared storage of the string values repeated across events.
+
+In timetable feeds, the same descriptions ('L2 CUPGE\\nL2 Maths...'), locations and titles come back in hundreds of
+events, and the parser creates a new string for each one. A `StringPool` keeps one instance of each value : the events
+of a feed share them. A `TransformCache` remembers the result of a rule action for each input value, so that the same
+title is prefixed once, and the events share the result.
+"""
+import threading
+from typing import Optional, Dict, Callable, Hashable, Tuple
+
+
+class StringPool:
+    """Ex:
+        pool = StringPool()
+        a = pool.intern(''.join(['L2', ' CUPGE']))
+        b = pool.intern('L2 CUPGE')
+        assert a is b
+    """
+
+    def __init__(self):
+        self._values: Dict[str, str] = {}
+        self.hits = 0
+
+    def intern(self, value: Optional[str]) -> Optional[str]:
+        """Returns the pooled instance equal to `value`. Anything else than a string is returned as is."""
+        if type(value) is not str:
+            return value
+        pooled = self._values.setdefault(value, value)
+        if pooled is not value:
+            self.hits += 1
+        return pooled
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def clear(self):
+        self._values.clear()
+
+
+class TransformCache:
+    """Results of pure functions of a string, by (action, input value). Cleared when it holds `max_size` results."""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._results: Dict[Tuple[Hashable, str], str] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def apply(self, action: Hashable, function: Callable[[str], str], value: str) -> str:
+        key = (action, value)
+        result = self._results.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        result = function(value)
+        with self._lock:
+            self.misses += 1
+            if len(self._results) >= self.max_size:
+                self._results.clear()
+            result = self._results.setdefault(key, result)
+        return result
+
+    def __len__(self) -> int:
+        return len(self._results)
@@ -0,0 +1,127 @@
+"""Write-ahead journal of the syncs, to resume a run that died in the middle of its writes.
+
+Before the first write, the whole plan is appended to the journal of the calendar. Each batch acknowledged by google
+is appended after it, and a last record marks the sync as finished. If the process dies in between, the next run
+first applies the changes of the journaled plan that weren't acknowledged, instead of leaving the calendar half
+filled until a full run redoes everything.
+
+Inserted events get ids computed from the plan and their sync key (google accepts client supplied ids) : replaying an
+insert that google already did fails with 409 Conflict instead of creating a duplicate, and counts as done.
+"""
+import hashlib
+import json
+import os
+import re
+import uuid
+from dataclasses import dataclass, replace
+from typing import Optional, Set, List
+
+from googleapiclient.errors import HttpError
+
+from src.sync_plan import SyncPlan, PlannedChange, INSERT, signed_sync_key
+from src.util import STATE_DIRECTORY
+
+PLAN = 'plan'
+ACK = 'ack'
+FINISHED = 'finished'
+
+
+def client_event_id(calendar_id: str, plan_id: str, key: str) -> str:
+    """Google event id of an insert. Ids must use the base32hex alphabet (a-v, 0-9) : hex digits are a subset."""
+    return hashlib.sha1(f'{calendar_id}|{plan_id}|{key}'.encode('utf-8')).hexdigest()
+
+
+def with_client_ids(plan: SyncPlan, plan_id: str) -> SyncPlan:
+    """Returns the plan where each insert has its client event id."""
+    changes = []
+    occurrences = {}
+    for change in plan.changes:
+        if change.action == INSERT:
+            key = signed_sync_key(change.event) or change.event.title
+            # source events sharing a sync key must still get different ids
+            occurrences[key] = occurrences.get(key, 0) + 1
+            key = f'{key}#{occurrences[key]}'
+            change = replace(change, event=replace(change.event,
+                                                   id=client_event_id(plan.calendar_id, plan_id, key)))
+        changes.append(change)
+    return replace(plan, changes=changes)
+
+
+def is_already_done(action: str, exception: Exception) -> bool:
+    """True if the write failed only because a previous attempt already did it."""
+    if not isinstance(exception, HttpError):
+        return False
+    if action == INSERT:
+        return exception.status_code == 409
+    return exception.status_code in (404, 410)
+
+
+@dataclass
+class PendingSync:
+    """A journaled plan whose sync didn't finish."""
+    plan_id: str
+    plan: SyncPlan
+    acknowledged: Set[str]
+
+    def remaining_changes(self) -> List[PlannedChange]:
+        return [change for change in self.plan.changes if change.event.id not in self.acknowledged]
+
+
+class SyncJournal:
+    """One append-only jsonl file per google calendar in `directory`. Each record is flushed to disk before the
+    writes it describes (or after the writes it acknowledges)."""
+
+    def __init__(self, directory: str = os.path.join(STATE_DIRECTORY, 'journals')):
+        self.directory = directory
+
+    def _path(self, calendar_id: str) -> str:
+        return os.path.join(self.directory, re.sub(r'[^A-Za-z0-9._-]', '_', calendar_id) + '.jsonl')
+
+    def _append(self, calendar_id: str, record: dict):
+        with open(self._path(calendar_id), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def begin(self, plan: SyncPlan) -> SyncPlan:
+        """Journals the plan before its writes. Returns it with the client ids of its inserts."""
+        os.makedirs(self.directory, exist_ok=True)
+        plan_id = uuid.uuid4().hex
+        plan = with_client_ids(plan, plan_id)
+        # a new sync starts : the journal of the previous ones is not needed anymore
+        with open(self._path(plan.calendar_id), 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'type': PLAN, 'plan_id': plan_id, 'plan': plan.to_dict()}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        return plan
+
+    def acknowledge(self, calendar_id: str, event_ids: List[str]):
+        """Records that google answered the writes of these events (done, or failed for good)."""
+        if event_ids:
+            self._append(calendar_id, {'type': ACK, 'ids': list(event_ids)})
+
+    def finish(self, calendar_id: str):
+        self._append(calendar_id, {'type': FINISHED})
+
+    def pending(self, calendar_id: str) -> Optional[PendingSync]:
+        """Returns the journaled sync of the calendar if it didn't finish, else None."""
+        try:
+            with open(self._path(calendar_id), 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return None
+
+        pending = None
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the process died while writing this line : the writes it described weren't acknowledged
+                break
+            if record['type'] == PLAN:
+                pending = PendingSync(record['plan_id'], SyncPlan.from_dict(record['plan']), set())
+            elif record['type'] == ACK and pending is not None:
+                pending.acknowledged.update(record['ids'])
+            elif record['type'] == FINISHED:
+                pending = None
+        return pending
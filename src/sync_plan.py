@@ -0,0 +1,208 @@
+"""Sync plans: the changes a KalWorker run will make to a google calendar, computed without touching it."""
+import json
+from dataclasses import dataclass, field, replace
+from datetime import datetime
+from typing import List, Dict, Optional
+
+import pytz
+
+from src.event import Event
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+
+# Fields compared between a wanted event and its copy in the google calendar, to decide if it needs an update.
+COMPARED_FIELDS = ('title', 'description', 'location', 'start', 'end', 'color')
+
+
+@dataclass
+class RuleOutcome:
+    """The result of applying the rules to one source event.
+    `result` is None if a rule removed the event. `rules` are the labels of the rules that matched."""
+    source: Event
+    result: Optional[Event]
+    rules: List[str] = field(default_factory=list)
+
+
+@dataclass
+class PlannedChange:
+    action: str
+    event: Event
+    reason: str
+    rules: List[str] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {
+            'action': self.action,
+            'reason': self.reason,
+            'rules': list(self.rules),
+            'event': self.event.to_dict(),
+        }
+
+    @staticmethod
+    def from_dict(d: dict) -> 'PlannedChange':
+        return PlannedChange(action=d['action'], event=Event.from_dict(d['event']), reason=d['reason'],
+                             rules=list(d.get('rules', [])))
+
+
+@dataclass
+class SyncPlan:
+    """All the inserts, updates and deletes needed to bring a google calendar in line with its source."""
+    calendar_id: str
+    separation_date: datetime
+    changes: List[PlannedChange] = field(default_factory=list)
+
+    def _with_action(self, action: str) -> List[PlannedChange]:
+        return [change for change in self.changes if change.action == action]
+
+    @property
+    def inserts(self) -> List[PlannedChange]:
+        return self._with_action(INSERT)
+
+    @property
+    def updates(self) -> List[PlannedChange]:
+        return self._with_action(UPDATE)
+
+    @property
+    def deletes(self) -> List[PlannedChange]:
+        return self._with_action(DELETE)
+
+    def is_empty(self) -> bool:
+        return not self.changes
+
+    def summary(self) -> str:
+        return f"{len(self.inserts)} inserts, {len(self.updates)} updates, {len(self.deletes)} deletes"
+
+    def to_dict(self) -> dict:
+        return {
+            'calendar_id': self.calendar_id,
+            'separation_date': self.separation_date.isoformat(),
+            'changes': [change.to_dict() for change in self.changes],
+        }
+
+    @staticmethod
+    def from_dict(d: dict) -> 'SyncPlan':
+        return SyncPlan(calendar_id=d['calendar_id'],
+                        separation_date=datetime.fromisoformat(d['separation_date']),
+                        changes=[PlannedChange.from_dict(c) for c in d['changes']])
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), ensure_ascii=False, **kwargs)
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.to_json(indent=2))
+
+    @staticmethod
+    def load(path: str) -> 'SyncPlan':
+        with open(path, 'r', encoding='utf-8') as f:
+            return SyncPlan.from_dict(json.load(f))
+
+
+def dump_events(events: List[Event], path: str):
+    """Saves events as json, e.g. to keep a snapshot of a google calendar for offline planning."""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump([event.to_dict() for event in events], f, ensure_ascii=False, indent=2)
+
+
+def load_events(path: str) -> List[Event]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [Event.from_dict(d) for d in json.load(f)]
+
+
+def sync_key(event: Event) -> str:
+    """Identifies a source event across runs : its ics UID, or its title and times if it has none."""
+    if event.uid:
+        return event.uid
+    start = event.start.astimezone(pytz.utc).isoformat() if event.start else ''
+    end = event.end.astimezone(pytz.utc).isoformat() if event.end else ''
+    return f'{event.title}|{start}|{end}'
+
+
+def signed_sync_key(event: Event) -> Optional[str]:
+    """Returns the sync key stored in the kal signature of the event, or None."""
+    properties = event.extended_properties or {}
+    return properties.get('private', {}).get('kal_key')
+
+
+def changed_fields(wanted: Event, current: Event) -> List[str]:
+    """Returns the names of the compared fields that differ between the two events."""
+    changed = []
+    for name in COMPARED_FIELDS:
+        a, b = getattr(wanted, name), getattr(current, name)
+        if name in ('start', 'end'):
+            if a is not None and b is not None:
+                a, b = a.astimezone(pytz.utc), b.astimezone(pytz.utc)
+        elif name != 'color':
+            a, b = a or '', b or ''
+        if a != b:
+            changed.append(name)
+    return changed
+
+
+class SyncPlanner:
+    """Incremental version of `compute_sync_plan`, for outcomes that arrive in chunks (see src/pipeline.py).
+
+    `add` returns the inserts and updates of a chunk right away. The deletes are only known once the whole source
+    has been seen : they are returned by `finish`."""
+
+    def __init__(self, remote_events: List[Event], separation_date: datetime, until: datetime = None):
+        separation_utc = separation_date.astimezone(pytz.utc)
+        until_utc = until.astimezone(pytz.utc) if until is not None else None
+        self.remote_by_key: Dict[Optional[str], List[Event]] = {}
+        for event in remote_events:
+            start = event.start.astimezone(pytz.utc)
+            if start <= separation_utc or (until_utc is not None and start > until_utc):
+                continue
+            self.remote_by_key.setdefault(signed_sync_key(event), []).append(event)
+        self.removed_by = {}
+
+    def add(self, outcomes: List[RuleOutcome]) -> List[PlannedChange]:
+        changes = []
+        for outcome in outcomes:
+            if outcome.result is None:
+                self.removed_by[sync_key(outcome.source)] = outcome.rules
+                continue
+
+            candidates = self.remote_by_key.get(signed_sync_key(outcome.result))
+            if not candidates:
+                changes.append(PlannedChange(INSERT, outcome.result, 'new in the source calendar', outcome.rules))
+                continue
+
+            current = candidates.pop()
+            changed = changed_fields(outcome.result, current)
+            if changed:
+                changes.append(PlannedChange(UPDATE, replace(outcome.result, id=current.id),
+                                             f"changed: {', '.join(changed)}", outcome.rules))
+        return changes
+
+    def finish(self) -> List[PlannedChange]:
+        """Returns the deletes of the remote events that no outcome matched."""
+        changes = []
+        for key, events in self.remote_by_key.items():
+            for event in events:
+                if key is None:
+                    reason = 'signed by a previous version of kal'
+                    rules = []
+                elif key in self.removed_by:
+                    rules = self.removed_by[key]
+                    reason = f"removed by {', '.join(rules)}"
+                else:
+                    reason = 'no longer in the source calendar'
+                    rules = []
+                changes.append(PlannedChange(DELETE, event, reason, rules))
+        self.remote_by_key = {}
+        return changes
+
+
+def compute_sync_plan(calendar_id: str, remote_events: List[Event], outcomes: List[RuleOutcome],
+                      separation_date: datetime, until: datetime = None) -> SyncPlan:
+    """Diffs the kal-signed events of the google calendar against the signed results of the rules.
+
+    Events starting before `separation_date` are never touched, nor events starting after `until` if it is given.
+    Remote events are matched to the wanted events by the sync key of their kal signature."""
+    planner = SyncPlanner(remote_events, separation_date, until)
+    changes = planner.add(outcomes)
+    changes += planner.finish()
+    return SyncPlan(calendar_id=calendar_id, separation_date=separation_date, changes=changes)
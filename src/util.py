@@ -2,9 +2,8 @@ import re
 from typing import TypeVar, List, Iterable
 
 
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+# Where kal keeps its state between runs : snapshots, caches...
+STATE_DIRECTORY = 'kal_state'
 
 url_validation_regexp = re.compile(
         r'^(?:http|ftp)s?://' # http:// or https://
@@ -27,12 +26,3 @@ def group_elements_by(n: int, elements: List[T]) -> Iterable[List[T]]:
         yield elements[n * i:n * (i + 1)]
     yield elements[k * n:]
 
-
-def robust_request(url) -> requests.Response:
-    s = requests.Session()
-    retries = Retry(total=5,
-                    backoff_factor=0.1,
-                    status_forcelist=[500, 502, 503, 504])
-
-    s.mount("https://", HTTPAdapter(max_retries=retries))
-    return s.get(url)
@@ -0,0 +1,331 @@
+"""Push triggers : google notifies kal when a target calendar changes, instead of kal polling it.
+
+`WatchRegistry` registers `events().watch` channels on the google calendars of the mirrors. Google then posts a
+notification to `NotificationReceiver`, a small http server, each time an event of the calendar changes (e.g. someone
+edited or deleted a kal event by hand). Notifications are debounced, then a sync job of the affected mirrors is
+enqueued (see src/job_queue.py), asking the worker to revalidate the calendar instead of trusting its snapshot.
+
+Kal's own writes also trigger notifications. The workers note the events they write in an `OwnWriteLog`. When
+notifications come in the `self_write_window` seconds after kal wrote to a calendar, the receiver lists the events
+changed since : if they are all in the state kal left them in, the notifications are ignored.
+See https://developers.google.com/calendar/api/guides/push
+"""
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+import sqlite3
+import uuid
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Callable, Optional, Tuple
+
+import pytz
+
+from src.event import Event
+from src.job_queue import JobQueue
+from src.mirror import Mirror
+from src.util import STATE_DIRECTORY
+
+# Payload of the jobs enqueued by notifications
+PUSH_PAYLOAD = {'trigger': 'push', 'revalidate': True}
+
+
+@dataclass
+class WatchChannel:
+    id: str
+    calendar_id: str
+    resource_id: str
+    token: str
+    expiration: float  # epoch seconds
+
+    def expires_within(self, seconds: float) -> bool:
+        return self.expiration - time.time() < seconds
+
+
+class WatchRegistry:
+    """Keeps one watch channel per google calendar, saved in a json file to be stopped or renewed by later runs."""
+
+    def __init__(self, address: str, path: str = os.path.join(STATE_DIRECTORY, 'watch_channels.json'),
+                 ttl: int = 7 * 24 * 3600):
+        """`address` is the public https url of the NotificationReceiver. `ttl` is the requested channel lifetime,
+        in seconds : google may shorten it."""
+        self.address = address
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.channels: Dict[str, WatchChannel] = self._load()
+
+    def _load(self) -> Dict[str, WatchChannel]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return {d['id']: WatchChannel(**d) for d in json.load(f)}
+        except (OSError, ValueError, TypeError, KeyError):
+            return {}
+
+    def _save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump([asdict(channel) for channel in self.channels.values()], f)
+        os.replace(tmp_path, self.path)
+
+    def channel_for(self, calendar_id: str) -> Optional[WatchChannel]:
+        with self._lock:
+            return next((c for c in self.channels.values() if c.calendar_id == calendar_id), None)
+
+    def get(self, channel_id: str) -> Optional[WatchChannel]:
+        with self._lock:
+            return self.channels.get(channel_id)
+
+    def watch(self, service, calendar_id: str, renew_margin: float = 24 * 3600) -> WatchChannel:
+        """Registers a channel on the calendar, unless it already has one valid for more than `renew_margin` seconds.
+        The previous channel of the calendar is stopped."""
+        current = self.channel_for(calendar_id)
+        if current is not None and not current.expires_within(renew_margin):
+            return current
+
+        body = {
+            'id': str(uuid.uuid4()),
+            'type': 'web_hook',
+            'address': self.address,
+            'token': secrets.token_urlsafe(16),
+            'params': {'ttl': str(self.ttl)},
+        }
+        response = service.events().watch(calendarId=calendar_id, body=body).execute()
+        # google answers the expiration in milliseconds
+        expiration = int(response.get('expiration', (time.time() + self.ttl) * 1000)) / 1000
+        channel = WatchChannel(id=body['id'], calendar_id=calendar_id, resource_id=response['resourceId'],
+                               token=body['token'], expiration=expiration)
+        with self._lock:
+            self.channels[channel.id] = channel
+            self._save()
+        if current is not None:
+            self.stop(service, current)
+        logging.info(f"Watching {calendar_id} with channel {channel.id}")
+        return channel
+
+    def stop(self, service, channel: WatchChannel):
+        try:
+            service.channels().stop(body={'id': channel.id, 'resourceId': channel.resource_id}).execute()
+        except Exception as e:
+            # expired channels can't be stopped, and die anyway
+            logging.warning(f"Could not stop channel {channel.id} : {type(e).__name__} {e}")
+        with self._lock:
+            self.channels.pop(channel.id, None)
+            self._save()
+
+
+class OwnWriteLog:
+    """Remembers the events kal wrote to each google calendar, with the `updated` date google gave them, in a SQLite
+    file shared by the workers and the receiver. Any later edit of an event changes its `updated` date."""
+
+    def __init__(self, path: str = os.path.join(STATE_DIRECTORY, 'own_writes.sqlite'), max_age: float = 3600):
+        """Writes older than `max_age` seconds are forgotten."""
+        self.path = path
+        self.max_age = max_age
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = self._connect()
+        try:
+            connection.execute('''CREATE TABLE IF NOT EXISTS own_writes (
+                calendar_id TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                updated TEXT,
+                deleted INTEGER NOT NULL,
+                written_at REAL NOT NULL,
+                PRIMARY KEY (calendar_id, event_id)
+            )''')
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def note(self, calendar_id: str, deleted_ids: List[str], written: List[Event], at: float = None):
+        """Records the events kal deleted, and the inserted or updated events as google returned them."""
+        at = at if at is not None else time.time()
+        rows = [(calendar_id, event_id, None, 1, at) for event_id in deleted_ids]
+        rows += [(calendar_id, event.id, event.updated.isoformat() if event.updated is not None else None, 0, at)
+                 for event in written]
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('INSERT OR REPLACE INTO own_writes VALUES (?, ?, ?, ?, ?)', rows)
+            connection.execute('DELETE FROM own_writes WHERE written_at < ?', (at - self.max_age,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+
+    def writes_since(self, calendar_id: str, since: float) -> Dict[str, Tuple[bool, Optional[datetime]]]:
+        """The events kal wrote to the calendar since `since` (epoch seconds) : (deleted, updated) by event id."""
+        connection = self._connect()
+        try:
+            rows = connection.execute('SELECT event_id, deleted, updated FROM own_writes '
+                                      'WHERE calendar_id = ? AND written_at >= ?', (calendar_id, since)).fetchall()
+        finally:
+            connection.close()
+        return {event_id: (bool(deleted), datetime.fromisoformat(updated) if updated is not None else None)
+                for event_id, deleted, updated in rows}
+
+
+def is_own_change(item: dict, own_writes: Dict[str, Tuple[bool, Optional[datetime]]]) -> bool:
+    """True if the changed event `item` (listed from google) is in the state kal left it in."""
+    if item['id'] not in own_writes:
+        return False
+    deleted, updated = own_writes[item['id']]
+    if deleted:
+        return item.get('status') == 'cancelled'
+    if updated is None or item.get('status') == 'cancelled':
+        return False
+    try:
+        return datetime.fromisoformat(item['updated']) == updated
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def changed_events(service, calendar_id: str, since: float) -> List[dict]:
+    """The events of the calendar changed since `since` (epoch seconds), deleted ones included."""
+    events = service.events()
+    request = events.list(calendarId=calendar_id, updatedMin=datetime.fromtimestamp(since, pytz.utc).isoformat(),
+                          showDeleted=True, fields='nextPageToken,items(id,status,updated)')
+    items = []
+    while request is not None:
+        response = request.execute()
+        items += response.get('items', [])
+        request = events.list_next(request, response)
+    return items
+
+
+class Debouncer:
+    """Calls `callback(key)` once `delay` seconds have passed without a new `trigger(key)`."""
+
+    def __init__(self, delay: float, callback: Callable[[str], None]):
+        self.delay = delay
+        self.callback = callback
+        self._timers: Dict[str, threading.Timer] = {}
+        self._lock = threading.Lock()
+
+    def trigger(self, key: str):
+        with self._lock:
+            if key in self._timers:
+                self._timers[key].cancel()
+            timer = threading.Timer(self.delay, self._fire, args=(key,))
+            timer.daemon = True
+            self._timers[key] = timer
+            timer.start()
+
+    def _fire(self, key: str):
+        with self._lock:
+            self._timers.pop(key, None)
+        try:
+            self.callback(key)
+        except Exception as e:
+            logging.error(f"Debounced callback failed for {key} : {type(e).__name__} {e}")
+
+    def cancel_all(self):
+        with self._lock:
+            for timer in self._timers.values():
+                timer.cancel()
+            self._timers.clear()
+
+
+class NotificationReceiver:
+    """Http server receiving the notifications of the watch channels, and enqueueing syncs of the affected mirrors.
+
+    Ex:
+        receiver = NotificationReceiver(registry, mirrors, queue, port=8080)
+        receiver.start()
+    """
+
+    def __init__(self, registry: WatchRegistry, mirrors: List[Mirror], queue: JobQueue, host: str = '0.0.0.0',
+                 port: int = 8080, debounce: float = 10.0, own_writes: OwnWriteLog = None,
+                 get_service: Callable[[Mirror], object] = None, self_write_window: float = 60.0):
+        """With `own_writes` and `get_service` (the google service of a mirror), notifications coming within
+        `self_write_window` seconds of kal's writes are ignored if only kal's writes changed the calendar."""
+        self.registry = registry
+        self.queue = queue
+        self.own_writes = own_writes
+        self.get_service = get_service
+        self.self_write_window = self_write_window
+        self.mirrors_by_calendar: Dict[str, List[Mirror]] = {}
+        for mirror in mirrors:
+            self.mirrors_by_calendar.setdefault(mirror.google_calendar_id, []).append(mirror)
+        self.debouncer = Debouncer(debounce, self._enqueue_syncs)
+        self.server = ThreadingHTTPServer((host, port), self._make_request_handler())
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def _only_own_writes(self, calendar_id: str) -> bool:
+        """True if kal wrote to the calendar recently, and nobody else changed it since."""
+        mirrors = self.mirrors_by_calendar.get(calendar_id)
+        if self.own_writes is None or self.get_service is None or not mirrors:
+            return False
+        since = time.time() - self.self_write_window
+        own_writes = self.own_writes.writes_since(calendar_id, since)
+        if not own_writes:
+            return False
+        try:
+            # the notifications were debounced : list the changes they may come from
+            changes = changed_events(self.get_service(mirrors[0]), calendar_id, since - self.debouncer.delay)
+        except Exception as e:
+            logging.warning(f"Could not list the changes of {calendar_id} : {type(e).__name__} {e}")
+            return False
+        return all(is_own_change(item, own_writes) for item in changes)
+
+    def _enqueue_syncs(self, calendar_id: str):
+        # checked once debounced : the notifications of a run come while it writes, before its writes are noted
+        if self._only_own_writes(calendar_id):
+            logging.debug(f"{calendar_id} only changed by kal's writes : ignoring the notifications")
+            return
+        for mirror in self.mirrors_by_calendar.get(calendar_id, []):
+            logging.info(f"{calendar_id} changed : enqueueing a sync of {mirror.title}")
+            self.queue.enqueue(mirror.title, mirror.google_calendar_id, payload=PUSH_PAYLOAD)
+
+    def handle_notification(self, headers) -> int:
+        """Returns the http status to answer."""
+        channel = self.registry.get(headers.get('X-Goog-Channel-ID', ''))
+        if channel is None or headers.get('X-Goog-Channel-Token') != channel.token:
+            return 404
+        # 'sync' is sent once when the channel is created, 'exists' and 'not_exists' when events change
+        if headers.get('X-Goog-Resource-State') != 'sync':
+            self.debouncer.trigger(channel.calendar_id)
+        return 200
+
+    def _make_request_handler(self):
+        receiver = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                self.send_response(receiver.handle_notification(self.headers))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logging.debug(f"Notification receiver : {format % args}")
+
+        return RequestHandler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='kal-notifications', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.debouncer.cancel_all()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from src.adaptive_polling import AdaptivePoller, source_key, calendar_key
+from src.change_detection import SyncRecordStore
+from src.fake_google_service import FakeGoogleService
+from src.kal_worker import KalWorker
+from src.mirror import Mirror
+from src.source_calendar.ics_calendar_provider import FileEventsProvider
+from tests.test_pipeline import write_ics
+
+now = datetime(2021, 9, 13, 7, 0)
+
+
+class TestAdaptivePolling(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.poller = AdaptivePoller(min_interval=timedelta(minutes=5), max_interval=timedelta(minutes=30),
+                                     hot_interval=timedelta(minutes=10), hot_threshold=2,
+                                     path=os.path.join(self.directory, 'poll_history.sqlite'))
+
+    def test_stable_keys_back_off(self):
+        for _ in range(4):
+            self.poller.observe('key', False, now)
+        self.assertEqual(self.poller.next_poll('key'), now + timedelta(minutes=30))
+        self.poller.observe('key', True, now)
+        self.assertEqual(self.poller.next_poll('key'), now + timedelta(minutes=5))
+        self.assertIsNone(self.poller.next_poll('unknown'))
+
+    def test_usual_change_hours_are_polled_sooner(self):
+        for day in range(2):
+            self.poller.observe('key', True, now - timedelta(days=day + 1) + timedelta(minutes=20))
+        for _ in range(4):
+            self.poller.observe('key', False, now)
+        # the key usually changes around 7:20
+        self.assertEqual(self.poller.next_poll('key'), now + timedelta(minutes=10))
+
+        self.poller.observe('key', False, now + timedelta(hours=3))
+        self.assertEqual(self.poller.next_poll('key'), now + timedelta(hours=3, minutes=30))
+
+    def test_mirror_is_due_when_one_of_its_keys_is(self):
+        mirror = Mirror('L2', ['https://example.com/a.ics', 'https://example.com/b.ics'], 'calendar', [])
+        self.assertTrue(self.poller.is_due(mirror, now))
+        for key in (source_key('https://example.com/a.ics'), source_key('https://example.com/b.ics'),
+                    calendar_key('calendar')):
+            self.poller.observe(key, False, now)
+        self.assertFalse(self.poller.is_due(mirror, now + timedelta(minutes=9)))
+        self.assertEqual(self.poller.due_mirrors([mirror], now + timedelta(minutes=10)), [mirror])
+
+        poller = AdaptivePoller(path=self.poller.path)
+        self.assertEqual(poller.histories, self.poller.histories)
+
+    def test_processes_share_the_histories(self):
+        # e.g. the scheduler and a job worker
+        other = AdaptivePoller(min_interval=timedelta(minutes=5), max_interval=timedelta(minutes=30),
+                               path=self.poller.path)
+        self.poller.observe('key', False, now)
+        other.observe('key', False, now)
+        other.observe('other key', True, now)
+        self.assertEqual(self.poller.next_poll('key'), now + timedelta(minutes=20))
+        self.assertEqual(set(self.poller.histories), {'key', 'other key'})
+
+    def test_worker_records_changes(self):
+        path = os.path.join(self.directory, 'cal.ics')
+        write_ics(path, [f'HAX{i}' for i in range(10)])
+        worker = KalWorker(source_ics_calendar_url=path, google_calendar_id='calendar', rules=[],
+                           provider=FileEventsProvider(path), poller=self.poller,
+                           sync_record_store=SyncRecordStore(os.path.join(self.directory, 'records')))
+        service = FakeGoogleService()
+        worker.run(service)
+        self.assertEqual(len(self.poller.histories[source_key(path)].changes), 1)
+        self.assertEqual(len(self.poller.histories[calendar_key('calendar')].changes), 1)
+
+        self.assertIsNone(worker.run(service))
+        for key in (source_key(path), calendar_key('calendar')):
+            self.assertEqual(self.poller.histories[key].interval, 600)
+            self.assertEqual(len(self.poller.histories[key].changes), 1)
@@ -0,0 +1,65 @@
+import unittest
+from datetime import datetime, timedelta
+
+import pytz
+
+from src.batch_controller import AdaptiveBatchController, BatchReport
+from src.event import Event
+from src.google_calendar_handler import GoogleCalendarHandler
+from src.fake_google_service import FakeGoogleService
+
+start = datetime(2030, 1, 7, 8, tzinfo=pytz.utc)
+events = [Event(title=f"HAX{i}", start=start + timedelta(hours=i), end=start + timedelta(hours=i, minutes=30))
+          for i in range(200)]
+
+
+class TestAdaptiveBatchController(unittest.TestCase):
+
+    def test_ramps_up_size_then_concurrency(self):
+        controller = AdaptiveBatchController(initial_size=40, max_concurrency=3)
+        for _ in range(2):
+            controller.record(BatchReport(size=controller.batch_size, latency=0.1))
+        self.assertEqual((controller.batch_size, controller.concurrency), (50, 1))
+        for _ in range(5):
+            controller.record(BatchReport(size=controller.batch_size, latency=0.1))
+        self.assertEqual((controller.batch_size, controller.concurrency), (50, 3))
+
+    def test_backs_off_on_throttling(self):
+        controller = AdaptiveBatchController(initial_concurrency=4, backoff=0)
+        controller.record(BatchReport(size=50, latency=0.1, throttled=3))
+        self.assertEqual((controller.batch_size, controller.concurrency), (25, 2))
+        self.assertEqual(controller.settings()['throttled_batches'], 1)
+
+    def test_slow_or_failing_batches_shrink(self):
+        controller = AdaptiveBatchController(target_latency=1)
+        controller.record(BatchReport(size=50, latency=3))
+        controller.record(BatchReport(size=45, latency=0.1, errors=10))
+        self.assertEqual(controller.batch_size, 40)
+
+    def test_invalid_limits(self):
+        with self.assertRaises(ValueError):
+            AdaptiveBatchController(max_size=100)
+
+
+class TestAdaptiveHandler(unittest.TestCase):
+
+    def test_concurrent_batches_insert_everything(self):
+        service = FakeGoogleService()
+        controller = AdaptiveBatchController(initial_size=45, max_concurrency=4)
+        handler = GoogleCalendarHandler('calendar', service, batch_controller=controller,
+                                        service_factory=lambda: service)
+        result = handler.insert_events(events)
+        self.assertEqual(len(result.done), 200)
+        self.assertEqual(result.failed, [])
+        self.assertGreater(controller.concurrency, 1)
+        self.assertEqual(max(service.batch_sizes), 50)
+
+    def test_throttled_writes_are_sent_again(self):
+        service = FakeGoogleService()
+        service.throttle(5)
+        controller = AdaptiveBatchController(backoff=0)
+        handler = GoogleCalendarHandler('calendar', service, batch_controller=controller)
+        result = handler.insert_events(events[:20])
+        self.assertEqual(len(result.done), 20)
+        self.assertEqual(len(service.calendars['calendar']), 20)
+        self.assertEqual(controller.batch_size, 25)
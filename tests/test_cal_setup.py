@@ -0,0 +1,69 @@
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from src.cal_setup import CalendarServiceCache
+
+
+class FakeCredentials:
+    def __init__(self, expiry=None):
+        self.expiry = expiry or datetime.utcnow() + timedelta(hours=1)
+        self.valid = True
+        self.refresh_token = 'refresh'
+        self.refreshes = 0
+
+    def refresh(self, request):
+        self.refreshes += 1
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+
+
+class TestCalendarServiceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.loaded = []
+
+        def load_credentials(name):
+            self.loaded.append(name)
+            return FakeCredentials()
+
+        for target, replacement in [('load_credentials', load_credentials),
+                                    ('build', lambda *args, **kwargs: object()),
+                                    ('AuthorizedHttp', lambda creds, http: (creds, http)),
+                                    ('_save_credentials', lambda name, creds: None),
+                                    ('Request', lambda: None)]:
+            patcher = mock.patch(f'src.cal_setup.{target}', replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.cache = CalendarServiceCache()
+
+    def test_credentials_are_loaded_once_per_account(self):
+        creds = self.cache.get_credentials('L2')
+        self.assertIs(self.cache.get_credentials('L2'), creds)
+        self.assertIsNot(self.cache.get_credentials('L3'), creds)
+        self.assertEqual(self.loaded, ['L2', 'L3'])
+
+    def test_credentials_are_refreshed_before_expiry(self):
+        creds = self.cache.get_credentials('L2')
+        creds.expiry = datetime.utcnow() + timedelta(minutes=1)
+        self.assertIs(self.cache.get_credentials('L2'), creds)
+        self.assertEqual(creds.refreshes, 1)
+        self.assertEqual(self.loaded, ['L2'])
+
+    def test_one_service_per_thread(self):
+        service = self.cache.get_service('L2')
+        self.assertIs(self.cache.get_service('L2'), service)
+
+        other_services = []
+        thread = threading.Thread(target=lambda: other_services.append(self.cache.get_service('L2')))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other_services[0], service)
+        # the credentials are shared by the threads
+        self.assertEqual(self.loaded, ['L2'])
+
+    def test_invalidate_rebuilds_the_services(self):
+        service = self.cache.get_service('L2')
+        self.cache.invalidate('L2')
+        self.assertIsNot(self.cache.get_service('L2'), service)
+        self.assertEqual(self.loaded, ['L2', 'L2'])
@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+
+from src.change_detection import SyncRecordStore
+from src.event_colors import EventColor
+from src.event_rules import Condition, Rule
+from src.kal_worker import KalWorker
+from src.source_calendar.ics_calendar_provider import FileEventsProvider
+from src.fake_google_service import FakeGoogleService
+from tests.test_pipeline import write_ics
+
+
+def make_rules(color=EventColor.TOMATO):
+    return [Rule().change_color(color).on(Condition().field('title').contains('301'))]
+
+
+class TestChangeDetection(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, 'cal.ics')
+        write_ics(self.path, ['HAX301X', 'HAI501I'])
+        self.store = SyncRecordStore(os.path.join(directory, 'records'))
+        self.service = FakeGoogleService()
+
+    def run_worker(self, rules=None, pipelined=False):
+        worker = KalWorker(source_ics_calendar_url=self.path, google_calendar_id='calendar',
+                           rules=rules or make_rules(), provider=FileEventsProvider(self.path),
+                           sync_record_store=self.store)
+        return worker.run_pipelined(self.service) if pipelined else worker.run(self.service)
+
+    def test_unchanged_run_is_skipped(self):
+        self.assertEqual(len(self.run_worker().inserts), 2)
+        batches = self.service.batches
+        self.assertIsNone(self.run_worker())
+        self.assertIsNone(self.run_worker(pipelined=True))
+        self.assertEqual(self.service.batches, batches)
+
+    def test_source_or_rules_changes_run(self):
+        self.run_worker()
+        self.assertEqual(len(self.run_worker(make_rules(EventColor.BASIL)).updates), 1)
+        self.assertIsNone(self.run_worker(make_rules(EventColor.BASIL)))
+
+        write_ics(self.path, ['HAX301X', 'HAI501I', 'HAI502I'])
+        self.assertEqual(len(self.run_worker(make_rules(EventColor.BASIL), pipelined=True).inserts), 1)
+
+    def test_rules_without_spec_always_run(self):
+        rules = [Rule().remove_event().on(Condition().overlaps_another_event())]
+        self.run_worker(rules)
+        self.assertIsNotNone(self.run_worker(rules))
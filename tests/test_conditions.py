@@ -121,5 +121,46 @@ class TestConditions(unittest.TestCase):
     def test_str_conditions_on_no_str_fields(self):
         """Using 'contains', 'startswith', ... methods on no-str fields should raise TypeError"""
         for field in ('start', 'end', 'updated', 'color'):
-            for method in ('contains', 'starts_with', 'ends_with', 'equals'):
+            for method in ('contains', 'starts_with', 'ends_with', 'equals', 'matches'):
                 self.assertRaises(TypeError, lambda: Condition().field(field).__getattribute__(method)("2021"))
+            self.assertRaises(TypeError, lambda: Condition().field(field).contains_any(["2021"]))
+
+    def test_contains_any(self):
+        event = Event(title="Annual meeting", description="Sales report", location="San Francisco")
+        condition = Condition().field('title').contains_any(['budget', 'meeting'])
+        self.assertTrue(condition.evaluate(event))
+        condition = Condition().field('title').contains_any(['budget', 'MEETING'])
+        self.assertFalse(condition.evaluate(event))
+        condition = Condition().field('title').contains_any(['budget', 'MEETING'], case_sensitive=False)
+        self.assertTrue(condition.evaluate(event))
+        condition = Condition().field('title').contains_any(['a.n'])
+        self.assertFalse(condition.evaluate(event))
+        condition = Condition().field('title').contains_any([])
+        self.assertFalse(condition.evaluate(event))
+        condition = Condition().field('title').contains_any(['meeting'])
+        self.assertFalse(condition.evaluate(Event()))
+
+    def test_matches(self):
+        event = Event(title="HAX301X Cours", description="Sales report", location="San Francisco")
+        condition = Condition().field('title').matches(r'HA[IX]3\d\dX')
+        self.assertTrue(condition.evaluate(event))
+        condition = Condition().field('title').matches(r'^hax301x')
+        self.assertFalse(condition.evaluate(event))
+        condition = Condition().field('title').matches(r'^hax301x', case_sensitive=False)
+        self.assertTrue(condition.evaluate(event))
+        condition = Condition().field('title').matches(r'.')
+        self.assertFalse(condition.evaluate(Event()))
+
+    def test_merged_or_chains(self):
+        """OR-chains of contains are merged, and still give the same results"""
+        conditions = [Condition().field('title').contains('HAX503X', case_sensitive=False),
+                      Condition().field('title').contains('HAX505X', case_sensitive=False),
+                      Condition().field('location').contains('Amphi')]
+        condition = Condition().logical_any(conditions)
+        self.assertTrue(condition.evaluate(Event(title="hax505x")))
+        self.assertTrue(condition.evaluate(Event(title="HAX401X", location="Amphi 5")))
+        self.assertFalse(condition.evaluate(Event(title="HAX401X", location="Salle 5")))
+
+        condition = Condition().logical_or(conditions[0], conditions[1])
+        self.assertTrue(condition.evaluate(Event(title="HAX503X")))
+        self.assertFalse(condition.evaluate(Event(title="HAX501X")))
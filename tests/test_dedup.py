@@ -0,0 +1,34 @@
+import unittest
+from datetime import datetime, timedelta
+
+import pytz
+
+from src.dedup import deduplicate_events, UID_KEY
+from src.event import Event
+
+start = datetime(2021, 9, 17, 13, 15, tzinfo=pytz.utc)
+end = start + timedelta(hours=1, minutes=30)
+
+group_a = Event(uid='a', title="HAX301X", description="L2 CUPGE\nAlgèbre III", location="Amphi 5.02",
+                start=start, end=end)
+group_b = Event(uid='b', title="HAX301X", description="L2 Maths\nAlgèbre III", location="Amphi 5.02",
+                start=start.astimezone(pytz.timezone('Europe/Paris')), end=end)
+other = Event(uid='a', title="HAX302X", location="Amphi 5.02", start=start, end=end)
+
+
+class TestDedup(unittest.TestCase):
+
+    def test_content_key(self):
+        self.assertEqual(deduplicate_events([group_a, group_b, other]), [group_a, other])
+
+    def test_uid_key(self):
+        self.assertEqual(deduplicate_events([group_a, group_b, other], key=UID_KEY), [group_a, group_b])
+
+    def test_custom_key(self):
+        self.assertEqual(deduplicate_events([group_a, group_b, other], key=['location']), [group_a])
+
+    def test_merge_descriptions(self):
+        merged = deduplicate_events([group_a, group_b, other], merge_descriptions=True)
+        self.assertEqual(merged[0].description, "L2 CUPGE\nAlgèbre III\nL2 Maths")
+        self.assertEqual(merged[0].uid, 'a')
+        self.assertIs(merged[1], other)
@@ -0,0 +1,161 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from src.exceptions import CircuitOpenError, InvalidStatusCodeError
+from src.source_calendar.fetch_scheduler import FetchScheduler, HostPolicy
+from src.source_calendar.ics_calendar_provider import NetworkEventsProvider
+
+ICS = 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:test\r\nEND:VCALENDAR'
+
+
+class IcsServer:
+    """Answers the statuses queued in `statuses` (200 when empty), and counts the requests."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.statuses = []
+        self.requests = 0
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server.lock:
+                    server.requests += 1
+                    server.running += 1
+                    server.max_running = max(server.max_running, server.running)
+                    status = server.statuses.pop(0) if server.statuses else 200
+                time.sleep(server.delay)
+                body = ICS.encode('utf-8') if status == 200 else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/calendar')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with server.lock:
+                    server.running -= 1
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def url(self, host='127.0.0.1'):
+        return f'http://{host}:{self.httpd.server_address[1]}/calendar.ics'
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestFetchScheduler(unittest.TestCase):
+
+    def make_server(self, delay=0.0):
+        server = IcsServer(delay)
+        self.addCleanup(server.close)
+        return server
+
+    def test_concurrency_is_limited_per_host(self):
+        server = self.make_server(delay=0.1)
+        scheduler = FetchScheduler(HostPolicy(max_concurrency=2))
+
+        def fetch(_):
+            with scheduler.fetch(server.url()) as response:
+                return response.status_code
+
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            self.assertEqual(list(executor.map(fetch, range(6))), [200] * 6)
+        self.assertEqual(server.max_running, 2)
+
+    def test_retries_share_the_budget_of_the_host(self):
+        server = self.make_server()
+        scheduler = FetchScheduler(HostPolicy(backoff=0.01, retry_budget=1, retry_refill=0, failure_threshold=10))
+        server.statuses = [503, 503, 503]
+        with scheduler.fetch(server.url()) as response:
+            # the only retry of the budget is spent by the first request
+            self.assertEqual(response.status_code, 503)
+        self.assertEqual(server.requests, 2)
+        with scheduler.fetch(server.url()) as response:
+            self.assertEqual(response.status_code, 503)
+        self.assertEqual(server.requests, 3)
+        with scheduler.fetch(server.url()) as response:
+            self.assertEqual(response.status_code, 200)
+
+    def test_circuit_opens_then_closes(self):
+        server = self.make_server()
+        scheduler = FetchScheduler(HostPolicy(backoff=0.01, max_attempts=1, failure_threshold=2, open_seconds=0.2))
+        server.statuses = [500, 500]
+        for _ in range(2):
+            with scheduler.fetch(server.url()) as response:
+                self.assertEqual(response.status_code, 500)
+        with self.assertRaises(CircuitOpenError):
+            with scheduler.fetch(server.url()):
+                pass
+        self.assertEqual(server.requests, 2)
+
+        # other hosts are not affected
+        with scheduler.fetch(server.url('localhost')) as response:
+            self.assertEqual(response.status_code, 200)
+
+        time.sleep(0.25)
+        with scheduler.fetch(server.url()) as response:
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(scheduler.host_state(server.url()).state, 'closed')
+
+    def test_failed_trial_releases_the_host(self):
+        server = self.make_server()
+        scheduler = FetchScheduler(HostPolicy(backoff=0.01, max_attempts=1, failure_threshold=1, open_seconds=0.1))
+        server.statuses = [500]
+        with scheduler.fetch(server.url()):
+            pass
+        time.sleep(0.15)
+
+        class BrokenSession:
+            def get(self, *args, **kwargs):
+                raise ValueError("not a requests error")
+
+        scheduler._local.session = BrokenSession()
+        with self.assertRaises(ValueError):
+            with scheduler.fetch(server.url()):
+                pass
+        del scheduler._local.session
+        # the trial ended with the error : the next request tests the host again
+        with scheduler.fetch(server.url()) as response:
+            self.assertEqual(response.status_code, 200)
+
+    def test_backoff_does_not_hold_a_slot(self):
+        server = self.make_server()
+        scheduler = FetchScheduler(HostPolicy(max_concurrency=1))
+        state = scheduler.host_state(server.url())
+        state.backoff_until = time.monotonic() + 0.3
+
+        def fetch():
+            with scheduler.fetch(server.url()) as response:
+                return response.status_code
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(fetch)
+            time.sleep(0.1)
+            # the request waits for the backoff without its slot
+            self.assertTrue(state.slots.acquire(blocking=False))
+            state.slots.release()
+            self.assertEqual(future.result(), 200)
+
+    def test_provider(self):
+        server = self.make_server()
+        provider = NetworkEventsProvider(server.url(), scheduler=FetchScheduler())
+        self.assertEqual(provider.download().text, ICS)
+        self.assertEqual(list(provider.iter_ics_lines()), ICS.split('\r\n'))
+
+        provider.scheduler = FetchScheduler(HostPolicy(max_attempts=1, failure_threshold=1))
+        server.statuses = [502]
+        with self.assertRaises(InvalidStatusCodeError):
+            provider.download()
+        with self.assertRaises(CircuitOpenError):
+            provider.download()
@@ -0,0 +1,50 @@
+import unittest
+from datetime import datetime, timezone, timedelta
+
+from src.event_colors import EventColor
+from src.google_calendar_handler import GoogleCalendarHandler
+from src.google_event_view import GoogleEventView
+from src.fake_google_service import FakeGoogleService
+
+paris = timezone(timedelta(hours=1))
+
+kal_response = {'id': 'g1', 'summary': 'HAX301X', 'location': 'Amphi 5.02', 'colorId': '11',
+                'created': '2021-09-13T16:38:41.000Z', 'updated': 'not a date',
+                'start': {'dateTime': '2030-12-09T08:00:00+01:00', 'timeZone': 'Europe/Paris'},
+                'end': {'dateTime': '2030-12-09T09:30:00+01:00', 'timeZone': 'Europe/Paris'},
+                'extendedProperties': {'private': {'kal': 'true', 'kal_key': '1'}}}
+
+# user event with a start kal can't parse : it must never be decoded
+user_response = {'id': 'g2', 'summary': 'Dentist', 'start': {'unknown': ''}, 'end': {'unknown': ''}}
+
+
+class TestGoogleEventView(unittest.TestCase):
+
+    def test_to_event(self):
+        event = GoogleEventView(kal_response).to_event()
+        self.assertEqual(event.title, 'HAX301X')
+        self.assertEqual(event.start, datetime(2030, 12, 9, 8, tzinfo=paris))
+        self.assertEqual(event.color, EventColor.from_color_id('11'))
+        self.assertIsNotNone(event.created)
+        self.assertIsNone(event.updated)
+        self.assertFalse(event.is_all_day)
+
+    def test_all_day(self):
+        view = GoogleEventView(dict(kal_response, start={'date': '2030-12-09'}, end={'date': '2030-12-10'}))
+        self.assertTrue(view.is_all_day)
+        self.assertEqual(view.start, datetime(2030, 12, 9))
+
+    def test_fields_are_decoded_on_access(self):
+        view = GoogleEventView(user_response)
+        self.assertFalse(view.has_kal_signature)
+        self.assertEqual(view.title, 'Dentist')
+        with self.assertRaises(ValueError):
+            view.start
+
+    def test_kal_only_listing_skips_user_events(self):
+        service = FakeGoogleService()
+        service.calendars['calendar'] = {'g1': kal_response, 'g2': dict(user_response, start=kal_response['start'],
+                                                                      end=kal_response['end'])}
+        handler = GoogleCalendarHandler('calendar', service)
+        self.assertEqual([e.id for e in handler.get_events_since_date(kal_only=True)], ['g1'])
+        self.assertEqual(len(handler.get_events_since_date()), 2)
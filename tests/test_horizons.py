@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from src.event_rules import Condition, Rule
+from src.horizons import HorizonTier, HorizonScheduler, tier_windows
+from src.kal_worker import KalWorker
+from src.source_calendar.ics_calendar_provider import FileEventsProvider
+from src.fake_google_service import FakeGoogleService
+from tests.test_pipeline import write_ics, start
+
+# write_ics puts an event every hour from tomorrow : 120 events cover 5 days
+tiers = [
+    HorizonTier('near', timedelta(days=2)),
+    HorizonTier('mid', timedelta(days=4), refresh_interval=timedelta(hours=6)),
+    HorizonTier('far', None, refresh_interval=timedelta(days=1), max_writes=10),
+]
+
+
+class TestHorizons(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, 'cal.ics')
+        write_ics(self.path, [f'HAX{i}' for i in range(120)])
+        self.scheduler = HorizonScheduler(tiers, path=os.path.join(directory, 'horizons.sqlite'))
+        self.service = FakeGoogleService()
+
+    def make_worker(self, rules=()):
+        return KalWorker(source_ics_calendar_url=self.path, google_calendar_id='calendar', rules=list(rules),
+                         provider=FileEventsProvider(self.path))
+
+    def test_tier_windows(self):
+        now = datetime(2021, 9, 13)
+        windows = tier_windows(tiers, now)
+        self.assertEqual([(after, until) for tier, after, until in windows],
+                         [(now, now + timedelta(days=2)), (now + timedelta(days=2), now + timedelta(days=4)),
+                          (now + timedelta(days=4), None)])
+
+    def test_only_the_last_tier_is_unbounded(self):
+        with self.assertRaises(ValueError):
+            HorizonScheduler([HorizonTier('all', None), HorizonTier('near', timedelta(days=1))])
+
+    def test_tiers_partition_the_events(self):
+        plans = self.make_worker().run_tiered(self.service, self.scheduler)
+        self.assertEqual(list(plans), ['near', 'mid', 'far'])
+        # the far tier only sends its 10 nearest writes
+        self.assertEqual(len(plans['far'].changes), 10)
+        self.assertEqual(sum(len(plan.inserts) for plan in plans.values()), len(self.service.calendars['calendar']))
+        inserted_near = sorted(change.event.start for change in plans['near'].inserts)
+        inserted_mid = sorted(change.event.start for change in plans['mid'].inserts)
+        self.assertLess(inserted_near[-1], inserted_mid[0])
+
+    def test_rules_see_the_other_tiers(self):
+        # the near tier ends 2 days from now, i.e. 1 day after start : these two events overlap across it
+        write_ics(self.path, ['LAST NEAR', 'FIRST MID'],
+                  begins=[start + timedelta(hours=23, minutes=45), start + timedelta(hours=24, minutes=5)])
+        rules = [Rule().remove_event().on(Condition().overlaps_another_event())]
+        plans = self.make_worker(rules).run_tiered(self.service, self.scheduler)
+        self.assertTrue(all(plan.is_empty() for plan in plans.values()))
+        self.assertNotIn('calendar', self.service.calendars)
+
+    def test_refresh_intervals(self):
+        self.make_worker().run_tiered(self.service, self.scheduler)
+        # the far tier isn't fully synced yet : it stays due, the mid tier isn't
+        self.assertEqual([tier.name for tier in self.scheduler.due_tiers('calendar')], ['near', 'far'])
+
+        plans = self.make_worker().run_tiered(self.service, self.scheduler)
+        self.assertEqual(list(plans), ['near', 'far'])
+        self.assertTrue(plans['near'].is_empty())
+        self.assertEqual(len(plans['far'].changes), 10)
+
+        later = datetime.now() + timedelta(hours=7)
+        self.assertEqual([tier.name for tier in self.scheduler.due_tiers('calendar', later)], ['near', 'mid', 'far'])
+
+    def test_processes_share_the_schedule(self):
+        # e.g. two job workers syncing different tiers
+        other = HorizonScheduler(tiers, path=self.scheduler.path)
+        self.scheduler.mark_synced('calendar', tiers[1])
+        other.mark_synced('calendar', tiers[2])
+        self.assertEqual([tier.name for tier in self.scheduler.due_tiers('calendar')], ['near'])
+        other.reset('calendar')
+        self.assertEqual(len(self.scheduler.due_tiers('calendar')), 3)
+
+    def test_schedule_is_saved(self):
+        self.make_worker().run_tiered(self.service, self.scheduler)
+        scheduler = HorizonScheduler(tiers, path=self.scheduler.path)
+        self.assertEqual([tier.name for tier in scheduler.due_tiers('calendar')], ['near', 'far'])
+        scheduler.reset('calendar')
+        self.assertEqual(len(scheduler.due_tiers('calendar')), 3)
@@ -0,0 +1,64 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+
+from src.event import Event
+from src.event_colors import EventColor
+from src.event_rules import Condition, Rule
+from src.interval_index import IntervalIndex, duplicates_mask, find_conflicts
+from src.kal_worker import get_events_after_applying_rules
+
+monday = datetime(2021, 9, 13, 8)
+
+
+def event_at(hour: float, duration: float, title="Cours") -> Event:
+    start = monday + timedelta(hours=hour)
+    return Event(title=title, start=start, end=start + timedelta(hours=duration))
+
+
+def overlap(a: Event, b: Event) -> bool:
+    return a.start < b.end and b.start < a.end
+
+
+class TestIntervalIndex(unittest.TestCase):
+
+    def test_against_pairwise_comparison(self):
+        rng = random.Random(42)
+        for _ in range(50):
+            events = [event_at(rng.randint(0, 20) / 2, rng.randint(0, 6) / 2) for _ in range(rng.randint(0, 30))]
+            index = IntervalIndex(events)
+
+            expected_pairs = {(i, j) for i in range(len(events)) for j in range(i + 1, len(events))
+                              if overlap(events[i], events[j])}
+            self.assertEqual(set(index.overlapping_pairs()), expected_pairs)
+            self.assertEqual(index.overlaps_mask(),
+                             [any(i in pair for pair in expected_pairs) for i in range(len(events))])
+
+    def test_touching_events_dont_overlap(self):
+        self.assertEqual(IntervalIndex([event_at(8, 1), event_at(9, 1)]).overlaps_mask(), [False, False])
+
+    def test_duplicates(self):
+        events = [event_at(8, 1), event_at(8, 1, "TD"), event_at(8, 1), event_at(9, 1)]
+        self.assertEqual(duplicates_mask(events), [False, False, True, False])
+        self.assertEqual(duplicates_mask(events, fields=()), [False, True, True, False])
+
+    def test_conditions(self):
+        events = [event_at(8, 2, "Cours"), event_at(9, 1, "TD"), event_at(11, 1, "TP"), event_at(11, 1, "TP")]
+        rules = [
+            Rule().remove_event().on(Condition().is_duplicate()),
+            Rule().change_color(EventColor.TOMATO).on(Condition().overlaps_another_event()),
+        ]
+        result = get_events_after_applying_rules(events, rules)
+        self.assertEqual([e.color for e in result], [EventColor.TOMATO, EventColor.TOMATO, None])
+        self.assertRaises(ValueError, lambda: Condition().overlaps_another_event().evaluate(events[0]))
+
+    def test_context_conditions_see_the_whole_batch(self):
+        events = [event_at(8, 2, "Cours"), event_at(9, 1, "TD")]
+        rule = Rule().change_color(EventColor.TOMATO).on(
+            [Condition().field('title').equals('TD'), Condition().overlaps_another_event()])
+        self.assertEqual([e.color for e in rule.apply_to_batch(events)], [None, EventColor.TOMATO])
+
+    def test_conflicts_between_sources(self):
+        conflicts = find_conflicts({'L3': [event_at(8, 2), event_at(8, 1)], 'M1': [event_at(9, 1), event_at(12, 1)]})
+        self.assertEqual(len(conflicts), 1)
+        self.assertEqual({conflicts[0].source_1, conflicts[0].source_2}, {'L3', 'M1'})
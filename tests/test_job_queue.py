@@ -0,0 +1,80 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from src.job_queue import SQLiteJobQueue, JobWorker, DONE, PENDING, FAILED
+
+
+class TestSQLiteJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = SQLiteJobQueue(os.path.join(tempfile.mkdtemp(), 'jobs.sqlite'), max_attempts=2)
+
+    def test_pending_jobs_are_not_enqueued_twice(self):
+        self.assertEqual(self.queue.enqueue('L2', 'calendar'), self.queue.enqueue('L2', 'calendar'))
+
+    def test_one_active_job_per_calendar(self):
+        self.queue.enqueue('L2', 'calendar')
+        self.queue.enqueue('L2 bis', 'calendar')
+        self.queue.enqueue('L3', 'other calendar')
+
+        first = self.queue.claim('worker 1', lease_seconds=60)
+        second = self.queue.claim('worker 2', lease_seconds=60)
+        self.assertEqual((first.mirror_title, second.mirror_title), ('L2', 'L3'))
+        self.assertIsNone(self.queue.claim('worker 3', lease_seconds=60))
+
+        self.queue.complete(first)
+        self.assertEqual(self.queue.claim('worker 3', lease_seconds=60).mirror_title, 'L2 bis')
+
+    def test_expired_lease_is_claimed_again(self):
+        self.queue.enqueue('L2', 'calendar')
+        lost = self.queue.claim('worker 1', lease_seconds=0.01)
+        time.sleep(0.02)
+        job = self.queue.claim('worker 2', lease_seconds=60)
+        self.assertEqual(job.id, lost.id)
+
+        self.assertFalse(self.queue.heartbeat(lost, 60))
+        self.queue.complete(lost)  # too late : the job belongs to worker 2
+        self.assertEqual(self.queue.get(job.id).status, 'running')
+
+    def test_failed_jobs_are_retried(self):
+        job_id = self.queue.enqueue('L2', 'calendar')
+        self.queue.fail(self.queue.claim('worker', 60), 'error')
+        self.assertEqual(self.queue.get(job_id).status, PENDING)
+        self.queue.fail(self.queue.claim('worker', 60), 'error')
+        self.assertEqual(self.queue.get(job_id).status, FAILED)
+
+
+class TestJobWorker(unittest.TestCase):
+
+    def test_workers_never_run_a_calendar_twice_at_once(self):
+        queue = SQLiteJobQueue(os.path.join(tempfile.mkdtemp(), 'jobs.sqlite'))
+        ids = [queue.enqueue(f'mirror {i}', f'calendar {i % 2}') for i in range(6)]
+        running = set()
+        overlaps = []
+        lock = threading.Lock()
+
+        def run_job(job):
+            with lock:
+                if job.calendar_id in running:
+                    overlaps.append(job.calendar_id)
+                running.add(job.calendar_id)
+            time.sleep(0.05)
+            with lock:
+                running.discard(job.calendar_id)
+
+        workers = [JobWorker(queue, f'worker {i}', run_job, lease_seconds=1) for i in range(4)]
+
+        def drain(worker):
+            while any(queue.get(i).status != DONE for i in ids):
+                if worker.run_once() is None:
+                    time.sleep(0.01)
+
+        threads = [threading.Thread(target=drain, args=(worker,)) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(overlaps, [])
@@ -0,0 +1,37 @@
+import logging
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+from src.event import Event
+from src.event_rules import Condition, Rule
+from src.kal_worker import apply_rules_with_attribution
+from src.log_setup import setup_logging, RULE_DEBUG_SAMPLES
+
+
+class TestLogging(unittest.TestCase):
+
+    def test_queued_logging_reaches_the_file(self):
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        path = os.path.join(tempfile.mkdtemp(), 'log.log')
+        try:
+            listener = setup_logging(path, console=False)
+            logging.info("synced")
+            listener.stop()
+            # stopped again when the program exits
+            listener.stop()
+        finally:
+            root.handlers, root.level = handlers, level
+        with open(path, encoding='utf-8') as f:
+            self.assertIn('synced', f.read())
+
+    def test_rules_log_a_summary_and_samples(self):
+        events = [Event(title=f"HAX30{i}X", start=datetime(2021, 9, 17, 13), end=datetime(2021, 9, 17, 14))
+                  for i in range(10)]
+        rules = [Rule().named('no 30').remove_event().on(Condition().field('title').contains('30'))]
+        with self.assertLogs(level=logging.DEBUG) as logs:
+            apply_rules_with_attribution(events, rules)
+        self.assertIn('Rules applied to 10 events : no 30 matched 10 (removed 10)', logs.output[-1])
+        self.assertEqual(len([line for line in logs.output if 'DEBUG' in line]), RULE_DEBUG_SAMPLES)
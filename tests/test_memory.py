@@ -0,0 +1,66 @@
+import time
+import unittest
+
+from src.exceptions import MemoryDriftError
+from src.fake_google_service import FakeGoogleService
+from src.kal_worker import KalWorker
+from src.memory import MemoryTracker, current_rss
+from src.metrics import RunMetrics
+from src.soak import soak
+
+
+class LeakyWorker(KalWorker):
+    """Keeps every plan it applied."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.plans = []
+
+    def apply(self, plan, handler):
+        self.plans.append(plan)
+        return super().apply(plan, handler)
+
+
+def make_worker(worker_class=KalWorker, **kwargs):
+    return worker_class(source_ics_calendar_url='synthetic', google_calendar_id='soak', rules=[], **kwargs)
+
+
+class TestMemory(unittest.TestCase):
+
+    def test_stages_are_measured(self):
+        tracker = MemoryTracker(top=5)
+        self.addCleanup(tracker.stop)
+        worker = make_worker(memory_tracker=tracker)
+        service = FakeGoogleService()
+        soak(worker, service, cycles=2, events=10, warmup=1)
+        self.assertEqual(set(worker.metrics.memory), {'list', 'fetch', 'plan', 'write'})
+        self.assertTrue(all(stage.traced_peak >= stage.traced_end for stage in worker.metrics.memory.values()))
+        self.assertIn('peak', worker.metrics.summary())
+        self.assertEqual(len(worker.memory_report.top), 5)
+        self.assertEqual(worker.memory_report.label, 'soak')
+
+    @unittest.skipIf(current_rss() is None, "the RSS can only be read on linux")
+    def test_peak_rss_is_measured_per_stage(self):
+        tracker = MemoryTracker()
+        self.addCleanup(tracker.stop)
+        metrics = RunMetrics(calendar_id='calendar', memory_tracker=tracker)
+        size = 64 * 1024 * 1024
+        with metrics.stage('heavy'):
+            data = b'x' * size
+            time.sleep(0.05)
+            del data
+        with metrics.stage('light'):
+            time.sleep(0.05)
+        # the memory of the heavy stage is given back : the next stage doesn't report its peak
+        self.assertGreater(metrics.memory['heavy'].peak_rss - metrics.memory['light'].peak_rss, size // 2)
+
+    def test_soak_without_leak(self):
+        # what is left after the warmup is churn of the allocator and of the bounded caches : it stays around 20 KiB
+        result = soak(make_worker(), FakeGoogleService(), cycles=40, events=10, warmup=10, sample_every=5,
+                      max_drift=64 * 1024)
+        self.assertEqual(len(result.samples), 6)
+
+    def test_soak_detects_leak(self):
+        with self.assertRaises(MemoryDriftError):
+            soak(make_worker(LeakyWorker), FakeGoogleService(), cycles=20, events=10, warmup=5, sample_every=5,
+                 max_drift=16 * 1024)
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import pytz
+
+from src.event_colors import EventColor
+from src.event_rules import Condition, Rule
+from src.kal_worker import KalWorker
+from src.source_calendar.events_repository import split_ics_lines
+from src.source_calendar.ics_calendar_provider import FileEventsProvider, CalendarProvider
+from src.fake_google_service import FakeGoogleService
+
+rules = [
+    Rule().change_color(EventColor.TOMATO).on(Condition().field('title').contains('301')),
+    Rule().remove_event().on(Condition().field('title').contains('302')),
+]
+
+
+start = datetime.now(pytz.utc).replace(microsecond=0) + timedelta(days=1)
+
+
+def write_ics(path, titles, begins=None):
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:test']
+    for i, title in enumerate(titles):
+        begin = begins[i] if begins else start + timedelta(hours=i)
+        lines += ['BEGIN:VEVENT', f'UID:{i}', 'DTSTAMP:20210913T080000Z',
+                  f"DTSTART:{begin.strftime('%Y%m%dT%H%M%SZ')}",
+                  f"DTEND:{(begin + timedelta(minutes=30)).strftime('%Y%m%dT%H%M%SZ')}",
+                  f'SUMMARY:{title}', 'END:VEVENT']
+    lines.append('END:VCALENDAR')
+    with open(path, 'w') as f:
+        f.write('\r\n'.join(lines))
+
+
+class BrokenProvider(CalendarProvider):
+    def get_calendar(self):
+        raise ConnectionError("down")
+
+    def iter_ics_lines(self):
+        raise ConnectionError("down")
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'cal.ics')
+        self.service = FakeGoogleService()
+
+    def make_worker(self, provider=None, rules=rules):
+        return KalWorker(source_ics_calendar_url=self.path, google_calendar_id='calendar', rules=rules,
+                         provider=provider or FileEventsProvider(self.path))
+
+    def test_split_ics_lines(self):
+        write_ics(self.path, [f'HAX{i}' for i in range(7)])
+        with open(self.path) as f:
+            chunks = list(split_ics_lines(f.read().splitlines(), 3))
+        self.assertEqual(len(chunks), 3)
+        self.assertTrue(all(chunk.startswith('BEGIN:VCALENDAR') for chunk in chunks))
+        self.assertEqual(chunks[-1].count('BEGIN:VEVENT'), 1)
+
+    def test_same_result_as_sequential_run(self):
+        write_ics(self.path, ['HAX301X', 'HAX302X', 'HAI501I'] * 40)
+        plan = self.make_worker().run_pipelined(self.service, events_per_chunk=7)
+
+        self.assertEqual(len(plan.inserts), 80)
+        self.assertEqual(len(self.service.calendars['calendar']), 80)
+        self.assertTrue(self.make_worker().run(self.service).is_empty())
+
+        write_ics(self.path, ['HAX301X', 'HAI501I', 'HAI502I'] * 30)
+        plan = self.make_worker().run_pipelined(self.service, events_per_chunk=7)
+        self.assertEqual(plan.summary(), "30 inserts, 30 updates, 20 deletes")
+        self.assertTrue(self.make_worker().run(self.service).is_empty())
+
+    def test_failing_stage_raises(self):
+        with self.assertRaises(ConnectionError):
+            self.make_worker(BrokenProvider()).run_pipelined(self.service)
+        self.assertEqual(self.service.calendars, {})
+
+    def test_overlap_across_chunks(self):
+        # the second and third events overlap, but would be in two chunks of 2 events
+        write_ics(self.path, ['A', 'B', 'C', 'D'],
+                  begins=[start, start + timedelta(hours=1), start + timedelta(hours=1, minutes=15),
+                          start + timedelta(hours=3)])
+        overlap_rules = [Rule().remove_event().on(Condition().overlaps_another_event())]
+        with self.assertLogs(level='WARNING'):
+            plan = self.make_worker(rules=overlap_rules).run_pipelined(self.service, events_per_chunk=2)
+
+        self.assertEqual(len(plan.inserts), 2)
+        self.assertEqual(sorted(event['summary'] for event in self.service.calendars['calendar'].values()),
+                         ['A', 'D'])
@@ -0,0 +1,53 @@
+import json
+import os
+import pstats
+import tempfile
+import unittest
+
+from profile_mirror import profile_mirror
+from src.kal_worker import KalWorker
+from src.mirror import Mirror
+from src.source_calendar.ics_calendar_provider import FileEventsProvider
+from src.sync_plan import dump_events
+from tests.test_pipeline import write_ics, rules
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_profile_mirror(self):
+        directory = tempfile.mkdtemp()
+        ics_file = os.path.join(directory, 'cal.ics')
+        write_ics(ics_file, [f'HAX{300 + i % 5}' for i in range(100)])
+        mirror = Mirror('L2', 'https://example.com/l2.ics', 'calendar', rules)
+
+        # the google calendar already has the first half of the events
+        write_ics(os.path.join(directory, 'half.ics'), [f'HAX{300 + i % 5}' for i in range(50)])
+        worker = KalWorker(source_ics_calendar_url=ics_file, google_calendar_id='calendar', rules=rules,
+                           provider=FileEventsProvider(os.path.join(directory, 'half.ics')))
+        google_events_file = os.path.join(directory, 'google_events.json')
+        dump_events([change.event for change in worker.plan([]).inserts], google_events_file)
+
+        output = os.path.join(directory, 'profiles')
+        metrics = profile_mirror(mirror, ics_file, google_events_file, output)
+        self.assertEqual(metrics.counters['inserted'], 40)
+
+        for stage in ('list', 'fetch', 'plan', 'write'):
+            stats = pstats.Stats(os.path.join(output, f'{stage}.pstats'))
+            self.assertGreater(stats.total_calls, 0)
+            with open(os.path.join(output, f'{stage}.speedscope.json')) as f:
+                profile = json.load(f)
+            sampled = profile['profiles'][0]
+            self.assertEqual(len(sampled['samples']), len(sampled['weights']))
+            frame_count = len(profile['shared']['frames'])
+            self.assertTrue(all(0 <= i < frame_count for sample in sampled['samples'] for i in sample))
+
+    def test_profile_mirror_with_several_sources(self):
+        directory = tempfile.mkdtemp()
+        ics_files = [os.path.join(directory, name) for name in ('l2.ics', 'l3.ics')]
+        write_ics(ics_files[0], ['HAX301X', 'HAI501I'])
+        write_ics(ics_files[1], ['HAI502I', 'HAX302X', 'HAI503I'])
+        mirror = Mirror('L2 L3', ['https://example.com/l2.ics', 'https://example.com/l3.ics'], 'calendar', rules)
+
+        metrics = profile_mirror(mirror, ics_files, output_directory=os.path.join(directory, 'profiles'))
+        # the HAX302X event is removed by the rules
+        self.assertEqual(metrics.counters['inserted'], 4)
@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+from dataclasses import replace
+from datetime import datetime, timedelta
+
+import pytz
+
+from src.event import Event
+from src.event_colors import EventColor
+from src.remote_snapshot import CalendarSnapshot, CalendarSnapshotStore
+
+now = datetime.now(pytz.utc).replace(microsecond=0)
+
+events = [Event(id=f'g{i}', uid=str(i), title=f"HAX30{i}X", location="Amphi 5.02",
+                start=now + timedelta(days=i), end=now + timedelta(days=i, hours=1)) for i in range(3)]
+
+
+class TestRemoteSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.store = CalendarSnapshotStore(os.path.join(tempfile.mkdtemp(), 'snapshots'), max_age=timedelta(hours=1))
+
+    def test_apply_writes(self):
+        snapshot = CalendarSnapshot('calendar', now, list(events))
+        updated = replace(events[1], color=EventColor.TOMATO)
+        inserted = replace(events[0], id='g3', uid='3')
+        snapshot.apply_writes(['g0'], [updated], [inserted])
+        self.assertEqual(snapshot.events, [updated, events[2], inserted])
+
+    def test_save_and_load(self):
+        snapshot = CalendarSnapshot('user@group.calendar.google.com', now, list(events))
+        self.store.save(snapshot)
+        self.assertEqual(self.store.load('user@group.calendar.google.com'), snapshot)
+        self.assertIsNone(self.store.load('other calendar'))
+
+    def test_old_snapshots_are_not_fresh(self):
+        self.store.save(CalendarSnapshot('calendar', now - timedelta(minutes=30), list(events)))
+        self.assertIsNotNone(self.store.load_fresh('calendar'))
+
+        self.store.save(CalendarSnapshot('calendar', now - timedelta(hours=2), list(events)))
+        self.assertIsNone(self.store.load_fresh('calendar'))
+        # still readable, e.g. to compare with the listed events
+        self.assertIsNotNone(self.store.load('calendar'))
+
+    def test_invalidate(self):
+        self.store.save(CalendarSnapshot('calendar', now, list(events)))
+        self.store.invalidate('calendar')
+        self.assertIsNone(self.store.load('calendar'))
+        # invalidating twice is harmless
+        self.store.invalidate('calendar')
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from dataclasses import replace
+from datetime import datetime
+
+from src.event import Event
+from src.event_colors import EventColor
+from src.event_rules import Condition, Rule
+from src.kal_worker import apply_rules_with_attribution
+from src.rule_cache import RuleResultCache, rules_fingerprint
+
+event = Event(uid='1', title="HAX301X", description="Algèbre", start=datetime(2021, 9, 17, 13, 15),
+              end=datetime(2021, 9, 17, 14, 45))
+
+
+def make_rules(prefix='Algèbre - '):
+    return [Rule().prefix_str_to_field('title', prefix).change_color(EventColor.TOMATO)
+            .on(Condition().field('title').contains('301'))]
+
+
+class CountingCondition(Condition):
+    """Counts evaluations, to know if the rules really ran."""
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def evaluate(self, event):
+        self.count += 1
+        return super().evaluate(event)
+
+    def evaluate_batch(self, events):
+        self.count += len(events)
+        return super().evaluate_batch(events)
+
+
+class TestRuleCache(unittest.TestCase):
+
+    def test_cached_outcome_is_reused(self):
+        condition = CountingCondition().field('title').contains('301')
+        rules = [Rule().prefix_str_to_field('title', 'Algèbre - ').on(condition)]
+        cache = RuleResultCache()
+
+        first = apply_rules_with_attribution([event], rules, cache)
+        second = apply_rules_with_attribution([replace(event, description="Changed")], rules, cache)
+
+        self.assertEqual(condition.count, 1)
+        self.assertEqual(second[0].result.title, first[0].result.title)
+        # fields the rules don't write come from the new event
+        self.assertEqual(second[0].result.description, "Changed")
+
+    def test_rule_changes_invalidate(self):
+        self.assertNotEqual(rules_fingerprint(make_rules()), rules_fingerprint(make_rules('Algebra - ')))
+
+        cache = RuleResultCache()
+        apply_rules_with_attribution([event], make_rules(), cache)
+        outcome = apply_rules_with_attribution([event], make_rules('Algebra - '), cache)[0]
+        self.assertEqual(outcome.result.title, 'Algebra - HAX301X')
+
+    def test_removed_events_are_cached(self):
+        rules = [Rule().remove_event().on(Condition().field('title').contains('301'))]
+        cache = RuleResultCache()
+        apply_rules_with_attribution([event], rules, cache)
+        self.assertIsNone(apply_rules_with_attribution([event], rules, cache)[0].result)
+
+    def test_lru_eviction(self):
+        cache = RuleResultCache(max_size=2)
+        events = [replace(event, title=f'HAX301X {i}') for i in range(3)]
+        apply_rules_with_attribution(events, make_rules(), cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_persistence(self):
+        path = os.path.join(tempfile.mkdtemp(), 'rule_cache.pickle')
+        cache = RuleResultCache(path=path)
+        apply_rules_with_attribution([event], make_rules(), cache)
+        cache.save()
+
+        loaded = RuleResultCache(path=path)
+        self.assertEqual(len(loaded), 1)
+        outcome = loaded.bind(make_rules()).get(event)
+        self.assertEqual(outcome.result.color, EventColor.TOMATO)
@@ -0,0 +1,99 @@
+import json
+import os
+import pickle
+import tempfile
+import unittest
+from datetime import datetime
+
+from src.event import Event
+from src.event_colors import EventColor
+from src.exceptions import InvalidRuleFileError
+from src.kal_worker import get_events_after_applying_rules
+from src.rule_files import compile_rules, load_rules, rules_from_plan, yaml
+
+from mirrors.my_mirrors import _supermuel_rules
+
+events = [Event(title=title, start=datetime(2021, 9, 17, 13, 15), end=datetime(2021, 9, 17, 14, 45))
+          for title in ('HAI507I', 'hax505x TD', 'HAX504X', 'HAX506X CM', 'Réunion')]
+
+
+class TestRuleFiles(unittest.TestCase):
+
+    @unittest.skipIf(yaml is None, "PyYAML is not installed")
+    def test_yaml_file_matches_python_rules(self):
+        rules = load_rules('mirrors/my_rules.yaml', cache_directory=None)
+        self.assertEqual(get_events_after_applying_rules(events, rules),
+                         get_events_after_applying_rules(events, _supermuel_rules))
+
+    def test_compiled_plan_is_cached(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'rules.json')
+        with open(path, 'w') as f:
+            json.dump({'rules': [{'when': {'field': 'title', 'contains': 'HAI'},
+                                  'actions': [{'change_color': 'SAGE'}]}]}, f)
+
+        cache_directory = os.path.join(directory, 'cache')
+        rules = load_rules(path, cache_directory)
+        self.assertEqual(len(os.listdir(cache_directory)), 1)
+        cached_rules = load_rules(path, cache_directory)
+        self.assertEqual([rule.spec for rule in rules], [rule.spec for rule in cached_rules])
+        self.assertEqual(cached_rules[0].apply_to_event(events[0]).color, EventColor.SAGE)
+
+        # a new version of the file replaces the plan of the previous one, but not the plans of other files
+        other_path = os.path.join(directory, 'other_rules.json')
+        with open(other_path, 'w') as f:
+            json.dump([{'when': {'field': 'title', 'contains': 'HAX'}, 'actions': ['remove_event']}], f)
+        load_rules(other_path, cache_directory)
+        with open(path, 'w') as f:
+            json.dump([{'when': {'field': 'title', 'contains': 'HAX'}, 'actions': [{'change_color': 'SAGE'}]}], f)
+        load_rules(path, cache_directory)
+        self.assertEqual(len(os.listdir(cache_directory)), 2)
+
+    def test_unreadable_cached_plan_is_compiled_again(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'rules.json')
+        with open(path, 'w') as f:
+            json.dump([{'when': {'field': 'title', 'contains': 'HAI'}, 'actions': [{'change_color': 'SAGE'}]}], f)
+        cache_directory = os.path.join(directory, 'cache')
+        load_rules(path, cache_directory)
+        cache_path = os.path.join(cache_directory, os.listdir(cache_directory)[0])
+
+        # a pickle referring to a class that doesn't exist anymore, then a plan in an older format
+        for content in (b'\x80\x04csrc.rule_files\nRenamedSpec\n.', pickle.dumps([('name', 'not a spec')])):
+            with open(cache_path, 'wb') as f:
+                f.write(content)
+            with self.assertLogs(level='WARNING'):
+                rules = load_rules(path, cache_directory)
+            self.assertEqual(rules[0].apply_to_event(events[0]).color, EventColor.SAGE)
+            with open(cache_path, 'rb') as f:
+                self.assertEqual(pickle.load(f)[0][1][0], 'rule')
+
+    def test_plan_is_flattened(self):
+        plan = compile_rules([{
+            'when': {'any': [{'field': 'title', 'contains': 'A'},
+                             {'any': [{'field': 'title', 'contains': 'B'},
+                                      {'field': 'location', 'equals': 'Amphi'}]}]},
+            'actions': ['remove_event', {'change_color': 'SAGE'}],
+        }])
+        name, (_, actions, conditions) = plan[0]
+        self.assertEqual(actions, (('remove_event',),))
+        self.assertEqual(conditions, (('any', (('contains_any', 'title', ('A', 'B'), True),
+                                               ('equals', 'location', 'Amphi'))),))
+        rule = rules_from_plan(plan)[0]
+        self.assertIsNone(rule.apply_to_event(Event(title='B', location='Salle')))
+        self.assertIsNotNone(rule.apply_to_event(Event(title='C', location='Salle')))
+
+    def test_invalid_rules(self):
+        invalid = [
+            {'rules': 'nope'},
+            [{'actions': ['remove_event']}],
+            [{'when': {'field': 'title', 'contains': 'A'}}],
+            [{'when': {'field': 'start', 'contains': 'A'}, 'actions': ['remove_event']}],
+            [{'when': {'field': 'invalid', 'contains': 'A'}, 'actions': ['remove_event']}],
+            [{'when': {'field': 'title', 'matches': '('}, 'actions': ['remove_event']}],
+            [{'when': {'field': 'title', 'contains': 'A'}, 'actions': [{'change_color': 'PINK'}]}],
+            [{'when': {'field': 'title', 'contains': 'A'}, 'actions': [{'explode': True}]}],
+            [{'when': {'field': 'title', 'contains': 'A', 'case_sensitive': 'no'}, 'actions': ['remove_event']}],
+        ]
+        for data in invalid:
+            self.assertRaises(InvalidRuleFileError, lambda: compile_rules(data))
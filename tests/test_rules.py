@@ -44,3 +44,30 @@ class TestRules(unittest.TestCase):
         rule = Rule().change_color(EventColor.GRAPHITE).on([condition_false, condition_true])
         rule.apply_to_event(event_no_color)
         self.assertEqual(initial_color, event_no_color.color)
+
+
+class TestBatchRules(unittest.TestCase):
+    events = [
+        Event(title="HAX301X", description="Double L2", location="Amphi 5.02"),
+        Event(title="HAX302X", description="Double L2", location="Amphi 5.03"),
+        Event(title="HAX301X", description="L3", location=None),
+        Event(title=None, description="Double L2"),
+    ]
+
+    def assert_same_as_per_event(self, rule):
+        self.assertEqual(rule.apply_to_batch(self.events), [rule.apply_to_event(e) for e in self.events])
+
+    def test_batch_matches_per_event(self):
+        self.assert_same_as_per_event(
+            Rule().prefix_str_to_field('title', 'Algèbre - ').change_color(EventColor.SAGE)
+            .append_str_to_field('title', ' (CM)').on([condition_true, condition_true2]))
+        self.assert_same_as_per_event(
+            Rule().set_field_str('location', 'Online').on(Condition().field('description').contains('double', case_sensitive=False)))
+        self.assert_same_as_per_event(Rule().remove_event().on(Condition().logical_not(condition_true2)))
+        self.assert_same_as_per_event(Rule().change_color(EventColor.BASIL).on(
+            Condition().logical_any([condition_false, Condition().field('location').ends_with('03')])))
+
+    def test_batch_mask(self):
+        rule = Rule().change_color(EventColor.BASIL).on(
+            Condition().logical_and(condition_true, Condition().field('location').starts_with('Amphi')))
+        self.assertEqual(rule.match_batch(self.events), [True, False, False, False])
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+
+from src.event_rules import Rule, Condition
+from src.source_calendar.events_repository import EventsRepository
+from src.source_calendar.ics_calendar_provider import FileEventsProvider
+from src.string_pool import StringPool, TransformCache
+from tests.test_pipeline import write_ics
+
+
+class TestStringPool(unittest.TestCase):
+
+    def test_intern(self):
+        pool = StringPool()
+        a = pool.intern(''.join(['L2', ' CUPGE']))
+        b = pool.intern(''.join(['L2 ', 'CUPGE']))
+        self.assertIs(a, b)
+        self.assertIsNone(pool.intern(None))
+        self.assertEqual((len(pool), pool.hits), (1, 1))
+
+    def test_transform_cache(self):
+        cache = TransformCache(max_size=2)
+        upper = str.upper
+        self.assertIs(cache.apply(0, upper, 'a'), cache.apply(0, upper, 'a'))
+        self.assertEqual(cache.apply(1, lambda value: value + '!', 'a'), 'a!')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        cache.apply(0, upper, 'b')
+        self.assertEqual(len(cache), 1)
+
+    def test_parsed_events_share_their_values(self):
+        path = os.path.join(tempfile.mkdtemp(), 'cal.ics')
+        write_ics(path, ['HAX301', 'HAX302', 'HAX301'])
+        events = sorted(EventsRepository(FileEventsProvider(path)).get_events(), key=lambda event: event.start)
+        self.assertIs(events[0].title, events[2].title)
+
+    def test_rules_share_their_results(self):
+        path = os.path.join(tempfile.mkdtemp(), 'cal.ics')
+        write_ics(path, ['HAX301'] * 3 + ['HAX302'])
+        events = list(EventsRepository(FileEventsProvider(path)).get_events())
+        rule = Rule().prefix_str_to_field('title', 'Algebra - ').append_str_to_field('title', ' !') \
+            .on(Condition().field('title').contains('HAX'))
+
+        results = rule.apply_to_batch(events)
+        titles = {id(event.title) for event in results}
+        self.assertEqual(len(titles), 2)
+        self.assertEqual(sorted({event.title for event in results}), ['Algebra - HAX301 !', 'Algebra - HAX302 !'])
+        self.assertEqual(rule.transform_cache.misses, 4)
+
+        for event in events:
+            rule.apply_to_event(event)
+        self.assertEqual(rule.transform_cache.misses, 4)
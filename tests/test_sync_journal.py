@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from src.kal_worker import KalWorker
+from src.source_calendar.ics_calendar_provider import FileEventsProvider
+from src.sync_journal import SyncJournal
+from src.fake_google_service import FakeGoogleService
+from tests.test_pipeline import write_ics
+
+
+class TestSyncJournal(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, 'cal.ics')
+        write_ics(self.path, [f'HAX{i}' for i in range(120)])
+        self.journal = SyncJournal(os.path.join(directory, 'journals'))
+        self.service = FakeGoogleService()
+
+    def make_worker(self):
+        return KalWorker(source_ics_calendar_url=self.path, google_calendar_id='calendar', rules=[],
+                         provider=FileEventsProvider(self.path), journal=self.journal)
+
+    def test_interrupted_run_is_resumed_without_duplicates(self):
+        self.service.crash_after_batches = 2
+        with self.assertRaises(ConnectionAbortedError):
+            self.make_worker().run(self.service)
+        self.assertEqual(len(self.service.calendars['calendar']), 100)
+        pending = self.journal.pending('calendar')
+        self.assertEqual(len(pending.remaining_changes()), 20)
+
+        self.service.crash_after_batches = None
+        batches = self.service.batches
+        worker = self.make_worker()
+        self.assertTrue(worker.run(self.service).is_empty())
+        self.assertEqual(self.service.batches, batches + 1)
+        self.assertEqual(worker.metrics.counters['resumed writes'], 20)
+        self.assertEqual(len(self.service.calendars['calendar']), 120)
+        self.assertIsNone(self.journal.pending('calendar'))
+
+    def test_replayed_inserts_count_as_done(self):
+        plan = self.make_worker().plan([])
+        plan = self.journal.begin(plan)
+        # google did the first batch, but the process died before acknowledging it
+        events = [change.event for change in plan.inserts[:50]]
+        self.make_worker()._make_handler(self.service).insert_events(events)
+
+        self.make_worker().run(self.service)
+        self.assertEqual(len(self.service.calendars['calendar']), 120)
@@ -0,0 +1,149 @@
+import os
+import tempfile
+import unittest
+from dataclasses import replace
+from datetime import datetime, timedelta
+
+import pytz
+
+from src.event import Event
+from src.event_colors import EventColor
+from src.event_rules import Condition, Rule
+from src.kal_worker import KalWorker, FanOutWorker
+from src.mirror import FanOutMirror, MirrorTarget
+from src.source_calendar.ics_calendar_provider import FileEventsProvider
+from src.sync_plan import SyncPlan
+
+now = datetime(2021, 9, 13, 8, tzinfo=pytz.utc)
+
+algebra = Event(uid='1', title="HAX301X", description="Algèbre", location="Amphi 5.02",
+                start=now + timedelta(days=1), end=now + timedelta(days=1, hours=1))
+analysis = Event(uid='2', title="HAX302X", description="Analyse", location="Amphi 5.03",
+                 start=now + timedelta(days=2), end=now + timedelta(days=2, hours=1))
+
+rules = [
+    Rule().named('algebra').change_color(EventColor.TOMATO).on(Condition().field('title').contains('301')),
+    Rule().named('no analysis').remove_event().on(Condition().field('title').contains('302')),
+]
+
+
+def make_worker(rules_=None) -> KalWorker:
+    return KalWorker(source_ics_calendar_url="https://example.com/cal.ics", google_calendar_id="calendar",
+                     rules=rules if rules_ is None else rules_)
+
+
+class TestSyncPlan(unittest.TestCase):
+
+    def test_empty_calendar_only_inserts(self):
+        plan = make_worker().plan([], now, source_events=[algebra, analysis])
+        self.assertEqual(len(plan.inserts), 1)
+        self.assertEqual(plan.updates, [])
+        self.assertEqual(plan.deletes, [])
+
+        inserted = plan.inserts[0]
+        self.assertEqual(inserted.event.color, EventColor.TOMATO)
+        self.assertEqual(inserted.rules, ['algebra'])
+        self.assertEqual(inserted.event.extended_properties['private']['kal_key'], '1')
+
+    def test_unchanged_calendar_gives_empty_plan(self):
+        worker = make_worker()
+        first = worker.plan([], now, source_events=[algebra])
+        google_events = [replace(change.event, id='g1') for change in first.inserts]
+
+        self.assertTrue(worker.plan(google_events, now, source_events=[algebra]).is_empty())
+
+    def test_changed_event_is_updated(self):
+        worker = make_worker()
+        first = worker.plan([], now, source_events=[algebra])
+        google_events = [replace(change.event, id='g1') for change in first.inserts]
+
+        plan = worker.plan(google_events, now, source_events=[replace(algebra, location="Amphi 6.01")])
+        self.assertEqual(len(plan.updates), 1)
+        self.assertEqual(plan.updates[0].event.id, 'g1')
+        self.assertIn('location', plan.updates[0].reason)
+
+    def test_removed_events_are_deleted_with_attribution(self):
+        google_events = [replace(change.event, id=f'g{i}') for i, change in
+                         enumerate(make_worker([]).plan([], now, source_events=[algebra, analysis]).inserts)]
+
+        plan = make_worker().plan(google_events, now, source_events=[algebra, analysis])
+        self.assertEqual(len(plan.deletes), 1)
+        self.assertEqual(plan.deletes[0].event.id, 'g1')
+        self.assertEqual(plan.deletes[0].rules, ['no analysis'])
+
+    def test_events_before_separation_date_are_ignored(self):
+        plan = make_worker([]).plan([], algebra.start + timedelta(minutes=1), source_events=[algebra, analysis])
+        self.assertEqual([change.event.uid for change in plan.inserts], ['2'])
+
+    def test_serialization_round_trip(self):
+        plan = make_worker().plan([], now, source_events=[algebra, analysis])
+        loaded = SyncPlan.from_dict(plan.to_dict())
+        self.assertEqual(loaded.summary(), plan.summary())
+        self.assertEqual(loaded.inserts[0].event, plan.inserts[0].event)
+
+
+ICS_TEMPLATE = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:test
+BEGIN:VEVENT
+UID:{uid}
+DTSTAMP:20210913T080000Z
+DTSTART:20210915T080000Z
+DTEND:20210915T093000Z
+SUMMARY:{title}
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+class TestFanIn(unittest.TestCase):
+
+    def test_sources_are_merged_and_tagged(self):
+        directory = tempfile.mkdtemp()
+        providers = []
+        for uid, title in (('1', 'HAX301X'), ('2', 'HAI501I')):
+            path = os.path.join(directory, f'{uid}.ics')
+            with open(path, 'w') as f:
+                f.write(ICS_TEMPLATE.format(uid=uid, title=title))
+            providers.append(FileEventsProvider(path))
+
+        worker = KalWorker(source_ics_calendar_url=[p.file_path for p in providers], google_calendar_id="calendar",
+                           rules=[], provider=providers)
+        plan = worker.plan([], now)
+        self.assertEqual([change.event.title for change in plan.inserts], ['HAX301X', 'HAI501I'])
+        self.assertEqual([change.event.extended_properties['private']['kal_source'] for change in plan.inserts],
+                         [p.file_path for p in providers])
+
+
+class TestFanOut(unittest.TestCase):
+
+    def test_targets_continue_the_common_rules(self):
+        common = CountingRule().named('algebra').change_color(EventColor.TOMATO).on(
+            Condition().field('title').contains('301'))
+        mirror = FanOutMirror("fan", "https://example.com/cal.ics", common_rules=[common], targets=[
+            MirrorTarget("all", "calendar_all"),
+            MirrorTarget("no analysis", "calendar_2", rules=[
+                Rule().remove_event().on(Condition().field('title').contains('302'))]),
+        ])
+        worker = FanOutWorker(mirror)
+        future_events = [replace(e, start=datetime.now(pytz.utc) + (e.start - now),
+                                 end=datetime.now(pytz.utc) + (e.end - now)) for e in (algebra, analysis)]
+        plans = worker.plan(source_events=future_events)
+
+        self.assertEqual(common.count, 1)
+        self.assertEqual([change.event.title for change in plans['all'].inserts], ['HAX301X', 'HAX302X'])
+        self.assertEqual([change.event.title for change in plans['no analysis'].inserts], ['HAX301X'])
+        self.assertEqual(plans['no analysis'].inserts[0].rules, ['algebra'])
+        self.assertEqual(plans['no analysis'].deletes, [])
+
+
+class CountingRule(Rule):
+    """Counts the batches the rule is matched against."""
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def match_batch(self, events):
+        self.count += 1
+        return super().match_batch(events)
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import time
+import unittest
+import urllib.request
+from urllib.error import HTTPError
+
+from src.job_queue import SQLiteJobQueue
+from src.kal_worker import KalWorker
+from src.mirror import Mirror
+from src.watch import WatchRegistry, NotificationReceiver, OwnWriteLog, PUSH_PAYLOAD
+from src.fake_google_service import FakeGoogleService
+from src.source_calendar.ics_calendar_provider import FileEventsProvider
+from tests.test_pipeline import write_ics
+
+
+def notify(port, channel_id, token, state='exists'):
+    request = urllib.request.Request(f'http://127.0.0.1:{port}/', method='POST', data=b'', headers={
+        'X-Goog-Channel-ID': channel_id, 'X-Goog-Channel-Token': token, 'X-Goog-Resource-State': state})
+    try:
+        return urllib.request.urlopen(request).status
+    except HTTPError as e:
+        return e.code
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = directory = tempfile.mkdtemp()
+        self.own_writes = OwnWriteLog(os.path.join(directory, 'own_writes.sqlite'))
+        self.service = FakeGoogleService()
+        self.registry = WatchRegistry('https://example.com/notifications', os.path.join(directory, 'channels.json'))
+        self.queue = SQLiteJobQueue(os.path.join(directory, 'jobs.sqlite'))
+        self.mirrors = [Mirror('L2', 'https://example.com/l2.ics', 'calendar', []),
+                        Mirror('L3', 'https://example.com/l3.ics', 'other calendar', [])]
+
+    def test_channels_are_kept_and_renewed(self):
+        channel = self.registry.watch(self.service, 'calendar')
+        self.assertIs(self.registry.watch(self.service, 'calendar'), channel)
+
+        channel.expiration = time.time()
+        renewed = self.registry.watch(self.service, 'calendar')
+        self.assertNotEqual(renewed.id, channel.id)
+        self.assertEqual(list(self.service.watched), [renewed.id])
+        # the registry is saved for the next processes
+        loaded = WatchRegistry(self.registry.address, self.registry.path)
+        self.assertEqual(loaded.channel_for('calendar').token, renewed.token)
+
+    def test_notifications_are_debounced_into_jobs(self):
+        channel = self.registry.watch(self.service, 'calendar')
+        receiver = NotificationReceiver(self.registry, self.mirrors, self.queue, host='127.0.0.1', port=0,
+                                        debounce=0.1)
+        receiver.start()
+        try:
+            self.assertEqual(notify(receiver.port, channel.id, channel.token, state='sync'), 200)
+            self.assertEqual(notify(receiver.port, channel.id, 'wrong token'), 404)
+            for _ in range(3):
+                self.assertEqual(notify(receiver.port, channel.id, channel.token), 200)
+            time.sleep(0.3)
+        finally:
+            receiver.stop()
+
+        job = self.queue.claim('worker', 60)
+        self.assertEqual((job.mirror_title, job.payload), ('L2', PUSH_PAYLOAD))
+        self.assertIsNone(self.queue.claim('worker', 60))
+
+    def make_receiver(self):
+        receiver = NotificationReceiver(self.registry, self.mirrors, self.queue, host='127.0.0.1', port=0,
+                                        own_writes=self.own_writes, get_service=lambda mirror: self.service)
+        receiver.start()
+        self.addCleanup(receiver.stop)
+        return receiver
+
+    def test_notifications_of_own_writes_are_ignored(self):
+        path = os.path.join(self.directory, 'l2.ics')
+        write_ics(path, ['HAX301X', 'HAX302X', 'HAX303X'])
+        worker = KalWorker(source_ics_calendar_url=path, google_calendar_id='calendar', rules=[],
+                           provider=FileEventsProvider(path), own_writes=self.own_writes)
+        worker.run(self.service)
+        receiver = self.make_receiver()
+        receiver._enqueue_syncs('calendar')
+        self.assertIsNone(self.queue.claim('worker', 60))
+
+        # kal deletes an event
+        write_ics(path, ['HAX301X', 'HAX302X'])
+        worker.run(self.service)
+        receiver._enqueue_syncs('calendar')
+        self.assertIsNone(self.queue.claim('worker', 60))
+
+        # someone edits a kal event right after
+        event_id, body = next(iter(self.service.calendars['calendar'].items()))
+        self.service.events().update(calendarId='calendar', eventId=event_id,
+                                     body=dict(body, summary='Moved')).execute()
+        receiver._enqueue_syncs('calendar')
+        self.assertEqual(self.queue.claim('worker', 60).mirror_title, 'L2')
+
+    def test_old_own_writes_are_not_checked(self):
+        self.own_writes.note('calendar', ['g0'], [], at=time.time() - 120)
+        self.assertEqual(self.own_writes.writes_since('calendar', time.time() - 60), {})
+        self.assertEqual(self.own_writes.writes_since('calendar', time.time() - 180), {'g0': (True, None)})
+        self.make_receiver()._enqueue_syncs('calendar')
+        self.assertEqual(self.queue.claim('worker', 60).mirror_title, 'L2')